@@ -0,0 +1,153 @@
+##########################################
+
+def _as_tuples(aabb):
+    return (tuple(float(v) for v in aabb[0]), tuple(float(v) for v in aabb[1]))
+
+
+def _union(aabb1, aabb2):
+    return (tuple(min(a, b) for a, b in zip(aabb1[0], aabb2[0])), tuple(max(a, b) for a, b in zip(aabb1[1], aabb2[1])))
+
+
+def _area(aabb):
+    dx, dy, dz = (u - l for l, u in zip(*aabb))
+    return 2 * (dx*dy + dy*dz + dz*dx)
+
+
+def _overlap(aabb1, aabb2):
+    return all(l1 <= u2 and l2 <= u1 for l1, u1, l2, u2 in zip(aabb1[0], aabb1[1], aabb2[0], aabb2[1]))
+
+
+class _Node(object):
+    __slots__ = ('aabb', 'name', 'parent', 'children')
+
+    def __init__(self, aabb, name=None, parent=None, children=None):
+        self.aabb = aabb
+        self.name = name
+        self.parent = parent
+        self.children = children
+
+    @property
+    def is_leaf(self):
+        return self.children is None
+
+
+class AABBTree(object):
+    """Bounding volume hierarchy of named AABBs that can be updated one object at a time.
+
+    `build` creates a balanced tree by median splits along the longest axis. `insert` places a new leaf next to
+    the node that increases the total surface area the least (surface area heuristic), `remove` takes the leaf
+    out and `update` moves it. `query` returns the names of the objects whose AABB overlaps a query AABB,
+    visiting only the branches that overlap it.
+    """
+
+    def __init__(self):
+        self.root = None
+        # leaves[name] = leaf node
+        self.leaves = {}
+
+    def __len__(self):
+        return len(self.leaves)
+
+    def __contains__(self, name):
+        return name in self.leaves
+
+    def get_aabb(self, name):
+        return self.leaves[name].aabb
+
+    def build(self, aabb_from_name):
+        """Replaces the tree by a balanced tree of the {name : aabb} objects.
+        """
+        self.leaves = {name : _Node(_as_tuples(aabb), name=name) for name, aabb in aabb_from_name.items()}
+        self.root = self._build(list(self.leaves.values()))
+
+    def _build(self, leaves):
+        if not leaves:
+            return None
+        if len(leaves) == 1:
+            leaves[0].parent = None
+            return leaves[0]
+        aabb = leaves[0].aabb
+        for leaf in leaves[1:]:
+            aabb = _union(aabb, leaf.aabb)
+        axis = max(range(3), key=lambda k: aabb[1][k] - aabb[0][k])
+        leaves = sorted(leaves, key=lambda leaf: leaf.aabb[0][axis] + leaf.aabb[1][axis])
+        middle = len(leaves) // 2
+        node = _Node(aabb, children=[self._build(leaves[:middle]), self._build(leaves[middle:])])
+        for child in node.children:
+            child.parent = node
+        return node
+
+    def insert(self, name, aabb):
+        if name in self.leaves:
+            self.remove(name)
+        leaf = _Node(_as_tuples(aabb), name=name)
+        self.leaves[name] = leaf
+        if self.root is None:
+            self.root = leaf
+            return
+
+        # * descend to the sibling with the lowest surface area cost
+        node = self.root
+        while not node.is_leaf:
+            union_area = _area(_union(node.aabb, leaf.aabb))
+            cost_here = 2 * union_area
+            inherited_cost = 2 * (union_area - _area(node.aabb))
+            child_costs = []
+            for child in node.children:
+                child_union_area = _area(_union(child.aabb, leaf.aabb))
+                child_costs.append(child_union_area + inherited_cost if child.is_leaf else \
+                    child_union_area - _area(child.aabb) + inherited_cost)
+            if cost_here < min(child_costs):
+                break
+            node = node.children[child_costs.index(min(child_costs))]
+
+        # * new parent of the sibling and the leaf
+        old_parent = node.parent
+        new_parent = _Node(_union(node.aabb, leaf.aabb), parent=old_parent, children=[node, leaf])
+        node.parent = new_parent
+        leaf.parent = new_parent
+        if old_parent is None:
+            self.root = new_parent
+        else:
+            old_parent.children[old_parent.children.index(node)] = new_parent
+        self._refit(old_parent)
+
+    def remove(self, name):
+        leaf = self.leaves.pop(name)
+        parent = leaf.parent
+        if parent is None:
+            self.root = None
+            return
+        # the sibling takes the place of the parent
+        sibling = parent.children[1] if parent.children[0] is leaf else parent.children[0]
+        grandparent = parent.parent
+        sibling.parent = grandparent
+        if grandparent is None:
+            self.root = sibling
+        else:
+            grandparent.children[grandparent.children.index(parent)] = sibling
+            self._refit(grandparent)
+
+    def update(self, name, aabb):
+        self.insert(name, aabb)
+
+    def _refit(self, node):
+        while node is not None:
+            node.aabb = _union(node.children[0].aabb, node.children[1].aabb)
+            node = node.parent
+
+    def query(self, aabb):
+        """Names of the objects whose AABB overlaps `aabb`.
+        """
+        aabb = _as_tuples(aabb)
+        names = []
+        stack = [self.root] if self.root is not None else []
+        while stack:
+            node = stack.pop()
+            if not _overlap(node.aabb, aabb):
+                continue
+            if node.is_leaf:
+                names.append(node.name)
+            else:
+                stack.extend(node.children)
+        return names
@@ -0,0 +1,269 @@
+from itertools import islice
+
+import numpy as np
+import pybullet
+import pybullet_planning as pp
+
+from integral_timber_joints.planning.robot_setup import BARE_ARM_GROUP, GANTRY_ARM_GROUP
+
+from utils import LOGGER
+
+# Joint axes of the 6-axis arm in its base frame at zero configuration (ABB convention in the ROS-Industrial urdfs)
+ARM_JOINT_AXES = np.array([
+    [0, 0, 1],
+    [0, 1, 0],
+    [0, 1, 0],
+    [1, 0, 0],
+    [0, 1, 0],
+    [1, 0, 0],
+], dtype=float)
+
+KINEMATICS_TOLERANCE = 1e-6
+
+# Wrist joints (4 and 6) whose limits usually span more than one turn, see `add_joint_turns`
+WRIST_TURN_JOINTS = (3, 5)
+
+##########################################
+
+def _rotation_from_quat(quat):
+    return np.array(pybullet.getMatrixFromQuaternion(quat)).reshape(3, 3)
+
+
+def _wrap_angle(angles):
+    return (angles + np.pi) % (2 * np.pi) - np.pi
+
+
+def extract_gantry_arm_kinematics(robot_uid, gantry_joints, arm_joints, arm_base_link, arm_tool_link):
+    """Read the kinematic parameters of the gantry and of the 6-axis arm from the pybullet model.
+    Returns None if the robot does not match the structure assumed by `batch_arm_ik`:
+    prismatic gantry joints (the arm base only translates) and an ABB-like spherical wrist arm.
+    """
+    for joint in gantry_joints:
+        if pp.get_joint_type(robot_uid, joint) != pybullet.JOINT_PRISMATIC:
+            return None
+
+    kinematics = {}
+    with pp.WorldSaver():
+        pp.set_joint_positions(robot_uid, gantry_joints, np.zeros(len(gantry_joints)))
+        pp.set_joint_positions(robot_uid, arm_joints, np.zeros(len(arm_joints)))
+        base_point, base_quat = pp.get_link_pose(robot_uid, arm_base_link)
+        base_point = np.array(base_point)
+        base_rotation = _rotation_from_quat(base_quat)
+
+        # * arm base translation per unit gantry joint value
+        gantry_directions = []
+        for i, joint in enumerate(gantry_joints):
+            values = np.zeros(len(gantry_joints))
+            values[i] = 1.0
+            pp.set_joint_positions(robot_uid, gantry_joints, values)
+            point, quat = pp.get_link_pose(robot_uid, arm_base_link)
+            if not np.allclose(_rotation_from_quat(quat), base_rotation, atol=KINEMATICS_TOLERANCE):
+                return None
+            gantry_directions.append(np.array(point) - base_point)
+        pp.set_joint_positions(robot_uid, gantry_joints, np.zeros(len(gantry_joints)))
+
+        # * arm joint origins and axes, expressed in the arm base frame
+        joint_points = []
+        for joint, expected_axis in zip(arm_joints, ARM_JOINT_AXES):
+            point, quat = pp.get_link_pose(robot_uid, pp.child_link_from_joint(joint))
+            axis = _rotation_from_quat(quat).dot(pp.get_joint_info(robot_uid, joint).jointAxis)
+            if not np.allclose(base_rotation.T.dot(axis), expected_axis, atol=KINEMATICS_TOLERANCE):
+                return None
+            joint_points.append(base_rotation.T.dot(np.array(point) - base_point))
+        joint_points = np.array(joint_points)
+
+        tool_point, tool_quat = pp.get_link_pose(robot_uid, arm_tool_link)
+        tool_rotation = base_rotation.T.dot(_rotation_from_quat(tool_quat))
+        tool_point = base_rotation.T.dot(np.array(tool_point) - base_point)
+
+    # all joints lie in the xz plane of the arm base, joint 3 is right above joint 2 at zero configuration
+    # and the wrist axes intersect at the joint 5 origin
+    if not np.allclose(joint_points[1:, 1], 0, atol=KINEMATICS_TOLERANCE) or \
+        not np.isclose(joint_points[2, 0], joint_points[1, 0], atol=KINEMATICS_TOLERANCE) or \
+        not np.isclose(joint_points[3, 2], joint_points[4, 2], atol=KINEMATICS_TOLERANCE) or \
+        not np.isclose(joint_points[5, 2], joint_points[4, 2], atol=KINEMATICS_TOLERANCE):
+        return None
+
+    kinematics['base_point'] = base_point
+    kinematics['base_rotation'] = base_rotation
+    kinematics['gantry_directions'] = np.array(gantry_directions)
+    kinematics['a1'] = joint_points[1, 0] # shoulder offset
+    kinematics['d1'] = joint_points[1, 2] # shoulder height
+    kinematics['a2'] = joint_points[2, 2] - joint_points[1, 2] # upper arm length
+    kinematics['a3'] = joint_points[3, 2] - joint_points[2, 2] # elbow offset
+    kinematics['d4'] = joint_points[4, 0] - joint_points[2, 0] # forearm length
+    kinematics['tool_rotation'] = tool_rotation
+    # wrist center (joint 5 origin) expressed in the tool frame, constant for all configurations
+    kinematics['wrist_from_tool'] = tool_rotation.T.dot(joint_points[4] - tool_point)
+    return kinematics
+
+##########################################
+
+def batch_arm_ik(kinematics, gantry_values, world_from_tool):
+    """Analytic IK of the arm for a batch of gantry configurations and one tool pose.
+
+    Parameters
+    ----------
+    gantry_values : (N, num_gantry_joints) array
+    world_from_tool : pybullet pose (point, quat), in meter
+
+    Returns
+    -------
+    (N, 8, 6) array of arm joint values in [-pi, pi), NaN where a solution does not exist.
+    """
+    gantry_values = np.atleast_2d(gantry_values)
+    base_rotation = kinematics['base_rotation']
+
+    # * tool pose in the arm base frame, only the translation varies with the gantry
+    base_points = kinematics['base_point'] + gantry_values.dot(kinematics['gantry_directions'])
+    tool_rotation = base_rotation.T.dot(_rotation_from_quat(world_from_tool[1]))
+    tool_points = (np.array(world_from_tool[0]) - base_points).dot(base_rotation)
+    return batch_arm_ik_in_base_frame(kinematics, tool_points, tool_rotation)
+
+
+def batch_arm_ik_in_base_frame(kinematics, tool_points, tool_rotation):
+    """Analytic IK of the arm for a batch of tool positions sharing one orientation, both in the arm base frame.
+    Returns a (N, 8, 6) array of arm joint values in [-pi, pi), NaN where a solution does not exist.
+    """
+    num_bases = tool_points.shape[0]
+    a1, d1, a2, a3, d4 = [kinematics[k] for k in ['a1', 'd1', 'a2', 'a3', 'd4']]
+    wrist_points = tool_points + tool_rotation.dot(kinematics['wrist_from_tool'])
+    wx, wy, wz = wrist_points[:, 0], wrist_points[:, 1], wrist_points[:, 2]
+
+    wrist_rotation = tool_rotation.dot(kinematics['tool_rotation'].T)
+    forearm_length = np.hypot(d4, a3)
+    forearm_angle = np.arctan2(d4, a3)
+    solutions = np.full((num_bases, 8, 6), np.nan)
+    with np.errstate(invalid='ignore'):
+        for shoulder in range(2):
+            # * joint 1, facing the wrist center or turned around
+            q1 = np.arctan2(wy, wx) + shoulder * np.pi
+            r = np.hypot(wx, wy) * (1 - 2 * shoulder)
+            x, z = r - a1, wz - d1
+            cos_elbow = (x**2 + z**2 - a2**2 - forearm_length**2) / (2 * a2 * forearm_length)
+            for elbow in range(2):
+                # * joint 3 and joint 2, planar two-link problem
+                q3 = (1 - 2 * elbow) * np.arccos(cos_elbow) - forearm_angle
+                vx = d4 * np.cos(q3) + a3 * np.sin(q3)
+                vz = a2 - d4 * np.sin(q3) + a3 * np.cos(q3)
+                q2 = np.arctan2(vz, vx) - np.arctan2(z, x)
+
+                # * wrist, Rx(q4) Ry(q5) Rx(q6) = Ry(q2 + q3)^T Rz(q1)^T R_tool R_tool_zero^T
+                c1, s1 = np.cos(q1), np.sin(q1)
+                c23, s23 = np.cos(q2 + q3), np.sin(q2 + q3)
+                rz1_t = np.zeros((num_bases, 3, 3))
+                rz1_t[:, 0, 0], rz1_t[:, 0, 1], rz1_t[:, 1, 0], rz1_t[:, 1, 1], rz1_t[:, 2, 2] = c1, s1, -s1, c1, 1
+                ry23_t = np.zeros((num_bases, 3, 3))
+                ry23_t[:, 0, 0], ry23_t[:, 0, 2], ry23_t[:, 2, 0], ry23_t[:, 2, 2], ry23_t[:, 1, 1] = c23, -s23, s23, c23, 1
+                m = ry23_t @ rz1_t @ wrist_rotation
+                q5 = np.arccos(np.clip(m[:, 0, 0], -1, 1))
+                q4 = np.arctan2(m[:, 1, 0], -m[:, 2, 0])
+                q6 = np.arctan2(m[:, 0, 1], m[:, 0, 2])
+                for wrist, (w4, w5, w6) in enumerate([(q4, q5, q6), (q4 + np.pi, -q5, q6 + np.pi)]):
+                    index = 4 * shoulder + 2 * elbow + wrist
+                    solutions[:, index, :] = _wrap_angle(np.stack([q1, q2, q3, w4, w5, w6], axis=1))
+    return solutions
+
+
+def add_joint_turns(solutions, joint_indices=WRIST_TURN_JOINTS):
+    """Adds the variants of the solutions with the values of the `joint_indices` turned by -2pi and +2pi,
+    (N, K, 6) -> (N, K * 3**len(joint_indices), 6). The variants outside the joint limits are removed
+    by `filter_joint_limits`.
+    """
+    for index in joint_indices:
+        turns = np.zeros((3, solutions.shape[-1]))
+        turns[:, index] = [0, -2 * np.pi, 2 * np.pi]
+        solutions = (solutions[:, :, None, :] + turns).reshape(solutions.shape[0], -1, solutions.shape[-1])
+    return solutions
+
+
+def filter_joint_limits(solutions, lower_limits, upper_limits):
+    """Boolean mask (N, K) of the solutions that exist and are within the joint limits.
+    """
+    valid = ~np.isnan(solutions).any(axis=-1)
+    with np.errstate(invalid='ignore'):
+        valid &= ((solutions >= lower_limits) & (solutions <= upper_limits)).all(axis=-1)
+    return valid
+
+##########################################
+
+def get_gantry_arm_kinematics(client, robot, options=None):
+    """Kinematic parameters of the gantry and arm (see `extract_gantry_arm_kinematics`),
+    together with the joint names and the arm joint limits (including `joint_custom_limits`).
+    Returns None if the robot kinematics is not supported.
+    """
+    options = options or {}
+    robot_uid = client.get_robot_pybullet_uid(robot)
+    arm_joint_names = robot.get_configurable_joint_names(group=BARE_ARM_GROUP)
+    arm_joints = pp.joints_from_names(robot_uid, arm_joint_names)
+    arm_base_link = pp.link_from_name(robot_uid, robot.get_base_link_name(group=BARE_ARM_GROUP))
+    arm_tool_link = pp.link_from_name(robot_uid, robot.get_end_effector_link_name(group=BARE_ARM_GROUP))
+
+    # the base configurations come with all the non-arm joints of the gantry arm group
+    gantry_arm_joint_names = robot.get_configurable_joint_names(group=GANTRY_ARM_GROUP)
+    gantry_joint_names = [name for name in gantry_arm_joint_names if name not in arm_joint_names]
+    gantry_joints = pp.joints_from_names(robot_uid, gantry_joint_names)
+
+    kinematics = extract_gantry_arm_kinematics(robot_uid, gantry_joints, arm_joints, arm_base_link, arm_tool_link)
+    if kinematics is None:
+        return None
+
+    joint_custom_limits = options.get('joint_custom_limits', {})
+    pb_custom_limits = {pp.joint_from_name(robot_uid, jn) : lims for jn, lims in joint_custom_limits.items()}
+    lower_limits, upper_limits = pp.get_custom_limits(robot_uid, arm_joints, pb_custom_limits)
+    gantry_lower_limits, gantry_upper_limits = pp.get_custom_limits(robot_uid, gantry_joints, pb_custom_limits)
+    kinematics.update({
+        'robot_uid' : robot_uid,
+        'gantry_joints' : gantry_joints,
+        'gantry_joint_names' : gantry_joint_names,
+        'gantry_joint_types' : robot.get_joint_types_by_names(gantry_joint_names),
+        'lower_limits' : np.array(lower_limits),
+        'upper_limits' : np.array(upper_limits),
+        'gantry_lower_limits' : np.array(gantry_lower_limits),
+        'gantry_upper_limits' : np.array(gantry_upper_limits),
+    })
+    return kinematics
+
+
+def get_batch_ik_fn(client, robot, options=None):
+    """Returns a function (base_confs, world_from_tool) -> list of arm_conf_vals for each base configuration,
+    solving the arm IK for all gantry base configurations at once and keeping the solutions within
+    the joint limits (including `joint_custom_limits`), with the wrist joints turned by 2pi where the limits allow it.
+    Returns None if the robot kinematics is not supported, the caller should then use the per-sample IK.
+    """
+    kinematics = get_gantry_arm_kinematics(client, robot, options)
+    if kinematics is None:
+        LOGGER.warning('Batch IK: unsupported robot kinematics, falling back to per-sample IK.')
+        return None
+    lower_limits, upper_limits = kinematics['lower_limits'], kinematics['upper_limits']
+
+    def batch_ik_fn(base_confs, world_from_tool):
+        gantry_values = np.array([base_conf.joint_values for base_conf in base_confs])
+        solutions = add_joint_turns(batch_arm_ik(kinematics, gantry_values, world_from_tool))
+        valid = filter_joint_limits(solutions, lower_limits, upper_limits)
+        arm_conf_vals_from_base = [[] for _ in base_confs]
+        for base_index, ik_index in zip(*np.nonzero(valid)):
+            arm_conf_vals_from_base[base_index].append(list(solutions[base_index, ik_index]))
+        return arm_conf_vals_from_base
+
+    return batch_ik_fn
+
+
+def gantry_ik_gen(gantry_sampler, gantry_attempts, world_from_tool, arm_sample_ik_fn, batch_ik_fn=None, batch_size=50):
+    """Yields (gantry_iter, base_conf, arm_conf_vals) for each gantry base sample.
+    With `batch_ik_fn`, gantry samples are drawn `batch_size` at a time and solved in one call,
+    otherwise `arm_sample_ik_fn` is called after each gantry sample (it uses the gantry configuration set in the world).
+    """
+    if batch_ik_fn is None:
+        for gantry_iter, base_conf in zip(range(gantry_attempts), gantry_sampler):
+            yield gantry_iter, base_conf, arm_sample_ik_fn(world_from_tool)
+        return
+
+    gantry_iter = 0
+    while gantry_iter < gantry_attempts:
+        base_confs = list(islice(gantry_sampler, min(batch_size, gantry_attempts - gantry_iter)))
+        if not base_confs:
+            return
+        for base_conf, arm_conf_vals in zip(base_confs, batch_ik_fn(base_confs, world_from_tool)):
+            yield gantry_iter, base_conf, arm_conf_vals
+            gantry_iter += 1
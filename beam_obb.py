@@ -0,0 +1,137 @@
+import numpy as np
+import pybullet_planning as pp
+
+from fk_cache import get_com_pose, matrices_from_quats
+from trajectory import replay_trajectory
+from utils import TrajectoryMemo
+
+##########################################
+
+def local_box(body, link=pp.BASE_LINK):
+    """(center, half extents) of the box that bounds the collision vertices of a link, in the link's inertial frame
+    (see `fk_cache.get_com_pose`).
+    Returns None if the link has no collision geometry.
+    """
+    points = np.array(pp.vertices_from_rigid(body, link), dtype=float).reshape(-1, 3)
+    if len(points) == 0:
+        return None
+    lower, upper = points.min(axis=0), points.max(axis=0)
+    return (lower + upper) / 2, (upper - lower) / 2
+
+
+def world_box(pose, box):
+    """(center, rotation, half extents) of a local box placed at the pose of the link's inertial frame.
+    """
+    center, extents = box
+    rotation = np.array(pp.matrix_from_quat(pose[1]))
+    return np.array(pose[0]) + rotation.dot(center), rotation, extents
+
+
+def obbs_separated(centers_a, rotations_a, extents_a, centers_b, rotations_b, extents_b):
+    """Separating axis test between broadcastable arrays of oriented boxes
+    (centers (..., 3), rotations (..., 3, 3) with the box axes as columns, half extents (..., 3)).
+    Returns a bool array that is True where the boxes are certainly disjoint.
+    """
+    # box b in the frame of box a
+    R = np.einsum('...ki,...kj->...ij', rotations_a, rotations_b)
+    t = np.einsum('...ki,...k->...i', rotations_a, centers_b - centers_a)
+    # the epsilon keeps the cross product axes of (nearly) parallel edges conservative
+    absR = np.abs(R) + 1e-6
+    ea, eb = extents_a, extents_b
+
+    # * axes of a, axes of b
+    separated = np.any(np.abs(t) > ea + np.einsum('...ij,...j->...i', absR, eb), axis=-1)
+    t_b = np.einsum('...i,...ij->...j', t, R)
+    separated |= np.any(np.abs(t_b) > np.einsum('...i,...ij->...j', ea, absR) + eb, axis=-1)
+
+    # * cross products of an axis of a and an axis of b
+    for i in range(3):
+        i1, i2 = (i + 1) % 3, (i + 2) % 3
+        for j in range(3):
+            j1, j2 = (j + 1) % 3, (j + 2) % 3
+            distance = np.abs(t[..., i2] * R[..., i1, j] - t[..., i1] * R[..., i2, j])
+            radius = ea[..., i1] * absR[..., i2, j] + ea[..., i2] * absR[..., i1, j] + \
+                eb[..., j1] * absR[..., i, j2] + eb[..., j2] * absR[..., i, j1]
+            separated |= distance > radius
+    return separated
+
+##########################################
+
+class BeamOBBChecker(object):
+    """Analytic collision prefilter between the robot links and the beams, placed in front of the pybullet checks.
+
+    The beams are rectangular prisms, each beam is bounded by the box of its collision vertices at its
+    assembled pose (joint cuts only remove material). Each robot link is bounded by the box of its collision
+    vertices in the link's inertial frame, grown by `margin`. The link boxes at each trajectory point are placed
+    at the inertial frame poses of the `fk_cache` (or computed by a single replay and memoized for the
+    `memo_size` most recent trajectories), and the separating
+    axis test is evaluated for all the points, links and beams at once. The robot can only collide with a beam at the points where a link box overlaps
+    the beam box, the other points do not need a pybullet check.
+    """
+
+    def __init__(self, client, robot_uid, links, margin=0.01, fk_cache=None, memo_size=1000):
+        self.client = client
+        self.robot_uid = robot_uid
+        # link poses shared with the other tests of the trajectory, see `fk_cache.TrajectoryFKCache`
+        self.fk_cache = fk_cache
+        # links without collision geometry can not collide
+        self.link_boxes = {}
+        for link in links:
+            box = local_box(robot_uid, link)
+            if box is not None:
+                self.link_boxes[link] = (box[0], box[1] + margin)
+        self.links = list(self.link_boxes)
+        # beam_boxes[name] = (center, rotation, half extents) in the world
+        self.beam_boxes = {}
+        # link_obbs[traj] = (centers (T, L, 3), rotations (T, L, 3, 3)), without `fk_cache`
+        self.link_obbs = TrajectoryMemo(memo_size)
+        self.query_count = 0
+        self.separated_count = 0
+
+    def add_beam(self, name, body, pose):
+        box = local_box(body)
+        if box is not None:
+            self.beam_boxes[name] = world_box(pose, box)
+
+    def get_link_obbs(self, traj):
+        """Link box centers and rotations at each trajectory point.
+        This changes the robot configuration in the world if the link poses are not cached.
+        """
+        if self.fk_cache is not None:
+            positions, quats = self.fk_cache.get_link_poses(traj, self.links)
+            rotations = matrices_from_quats(quats)
+            link_centers = np.array([self.link_boxes[link][0] for link in self.links])
+            return positions + np.einsum('tlij,lj->tli', rotations, link_centers), rotations
+        if traj not in self.link_obbs:
+            centers, rotations = [], []
+            for _ in replay_trajectory(self.client, self.robot_uid, traj):
+                boxes = [world_box(get_com_pose(self.robot_uid, link), self.link_boxes[link]) for link in self.links]
+                centers.append([center for center, _, _ in boxes])
+                rotations.append([rotation for _, rotation, _ in boxes])
+            self.link_obbs[traj] = (np.array(centers).reshape(-1, len(self.links), 3),
+                np.array(rotations).reshape(-1, len(self.links), 3, 3))
+        return self.link_obbs[traj]
+
+    def get_ambiguous_points(self, traj, names):
+        """(T, len(names)) bool array, True where a robot link box overlaps the beam box at the trajectory point.
+        Unknown beams are overlapping at every point.
+        """
+        centers, rotations = self.get_link_obbs(traj)
+        ambiguous = np.ones((len(centers), len(names)), dtype=bool)
+        known = [k for k, name in enumerate(names) if name in self.beam_boxes]
+        if not self.links:
+            ambiguous[:, known] = False
+        if not known or not self.links:
+            return ambiguous
+        beam_centers = np.array([self.beam_boxes[names[k]][0] for k in known])
+        beam_rotations = np.array([self.beam_boxes[names[k]][1] for k in known])
+        beam_extents = np.array([self.beam_boxes[names[k]][2] for k in known])
+        link_extents = np.array([self.link_boxes[link][1] for link in self.links])
+
+        # (T, L, B)
+        separated = obbs_separated(centers[:, :, None], rotations[:, :, None], link_extents[None, :, None],
+            beam_centers[None, None], beam_rotations[None, None], beam_extents[None, None])
+        ambiguous[:, known] = ~np.all(separated, axis=1)
+        self.query_count += len(known)
+        self.separated_count += int(np.sum(~np.any(ambiguous[:, known], axis=0)))
+        return ambiguous
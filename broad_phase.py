@@ -0,0 +1,156 @@
+import numpy as np
+import pybullet_planning as pp
+
+from aabb_tree import AABBTree
+from beam_obb import local_box
+from fk_cache import matrices_from_quats
+from trajectory import replay_trajectory
+from utils import TrajectoryMemo
+
+##########################################
+
+def buffer_aabb(aabb, margin):
+    lower, upper = aabb
+    return pp.AABB([v - margin for v in lower], [v + margin for v in upper])
+
+
+def get_links_aabb(body, links):
+    return pp.aabb_union([pp.get_aabb(body, link) for link in links])
+
+
+class BroadPhaseIndex(object):
+    """AABB prefilter placed in front of the pybullet narrow-phase checks.
+
+    Static objects (beams at `assembly_wcf_final`, clamps at `clamp_wcf_final`) are registered once with their AABB,
+    in a dict and in an `AABBTree` that finds the objects close to a trajectory (`get_candidates`).
+    The swept AABB of a trajectory (union of the robot link AABBs and of the attached objects over all points)
+    is computed on first use and memoized. If the two AABBs are disjoint, the narrow-phase check can be skipped.
+    The AABB of each trajectory point is memoized as well, so that the narrow phase can be restricted
+    to the points whose AABB overlaps the object (`get_overlapping_points`).
+    Both memos keep the `memo_size` most recently used trajectories.
+    """
+
+    def __init__(self, client, robot_uid, links, margin=0.01, fk_cache=None, memo_size=1000):
+        self.client = client
+        self.robot_uid = robot_uid
+        self.links = links
+        self.margin = margin
+        # with the inertial frame poses of the `fk_cache`, the link AABBs bound the link boxes (see `beam_obb.local_box`)
+        # and the trajectory is not replayed
+        self.fk_cache = fk_cache
+        self.link_boxes = {}
+        if fk_cache is not None:
+            self.link_boxes = {link : box for link, box in ((link, local_box(robot_uid, link)) for link in links) if box is not None}
+        self.object_aabbs = {}
+        # the same AABBs in a hierarchy, to find the objects close to a trajectory without visiting all of them
+        self.object_tree = AABBTree()
+        # point_aabbs[traj] = [aabb of each point]
+        self.point_aabbs = TrajectoryMemo(memo_size)
+        # swept_aabbs[traj] = aabb
+        self.swept_aabbs = TrajectoryMemo(memo_size)
+        self.pruned_count = 0
+        self.query_count = 0
+
+    def add_object(self, name, body, pose=None):
+        """Register an object's AABB, at `pose` if given (the body is moved there), or at its current pose otherwise.
+        """
+        if pose is not None:
+            pp.set_pose(body, pose)
+        self.object_aabbs[name] = buffer_aabb(pp.get_aabb(body), self.margin)
+        self.object_tree.insert(name, self.object_aabbs[name])
+
+    def add_objects(self, objects):
+        """Register the AABBs of the (name, body, pose) objects, the hierarchy is rebuilt once (balanced) instead of
+        inserting the objects one at a time. The bodies are moved to the poses.
+        """
+        for name, body, pose in objects:
+            pp.set_pose(body, pose)
+            self.object_aabbs[name] = buffer_aabb(pp.get_aabb(body), self.margin)
+        self.object_tree.build(self.object_aabbs)
+
+    def remove_object(self, name):
+        if name in self.object_aabbs:
+            del self.object_aabbs[name]
+            self.object_tree.remove(name)
+
+    def get_nearby_objects(self, aabb):
+        """Names of the registered objects whose AABB overlaps `aabb`.
+        """
+        return self.object_tree.query(aabb)
+
+    def get_point_aabbs(self, traj, attachments=()):
+        """AABB of the robot links (and attached objects) at each trajectory point, buffered by the margin.
+        This changes the robot configuration (or the attached object poses) in the world.
+        """
+        if traj not in self.point_aabbs and self.fk_cache is not None and self.link_boxes and \
+                all(attachment.parent_link in self.fk_cache.link_index for attachment in attachments):
+            self.point_aabbs[traj] = self._compute_point_aabbs_from_fk(traj, attachments)
+        if traj not in self.point_aabbs:
+            point_aabbs = []
+            for _ in replay_trajectory(self.client, self.robot_uid, traj):
+                aabbs = [get_links_aabb(self.robot_uid, self.links)]
+                for attachment in attachments:
+                    attachment.assign()
+                    aabbs.append(pp.get_aabb(attachment.child))
+                point_aabbs.append(buffer_aabb(pp.aabb_union(aabbs), self.margin))
+            self.point_aabbs[traj] = point_aabbs
+        return self.point_aabbs[traj]
+
+    def _compute_point_aabbs_from_fk(self, traj, attachments):
+        links = list(self.link_boxes)
+        positions, quats = self.fk_cache.get_link_poses(traj, links)
+        rotations = matrices_from_quats(quats)
+        centers = positions + np.einsum('tlij,lj->tli', rotations, np.array([self.link_boxes[link][0] for link in links]))
+        extents = np.einsum('tlij,lj->tli', np.abs(rotations), np.array([self.link_boxes[link][1] for link in links]))
+        lowers, uppers = (centers - extents).min(axis=1), (centers + extents).max(axis=1)
+        attachment_poses = [self.fk_cache.get_attachment_poses(traj, attachment) for attachment in attachments]
+        point_aabbs = []
+        for i in range(len(positions)):
+            aabbs = [pp.AABB(lowers[i], uppers[i])]
+            for attachment, poses in zip(attachments, attachment_poses):
+                pp.set_pose(attachment.child, poses[i])
+                aabbs.append(pp.get_aabb(attachment.child))
+            point_aabbs.append(buffer_aabb(pp.aabb_union(aabbs), self.margin))
+        return point_aabbs
+
+    def get_swept_aabb(self, traj, attachments=()):
+        """Union of the robot link AABBs (and attached objects) over all trajectory points.
+        This changes the robot configuration in the world.
+        """
+        if traj not in self.swept_aabbs:
+            self.swept_aabbs[traj] = pp.aabb_union(self.get_point_aabbs(traj, attachments))
+        return self.swept_aabbs[traj]
+
+    def get_overlapping_points(self, traj, name, attachments=()):
+        """Indices of the trajectory points whose AABB overlaps the object `name`, all points for unknown objects.
+        """
+        self.query_count += 1
+        point_aabbs = self.get_point_aabbs(traj, attachments)
+        if name not in self.object_aabbs:
+            return list(range(len(point_aabbs)))
+        object_aabb = self.object_aabbs[name]
+        point_indices = [i for i, aabb in enumerate(point_aabbs) if pp.aabb_overlap(aabb, object_aabb)]
+        if not point_indices:
+            self.pruned_count += 1
+        return point_indices
+
+    def get_candidates(self, traj, attachments=()):
+        """Names of the registered objects whose AABB overlaps the trajectory's swept AABB,
+        the other objects can not collide with it.
+        """
+        candidates = self.get_nearby_objects(self.get_swept_aabb(traj, attachments))
+        self.query_count += len(self.object_aabbs)
+        self.pruned_count += len(self.object_aabbs) - len(candidates)
+        return candidates
+
+    def may_collide(self, traj, name, attachments=()):
+        """False if the trajectory's swept volume is certainly disjoint from the object `name`.
+        Unknown objects are always reported as possible collisions.
+        """
+        self.query_count += 1
+        if name not in self.object_aabbs:
+            return True
+        if pp.aabb_overlap(self.get_swept_aabb(traj, attachments), self.object_aabbs[name]):
+            return True
+        self.pruned_count += 1
+        return False
@@ -0,0 +1,109 @@
+from collections import OrderedDict
+
+import numpy as np
+import pybullet_planning as pp
+
+##########################################
+
+def _pose_key(pose, precision=6):
+    point, quat = pose
+    return tuple(round(v, precision) for v in list(point) + list(quat))
+
+
+class CartesianPathCache(object):
+    """LRU cache of Cartesian paths, keyed by the target pose list and the quantized start configuration.
+
+    `plan_cartesian_motion_from_links` solves the IK of each target pose in sequence, seeded by the solution
+    of the previous one, and returns one configuration per target pose. A stored path of a request
+    with the same start configuration and a common prefix of target poses can therefore be reused
+    for that prefix, and the planning only continues from the last reused configuration.
+    Failed requests (None) are stored as well.
+    A reused path leaves the robot at its last configuration, as `plan_fn` does.
+    The samplers only use the cache with `options['cartesian_cache']`, it rarely hits since the gantry and IK samples
+    seldom repeat a start configuration.
+    """
+
+    def __init__(self, max_entries=10000, resolution=1e-3):
+        self.max_entries = max_entries
+        self.resolution = resolution
+        # entries[(start_key, pose_keys)] = path or None
+        self.entries = OrderedDict()
+        # pose_keys_from_start[start_key] = set of pose_keys stored for this start, for the prefix lookup
+        self.pose_keys_from_start = {}
+        self.hits = 0
+        self.prefix_hits = 0
+        self.misses = 0
+
+    @property
+    def hit_rate(self):
+        num_queries = self.hits + self.prefix_hits + self.misses
+        return (self.hits + self.prefix_hits) / float(num_queries) if num_queries else 0.0
+
+    def _start_key(self, start_conf):
+        return tuple(np.round(np.array(start_conf) / self.resolution).astype(int).tolist())
+
+    def _store(self, key, path):
+        self.entries[key] = path
+        self.entries.move_to_end(key)
+        self.pose_keys_from_start.setdefault(key[0], set()).add(key[1])
+        while len(self.entries) > self.max_entries:
+            (start_key, pose_keys), _ = self.entries.popitem(last=False)
+            self.pose_keys_from_start[start_key].discard(pose_keys)
+            if not self.pose_keys_from_start[start_key]:
+                del self.pose_keys_from_start[start_key]
+
+    def _longest_prefix(self, start_key, pose_keys):
+        # longest stored successful path from the same start, sharing a prefix of target poses
+        best_key, best_length = None, 0
+        for stored_pose_keys in self.pose_keys_from_start.get(start_key, ()):
+            key = (start_key, stored_pose_keys)
+            if self.entries[key] is None:
+                continue
+            length = 0
+            for stored_pose_key, pose_key in zip(stored_pose_keys, pose_keys):
+                if stored_pose_key != pose_key:
+                    break
+                length += 1
+            if length > best_length:
+                best_key, best_length = key, length
+        return best_key, best_length
+
+    def plan(self, plan_fn, robot_uid, joints, start_conf, target_poses):
+        """Returns the path from `plan_fn(target_poses)` (one configuration of `joints` per target pose),
+        starting at the configuration `start_conf` currently set in the world.
+        """
+        start_key = self._start_key(start_conf)
+        pose_keys = tuple(_pose_key(pose) for pose in target_poses)
+        key = (start_key, pose_keys)
+        if key in self.entries:
+            self.hits += 1
+            self.entries.move_to_end(key)
+            path = self.entries[key]
+            if path is None:
+                return None
+            pp.set_joint_positions(robot_uid, joints, path[-1])
+            return list(path)
+
+        prefix_key, prefix_length = self._longest_prefix(start_key, pose_keys)
+        if prefix_length > 0:
+            self.prefix_hits += 1
+            self.entries.move_to_end(prefix_key)
+            prefix_path = list(self.entries[prefix_key][:prefix_length])
+            if prefix_length == len(target_poses):
+                path = prefix_path
+                pp.set_joint_positions(robot_uid, joints, path[-1])
+            else:
+                # continue the IK chain from the last reused configuration
+                pp.set_joint_positions(robot_uid, joints, prefix_path[-1])
+                suffix_path = plan_fn(target_poses[prefix_length:])
+                path = None if suffix_path is None else prefix_path + list(suffix_path)
+        else:
+            self.misses += 1
+            path = plan_fn(target_poses)
+
+        self._store(key, None if path is None else [list(conf) for conf in path])
+        return path
+
+    def stats_str(self):
+        return 'Cartesian cache: {} hits, {} prefix hits, {} misses ({:.1%} hit rate), {} entries'.format(
+            self.hits, self.prefix_hits, self.misses, self.hit_rate, len(self.entries))
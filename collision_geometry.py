@@ -0,0 +1,254 @@
+import os
+
+import numpy as np
+import pybullet_planning as pp
+
+from integral_timber_joints.planning.robot_setup import GANTRY_ARM_GROUP, get_tolerances
+
+from load_pddlstream import HERE
+from fk_cache import get_com_pose
+from stream_cache import hash_from_data
+from utils import LOGGER
+
+# Bump this whenever the proxy computation changes, old proxy files are then recomputed.
+COLLISION_GEOMETRY_VERSION = 1
+COLLISION_GEOMETRY_DIR = os.path.join(HERE, 'collision_geometry')
+
+# Proxies of the loaded world, keyed by client id, shared by all samplers of this process
+_COLLISION_PROXIES = {}
+
+##########################################
+
+def _sphere_directions(num_directions):
+    # the 6 axis directions (so that the proxy is within the AABB) and a Fibonacci sphere
+    axes = np.vstack([np.eye(3), -np.eye(3)])
+    k = np.arange(num_directions) + 0.5
+    z = 1 - 2 * k / num_directions
+    r = np.sqrt(1 - z**2)
+    theta = np.pi * (1 + 5**0.5) * k
+    return np.vstack([axes, np.column_stack([r * np.cos(theta), r * np.sin(theta), z])])
+
+
+def kdop_from_points(points, num_directions):
+    """Convex polytope bounded by the supporting planes of the points in `num_directions` directions (k-DOP).
+    It contains the convex hull of the points, so a collision free proxy proves that the mesh is collision free.
+    Returns the polytope's (vertices, triangles) and its error: the largest distance of its vertices
+    outside the face planes of the points' hull. Returns None for flat or degenerate meshes.
+    """
+    # only needed when the proxies are enabled
+    from scipy.spatial import ConvexHull, HalfspaceIntersection, QhullError
+
+    points = np.asarray(points, dtype=float)
+    try:
+        hull = ConvexHull(points)
+        directions = _sphere_directions(num_directions)
+        offsets = points.dot(directions.T).max(axis=0)
+        # scipy's halfspaces are [normal, offset] with normal . x + offset <= 0
+        interior = points[hull.vertices].mean(axis=0)
+        intersection = HalfspaceIntersection(np.column_stack([directions, -offsets]), interior)
+        vertices = intersection.intersections
+        kdop = ConvexHull(vertices)
+    except (QhullError, ValueError):
+        return None
+    error = max(0.0, (vertices.dot(hull.equations[:, :3].T) + hull.equations[:, 3]).max())
+    return vertices[kdop.vertices], _reindex_triangles(kdop.simplices, kdop.vertices), error
+
+
+def _reindex_triangles(simplices, vertex_indices):
+    index_from_vertex = {v : i for i, v in enumerate(vertex_indices)}
+    return [[index_from_vertex[v] for v in triangle] for triangle in simplices]
+
+
+def _write_obj(path, vertices, triangles):
+    # write and rename, several worker processes may write the same proxy
+    tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+    with open(tmp_path, 'w') as f:
+        for vertex in vertices:
+            f.write('v {:.6f} {:.6f} {:.6f}\n'.format(*vertex))
+        for triangle in triangles:
+            f.write('f {} {} {}\n'.format(*[v + 1 for v in triangle]))
+    os.replace(tmp_path, path)
+
+##########################################
+
+class CollisionProxies(object):
+    """Simplified collision geometry of the bodies of a world, used as a conservative first check.
+
+    Each link with a collision mesh gets a proxy body, a k-DOP (see `kdop_from_points`) of its mesh vertices
+    with as few directions as the `tolerance` (in meter) allows, up to `max_directions`.
+    The proxies are computed once per mesh and persisted as obj files under `geometry_dir`,
+    the file name is a hash of the mesh vertices and of the parameters.
+
+    A link pair is checked on the proxies, which are moved to the links' inertial frames (the frame of the
+    collision vertices, see `fk_cache.get_com_pose`), first. The proxies contain
+    the meshes, so a collision free proxy pair is collision free. If the proxies collide the pair is
+    re-checked on the exact meshes when `conservative` is set, otherwise the pair is reported in collision
+    (false positives within the tolerance).
+    """
+
+    def __init__(self, conservative=True, tolerance=0.01, min_directions=20, max_directions=200, geometry_dir=COLLISION_GEOMETRY_DIR):
+        self.conservative = conservative
+        self.tolerance = tolerance
+        self.min_directions = min_directions
+        self.max_directions = max_directions
+        self.geometry_dir = geometry_dir
+        # proxies[(body, link)] = proxy body, None if the link has no usable collision mesh
+        self.proxies = {}
+        self.proxy_checks = 0
+        self.exact_checks = 0
+
+    def _proxy_path(self, points):
+        key = hash_from_data([COLLISION_GEOMETRY_VERSION, np.round(points, 6).tolist(),
+            self.tolerance, self.min_directions, self.max_directions])
+        return os.path.join(self.geometry_dir, key + '.obj')
+
+    def _compute_proxy(self, path, points):
+        num_directions = self.min_directions
+        while True:
+            kdop = kdop_from_points(points, num_directions)
+            if kdop is None:
+                return False
+            vertices, triangles, error = kdop
+            if error <= self.tolerance or num_directions >= self.max_directions:
+                break
+            num_directions *= 2
+        if not os.path.exists(self.geometry_dir):
+            os.makedirs(self.geometry_dir)
+        _write_obj(path, vertices, triangles)
+        LOGGER.debug('Collision proxy {}: {} mesh vertices -> {} vertices, error {:.4f} m.'.format(
+            os.path.basename(path), len(points), len(vertices), error))
+        return True
+
+    def add_body(self, body):
+        for link in pp.get_all_links(body):
+            self.get_proxy(body, link)
+
+    def get_proxy(self, body, link=pp.BASE_LINK):
+        key = (body, link)
+        if key not in self.proxies:
+            self.proxies[key] = None
+            points = np.array(pp.vertices_from_rigid(body, link), dtype=float).reshape(-1, 3)
+            if len(points) < 4:
+                return None
+            path = self._proxy_path(points)
+            if not os.path.exists(path) and not self._compute_proxy(path, points):
+                return None
+            self.proxies[key] = pp.create_obj(path, color=(0, 0, 0, 0))
+        return self.proxies[key]
+
+    def _synced_proxy(self, body, link):
+        proxy = self.get_proxy(body, link)
+        if proxy is not None:
+            pp.set_pose(proxy, get_com_pose(body, link))
+        return proxy
+
+    def link_pair_collision(self, body1, link1, body2, link2):
+        return self._link_pair_collision(body1, link1, self._synced_proxy(body1, link1), body2, link2, self._synced_proxy(body2, link2))
+
+    def _link_pair_collision(self, body1, link1, proxy1, body2, link2, proxy2):
+        # the proxies are already at the links' poses
+        if proxy1 is not None and proxy2 is not None:
+            self.proxy_checks += 1
+            if not pp.pairwise_collision(proxy1, proxy2):
+                return False
+            if not self.conservative:
+                return True
+        self.exact_checks += 1
+        return pp.pairwise_link_collision(body1, link1, body2, link2)
+
+    def any_link_pair_collision(self, body1, links1, body2, links2=None):
+        """Same as `pp.any_link_pair_collision`, checked on the proxies first.
+        """
+        links1 = pp.get_all_links(body1) if links1 is None else links1
+        links2 = pp.get_all_links(body2) if links2 is None else links2
+        # each proxy is moved once per call, not once per pair
+        proxies1 = {link : self._synced_proxy(body1, link) for link in links1}
+        proxies2 = {link : self._synced_proxy(body2, link) for link in links2}
+        return any(self._link_pair_collision(body1, link1, proxies1[link1], body2, link2, proxies2[link2]) \
+            for link1 in links1 for link2 in links2)
+
+    def pairwise_collision(self, body1, body2):
+        return self.any_link_pair_collision(body1, None, body2, None)
+
+##########################################
+
+def check_collision_proxies(client, robot, proxies, num_samples=100, seed=0):
+    """Compares the proxy and exact checks of the gantry arm links against the other proxied links
+    (of the robot and of the other bodies) at uniform configurations of the gantry arm.
+    Returns the (conf, body1, link1, body2, link2) pairs that collide on the exact meshes but not on the proxies,
+    there are none if the proxies are computed and placed correctly.
+    """
+    robot_uid = client.get_robot_pybullet_uid(robot)
+    joints = pp.joints_from_names(robot_uid, robot.get_configurable_joint_names(group=GANTRY_ARM_GROUP))
+    joint_custom_limits = get_tolerances(robot).get('joint_custom_limits', {})
+    custom_limits = {pp.joint_from_name(robot_uid, jn) : lims for jn, lims in joint_custom_limits.items()}
+    lower_limits, upper_limits = pp.get_custom_limits(robot_uid, joints, custom_limits)
+    links = pp.get_moving_links(robot_uid, joints)
+
+    # the proxies contain the meshes, so an exact collision is always a proxy collision
+    links1 = [link for link in links if proxies.get_proxy(robot_uid, link) is not None]
+    others = [key for key, proxy in list(proxies.proxies.items()) if proxy is not None]
+    missed = []
+    rng = np.random.default_rng(seed)
+    with pp.WorldSaver():
+        for conf in rng.uniform(lower_limits, upper_limits, size=(num_samples, len(joints))):
+            pp.set_joint_positions(robot_uid, joints, conf)
+            for link1 in links1:
+                for body2, link2 in others:
+                    if (body2, link2) == (robot_uid, link1):
+                        continue
+                    if pp.pairwise_link_collision(robot_uid, link1, body2, link2) and \
+                            not pp.pairwise_collision(proxies._synced_proxy(robot_uid, link1), proxies._synced_proxy(body2, link2)):
+                        missed.append((tuple(conf), robot_uid, link1, body2, link2))
+    LOGGER.info('Collision proxies: {} configurations checked, {} exact collisions missed by the proxies.'.format(num_samples, len(missed)))
+    return missed
+
+##########################################
+
+def build_collision_proxies(client, robot, process, options=None):
+    """Computes or loads the proxies of the beams, clamps, grippers, screwdrivers and robot gantry arm links.
+    Returns None unless enabled with `options['collision_proxies']`: pybullet already collides the meshes as
+    convex hulls, so the proxies only pay off for meshes with many hull vertices, measure before enabling them.
+    The proxies are bodies of the world, so this is called when the world is loaded, before its state is saved.
+    """
+    options = options or {}
+    if not options.get('collision_proxies', False):
+        return None
+    proxies = CollisionProxies(conservative=options.get('collision_proxies_conservative', True),
+        tolerance=options.get('collision_proxies_tolerance', 0.01))
+
+    robot_uid = client.get_robot_pybullet_uid(robot)
+    gantry_arm_joints = pp.joints_from_names(robot_uid, robot.get_configurable_joint_names(group=GANTRY_ARM_GROUP))
+    for link in pp.get_moving_links(robot_uid, gantry_arm_joints):
+        proxies.get_proxy(robot_uid, link)
+    names = list(process.assembly.sequence) + [tool.name for tool in list(process.clamps) + list(process.grippers) + list(process.screwdrivers)]
+    for name in names:
+        for body in client._get_bodies('^{}$'.format(name)):
+            proxies.add_body(body)
+
+    num_proxies = sum(proxy is not None for proxy in proxies.proxies.values())
+    LOGGER.info('Collision proxies: {} of {} links simplified.'.format(num_proxies, len(proxies.proxies)))
+    _COLLISION_PROXIES[client.client_id] = proxies
+    return proxies
+
+
+def clear_collision_proxies(client):
+    """Forgets the proxies of the client's world, called when it is disconnected (client ids are reused).
+    """
+    _COLLISION_PROXIES.pop(client.client_id, None)
+
+
+def get_collision_proxies(client):
+    """Proxies built for the world of the client by `build_collision_proxies`, None if there are none.
+    """
+    return _COLLISION_PROXIES.get(client.client_id)
+
+
+def get_link_pair_collision_fns(client):
+    """Returns (any_link_pair_collision, pairwise_collision), checked on the proxies of the client's world
+    if it has some, the `pybullet_planning` functions otherwise.
+    """
+    proxies = get_collision_proxies(client)
+    if proxies is None:
+        return pp.any_link_pair_collision, pp.pairwise_collision
+    return proxies.any_link_pair_collision, proxies.pairwise_collision
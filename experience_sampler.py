@@ -0,0 +1,211 @@
+import os
+import json
+import atexit
+import random
+
+import numpy as np
+import pybullet_planning as pp
+from compas_fab.robots import Configuration
+
+from integral_timber_joints.planning.robot_setup import BARE_ARM_GROUP, GANTRY_ARM_GROUP
+
+from load_pddlstream import HERE
+from stream_cache import hash_from_data
+from batch_ik import get_gantry_arm_kinematics
+from reachability_map import _canonical_quat
+from utils import LOGGER
+
+EXPERIENCE_DIR = os.path.join(HERE, 'experience')
+
+# Loaded experience stores, keyed by file path, shared by all samplers of this process
+_GANTRY_EXPERIENCES = {}
+
+##########################################
+
+class GantryExperience(object):
+    """Gantry base configurations of successful samples, recorded with the target tool pose they reached.
+
+    Target poses are indexed in a KD-tree over (position, `orientation_weight` * quaternion), so that
+    the successful configurations of the nearest targets can be proposed for a new target.
+    The proposed configuration is shifted by the translation between the two targets when the gantry kinematics
+    is known (see `batch_ik.get_gantry_arm_kinematics`), and used as is otherwise.
+    Records are persisted as json under `experience_dir`, keyed by the robot model and joint limits,
+    so that later runs start from the experience of previous ones. They are written in batches of
+    `options['experience_save_interval']` new records, at the end of each planning case and at exit
+    (see `save_gantry_experiences`). At most `options['experience_max_records']` records are kept, the oldest are dropped.
+    """
+
+    def __init__(self, client, robot, options=None, experience_dir=EXPERIENCE_DIR):
+        options = options or {}
+        self.orientation_weight = options.get('experience_orientation_weight', 1.0)
+        self.max_distance = options.get('experience_max_distance', 1.0)
+        self.num_neighbors = options.get('experience_neighbors', 5)
+        self.jitter = options.get('experience_jitter', 0.05)
+        self.max_records = options.get('experience_max_records', 10000)
+        self.save_interval = options.get('experience_save_interval', 100)
+
+        self.path = get_gantry_experience_path(robot, options, experience_dir)
+        self.experience_dir = experience_dir
+        # records: list of (target point, target quat, gantry values)
+        self.records = []
+        # number of records added since the last save
+        self.unsaved_count = 0
+        self.tree = None
+        self.proposed_count = 0
+        self.explored_count = 0
+        self.bind(client, robot, options)
+
+    def bind(self, client, robot, options=None):
+        """Sets the body and joint ids and the kinematics of the robot's world, called again when the world is reloaded.
+        """
+        options = options or {}
+        self.robot_uid = client.get_robot_pybullet_uid(robot)
+        arm_joint_names = robot.get_configurable_joint_names(group=BARE_ARM_GROUP)
+        self.joint_names = [name for name in robot.get_configurable_joint_names(group=GANTRY_ARM_GROUP) if name not in arm_joint_names]
+        self.joint_types = robot.get_joint_types_by_names(self.joint_names)
+        self.joints = pp.joints_from_names(self.robot_uid, self.joint_names)
+        joint_custom_limits = options.get('joint_custom_limits', {})
+        pb_custom_limits = {pp.joint_from_name(self.robot_uid, jn) : lims for jn, lims in joint_custom_limits.items()}
+        lower_limits, upper_limits = pp.get_custom_limits(self.robot_uid, self.joints, pb_custom_limits)
+        self.lower_limits, self.upper_limits = np.array(lower_limits), np.array(upper_limits)
+
+        kinematics = get_gantry_arm_kinematics(client, robot, options)
+        # gantry values from an arm base translation
+        self.gantry_from_translation = None if kinematics is None else np.linalg.pinv(kinematics['gantry_directions'])
+
+    def _feature(self, world_from_tool):
+        point, quat = world_from_tool
+        return np.concatenate([point, self.orientation_weight * _canonical_quat(quat)])
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, 'r') as f:
+                records = json.load(f)
+        except (ValueError, OSError) as e:
+            LOGGER.warning('Gantry experience {} is unreadable and will be ignored: {}'.format(self.path, e))
+            return
+        self.records = [tuple(map(tuple, record)) for record in records]
+        LOGGER.debug('Gantry experience loaded from {} with {} records.'.format(self.path, len(self.records)))
+
+    def save(self):
+        """Writes the records if some were added since the last save.
+        """
+        if self.unsaved_count == 0:
+            return
+        if not os.path.exists(self.experience_dir):
+            os.makedirs(self.experience_dir)
+        # merge with the records saved by other processes since this one was loaded
+        records = list(self.records)
+        if os.path.exists(self.path):
+            try:
+                with open(self.path, 'r') as f:
+                    saved_records = [tuple(map(tuple, record)) for record in json.load(f)]
+                known_records = set(records)
+                records.extend(record for record in saved_records if record not in known_records)
+            except (ValueError, OSError):
+                pass
+        tmp_path = '{}.{}.tmp'.format(self.path, os.getpid())
+        with open(tmp_path, 'w') as f:
+            # keep the most recent records
+            json.dump(records[-self.max_records:], f)
+        os.replace(tmp_path, self.path)
+        LOGGER.debug('Gantry experience saved to {} with {} new records.'.format(self.path, self.unsaved_count))
+        self.unsaved_count = 0
+
+    def record(self, world_from_tool, base_conf):
+        """Stores the gantry configuration `base_conf` of a successful sample for the target pose `world_from_tool`.
+        """
+        point, quat = world_from_tool
+        self.records.append((tuple(float(v) for v in point), tuple(float(v) for v in quat),
+            tuple(float(v) for v in base_conf.joint_values)))
+        del self.records[:-self.max_records]
+        self.tree = None
+        self.unsaved_count += 1
+        if self.unsaved_count >= self.save_interval:
+            self.save()
+
+    def propose(self, world_from_tool):
+        """Returns gantry values adapted from the experience of a nearby target, None if there is none.
+        Nearer targets are picked with a higher probability.
+        """
+        if not self.records:
+            return None
+        # rebuilt when records were added since the last query
+        if self.tree is None:
+            # only needed when the experience sampler is enabled
+            from scipy.spatial import cKDTree
+            self.tree = cKDTree([self._feature(record[:2]) for record in self.records])
+        num_neighbors = min(self.num_neighbors, len(self.records))
+        distances, indices = self.tree.query(self._feature(world_from_tool), k=num_neighbors, distance_upper_bound=self.max_distance)
+        distances, indices = np.atleast_1d(distances), np.atleast_1d(indices)
+        found = np.isfinite(distances)
+        if not found.any():
+            return None
+        distances, indices = distances[found], indices[found]
+        weights = 1.0 / (1.0 + distances / self.max_distance)
+        target_point, _, gantry_values = self.records[np.random.choice(indices, p=weights / weights.sum())]
+
+        gantry_values = np.array(gantry_values)
+        if self.gantry_from_translation is not None:
+            gantry_values += (np.array(world_from_tool[0]) - np.array(target_point)).dot(self.gantry_from_translation)
+        gantry_values += np.random.normal(0, self.jitter, len(gantry_values))
+        return np.clip(gantry_values, self.lower_limits, self.upper_limits)
+
+    def gantry_sampler(self, world_from_tool, base_sampler, exploration=0.3):
+        """Yields gantry base configurations for the tool pose, proposed from the experience of nearby targets,
+        or drawn from `base_sampler` with probability `exploration` (or when there is no nearby experience).
+        The gantry joints are set in the world before each yield, as for `gantry_base_generator`.
+        Stops when `base_sampler` is exhausted.
+        """
+        while True:
+            gantry_values = None if random.random() < exploration else self.propose(world_from_tool)
+            if gantry_values is None:
+                self.explored_count += 1
+                base_conf = next(base_sampler, None)
+                if base_conf is None:
+                    return
+                yield base_conf
+                continue
+            self.proposed_count += 1
+            pp.set_joint_positions(self.robot_uid, self.joints, gantry_values)
+            yield Configuration(gantry_values.tolist(), self.joint_types, self.joint_names)
+
+##########################################
+
+def get_gantry_experience_path(robot, options=None, experience_dir=EXPERIENCE_DIR):
+    """Experience file of the robot model and joint limits.
+    """
+    options = options or {}
+    return os.path.join(experience_dir, hash_from_data([robot.model, options.get('joint_custom_limits', {})]) + '.json')
+
+
+def get_gantry_experience(client, robot, options=None):
+    """Returns the gantry experience of the robot, loaded from disk on first use in this process and shared by all
+    the samplers of the process. Returns None unless enabled with `options['experience_sampler']`,
+    the experience is then neither read nor written.
+    """
+    options = options or {}
+    if not options.get('experience_sampler', False):
+        return None
+    path = get_gantry_experience_path(robot, options)
+    if path not in _GANTRY_EXPERIENCES:
+        experience = GantryExperience(client, robot, options)
+        experience.load()
+        if not _GANTRY_EXPERIENCES:
+            atexit.register(save_gantry_experiences)
+        _GANTRY_EXPERIENCES[path] = experience
+    else:
+        # the world may have been reloaded, the body and joint ids are updated in the shared experience
+        experience = _GANTRY_EXPERIENCES[path]
+        experience.bind(client, robot, options)
+    return experience
+
+
+def save_gantry_experiences():
+    """Writes the new records of all the gantry experiences of this process,
+    called at the end of each planning case and at exit.
+    """
+    for experience in _GANTRY_EXPERIENCES.values():
+        experience.save()
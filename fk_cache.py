@@ -0,0 +1,142 @@
+from collections import OrderedDict
+
+import numpy as np
+import pybullet_planning as pp
+
+from trajectory import replay_trajectory
+from utils import LOGGER
+
+# Link pose caches, keyed by (client id, robot uid, links), shared by the samplers and tests of this process
+_FK_CACHES = {}
+
+##########################################
+
+def matrices_from_quats(quats):
+    """Rotation matrices (..., 3, 3) of pybullet [x, y, z, w] quaternions (..., 4).
+    """
+    x, y, z, w = np.moveaxis(np.asarray(quats, dtype=float), -1, 0)
+    return np.stack([
+        np.stack([1 - 2*(y*y + z*z), 2*(x*y - z*w), 2*(x*z + y*w)], axis=-1),
+        np.stack([2*(x*y + z*w), 1 - 2*(x*x + z*z), 2*(y*z - x*w)], axis=-1),
+        np.stack([2*(x*z - y*w), 2*(y*z + x*w), 1 - 2*(x*x + y*y)], axis=-1),
+    ], axis=-2)
+
+
+def get_com_pose(body, link=pp.BASE_LINK):
+    """World pose of the link's inertial (center of mass) frame, the frame of its collision geometry in pybullet
+    (`pp.vertices_from_rigid`). The pose of a body's base is already its inertial frame.
+    """
+    if link == pp.BASE_LINK:
+        return pp.get_pose(body)
+    return pp.get_com_pose(body, link)
+
+
+class TrajectoryFKCache(object):
+    """World poses of the robot links' inertial frames (see `get_com_pose`) at each point of the trajectories,
+    computed with one replay per trajectory.
+
+    Entries are keyed by id(traj) and keep the trajectory so that its id cannot be recycled.
+    The samplers add the trajectories they certify, the tests read the link poses instead of replaying
+    the trajectory (the pybullet narrow phase still sets the robot configurations it checks).
+    The search does not report the trajectories it drops, they are no longer queried and the least recently
+    used entries are evicted once the arrays exceed `max_bytes`.
+    """
+
+    def __init__(self, client, robot_uid, links, max_bytes=256 * 2**20):
+        self.client = client
+        self.robot_uid = robot_uid
+        self.links = list(links)
+        self.link_index = {link : k for k, link in enumerate(self.links)}
+        # inertial frame of each link in its link frame, the attachments are relative to the link frame
+        self.link_from_com = {link : pp.get_link_inertial_pose(robot_uid, link) for link in self.links}
+        self.max_bytes = max_bytes
+        # entries[id(traj)] = (traj, positions (T, L, 3), quats (T, L, 4))
+        self.entries = OrderedDict()
+        self.num_bytes = 0
+        self.hit_count = 0
+        self.miss_count = 0
+        self.evicted_count = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def _insert(self, traj, positions, quats):
+        self.entries[id(traj)] = (traj, positions, quats)
+        self.num_bytes += positions.nbytes + quats.nbytes
+        while self.num_bytes > self.max_bytes and len(self.entries) > 1:
+            _, (_, old_positions, old_quats) = self.entries.popitem(last=False)
+            self.num_bytes -= old_positions.nbytes + old_quats.nbytes
+            self.evicted_count += 1
+
+    def _compute(self, traj):
+        positions, quats = [], []
+        for _ in replay_trajectory(self.client, self.robot_uid, traj):
+            poses = [get_com_pose(self.robot_uid, link) for link in self.links]
+            positions.append([pose[0] for pose in poses])
+            quats.append([pose[1] for pose in poses])
+        num_links = len(self.links)
+        return np.array(positions, dtype=float).reshape(-1, num_links, 3), np.array(quats, dtype=float).reshape(-1, num_links, 4)
+
+    def add(self, traj, reversed_from=None):
+        """Computes the link poses of a trajectory. If `reversed_from` is given and cached, `traj` is its
+        reversed trajectory and the poses are the cached ones in reverse order.
+        This changes the robot configuration in the world.
+        """
+        if id(traj) in self.entries:
+            return
+        if reversed_from is not None and id(reversed_from) in self.entries:
+            _, positions, quats = self.entries[id(reversed_from)]
+            self._insert(traj, positions[::-1].copy(), quats[::-1].copy())
+            return
+        self._insert(traj, *self._compute(traj))
+
+    def get_link_poses(self, traj, links=None):
+        """(positions (T, L, 3), quats (T, L, 4)) of the inertial frames of the `links` (all cached links by default)
+        at each trajectory point.
+        This changes the robot configuration in the world if the trajectory is not cached.
+        """
+        if id(traj) in self.entries:
+            self.hit_count += 1
+            self.entries.move_to_end(id(traj))
+        else:
+            self.miss_count += 1
+            self.add(traj)
+        _, positions, quats = self.entries[id(traj)]
+        if links is None:
+            return positions, quats
+        indices = [self.link_index[link] for link in links]
+        return positions[:, indices], quats[:, indices]
+
+    def get_attachment_poses(self, traj, attachment):
+        """World pose of the attached object at each trajectory point, its parent link must be cached.
+        """
+        positions, quats = self.get_link_poses(traj, [attachment.parent_link])
+        com_from_link = pp.invert(self.link_from_com[attachment.parent_link])
+        return [pp.multiply((position, quat), com_from_link, attachment.grasp_pose) \
+            for position, quat in zip(positions[:, 0].tolist(), quats[:, 0].tolist())]
+
+    def stats_str(self):
+        return 'FK cache: {} trajectories, {:.1f} MB, {} hits, {} misses, {} evicted.'.format(
+            len(self.entries), self.num_bytes / 2**20, self.hit_count, self.miss_count, self.evicted_count)
+
+##########################################
+
+def get_fk_cache(client, robot_uid, links, options=None):
+    """Link pose cache of the robot links, shared by all the callers with the same links.
+    Returns None if disabled by `options['fk_cache']`, the budget is `options['fk_cache_memory']` in MB.
+    """
+    options = options or {}
+    if not options.get('fk_cache', True):
+        return None
+    key = (client.client_id, robot_uid, tuple(links))
+    if key not in _FK_CACHES:
+        _FK_CACHES[key] = TrajectoryFKCache(client, robot_uid, links, max_bytes=options.get('fk_cache_memory', 256) * 2**20)
+        LOGGER.debug('FK cache created for {} links.'.format(len(links)))
+    return _FK_CACHES[key]
+
+
+def clear_fk_caches(client):
+    """Drops the caches of the client's world, called when it is disconnected (client ids are reused).
+    """
+    for key in [key for key in _FK_CACHES if key[0] == client.client_id]:
+        del _FK_CACHES[key]
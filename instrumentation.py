@@ -0,0 +1,153 @@
+import os
+import json
+import time
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+
+from load_pddlstream import HERE
+from utils import LOGGER
+
+##########################################
+
+class StreamProfiler(object):
+    """Per-stream counters and timers of the sampler and test functions.
+
+    For each stream: number of calls and successes, rejections by reason, wall time and count per sub-stage
+    (e.g. gantry_ik, env_collision, cartesian_plan) and the gantry iterations needed for each success.
+    Recording only adds a few dict updates and `time.perf_counter` calls to the hot path.
+    With `num_workers > 1`, the sub-stages run in the worker processes and only the stream-level calls
+    and times of the parent process are recorded.
+    """
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.calls = Counter()
+        self.successes = Counter()
+        self.total_times = defaultdict(float)
+        self.rejections = defaultdict(Counter)
+        self.stage_times = defaultdict(lambda: defaultdict(float))
+        self.stage_counts = defaultdict(Counter)
+        self.gantry_iters = defaultdict(list)
+        self.start_time = time.perf_counter()
+
+    def count_call(self, stream_name, elapsed=0.0):
+        self.calls[stream_name] += 1
+        self.total_times[stream_name] += elapsed
+
+    def count_success(self, stream_name):
+        self.successes[stream_name] += 1
+
+    def record_gantry_iters(self, stream_name, gantry_iters):
+        self.gantry_iters[stream_name].append(gantry_iters)
+
+    def count_rejection(self, stream_name, reason):
+        self.rejections[stream_name][reason] += 1
+
+    def add_stage_time(self, stream_name, stage, elapsed):
+        self.stage_times[stream_name][stage] += elapsed
+        self.stage_counts[stream_name][stage] += 1
+
+    @contextmanager
+    def stage(self, stream_name, stage):
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_stage_time(stream_name, stage, time.perf_counter() - start_time)
+
+    def timed_iter(self, stream_name, stage, iterable):
+        """Iterates over `iterable`, the time spent producing each item is added to `stage`.
+        """
+        iterator = iter(iterable)
+        while True:
+            start_time = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                self.add_stage_time(stream_name, stage, time.perf_counter() - start_time)
+                return
+            self.add_stage_time(stream_name, stage, time.perf_counter() - start_time)
+            yield item
+
+    def report(self):
+        stream_names = sorted(set(self.calls) | set(self.rejections) | set(self.stage_times))
+        streams = {}
+        for stream_name in stream_names:
+            gantry_iters = self.gantry_iters[stream_name]
+            streams[stream_name] = {
+                'calls' : self.calls[stream_name],
+                'successes' : self.successes[stream_name],
+                'total_time' : self.total_times[stream_name],
+                'rejections' : dict(self.rejections[stream_name]),
+                'stages' : {stage : {'time' : elapsed, 'count' : self.stage_counts[stream_name][stage]} \
+                    for stage, elapsed in self.stage_times[stream_name].items()},
+                'gantry_iters_per_success' : {
+                    'mean' : sum(gantry_iters) / float(len(gantry_iters)) if gantry_iters else None,
+                    'max' : max(gantry_iters) if gantry_iters else None,
+                    'values' : gantry_iters,
+                },
+            }
+        return {'wall_time' : time.perf_counter() - self.start_time, 'streams' : streams}
+
+    def save_report(self, pddl_folder, file_name, extra=None):
+        if not os.path.exists(pddl_folder):
+            os.makedirs(pddl_folder)
+        report = self.report()
+        report.update(extra or {})
+        file_output_path = os.path.join(HERE, pddl_folder, file_name)
+        with open(file_output_path, 'w') as f:
+            json.dump(report, f, indent=4)
+        return file_output_path
+
+    def log_summary(self):
+        report = self.report()
+        lines = ['{:<36} {:>7} {:>7} {:>9} {:>9}  {}'.format('stream / stage', 'calls', 'success', 'time (s)', 'gantry/ok', 'rejections')]
+        for stream_name, stats in report['streams'].items():
+            mean_iters = stats['gantry_iters_per_success']['mean']
+            rejections = ', '.join('{}={}'.format(reason, n) for reason, n in sorted(stats['rejections'].items()))
+            lines.append('{:<36} {:>7} {:>7} {:>9.2f} {:>9}  {}'.format(stream_name, stats['calls'], stats['successes'],
+                stats['total_time'], '-' if mean_iters is None else '{:.1f}'.format(mean_iters), rejections))
+            for stage, stage_stats in sorted(stats['stages'].items(), key=lambda item: -item[1]['time']):
+                lines.append('  {:<34} {:>7} {:>7} {:>9.2f}'.format(stage, stage_stats['count'], '', stage_stats['time']))
+        LOGGER.info('Stream profile ({:.2f} s wall time):\n{}'.format(report['wall_time'], '\n'.join(lines)))
+
+# Profiler shared by all streams of this process
+PROFILER = StreamProfiler()
+
+##########################################
+
+def get_profiled_gen_fn(stream_name, gen_fn, profiler=PROFILER):
+    """Wraps a stream generator function, each output request counts as one call.
+    """
+    def profiled_gen_fn(*inputs):
+        generator = gen_fn(*inputs)
+        while True:
+            start_time = time.perf_counter()
+            output = next(generator, StopIteration)
+            profiler.count_call(stream_name, time.perf_counter() - start_time)
+            if output is StopIteration:
+                profiler.count_rejection(stream_name, 'out_of_samples')
+                return
+            if output is None:
+                profiler.count_rejection(stream_name, 'cancelled')
+            else:
+                profiler.count_success(stream_name)
+            yield output
+    return profiled_gen_fn
+
+
+def get_profiled_test_fn(stream_name, test_fn, profiler=PROFILER):
+    """Wraps a stream test function, a failed test counts as a 'collision' rejection.
+    """
+    def profiled_test_fn(*inputs):
+        start_time = time.perf_counter()
+        result = test_fn(*inputs)
+        profiler.count_call(stream_name, time.perf_counter() - start_time)
+        if result:
+            profiler.count_success(stream_name)
+        else:
+            profiler.count_rejection(stream_name, 'collision')
+        return result
+    return profiled_test_fn
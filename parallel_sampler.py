@@ -0,0 +1,256 @@
+import json
+import math
+import queue
+import atexit
+import random
+import threading
+import multiprocessing
+from collections import defaultdict, deque
+
+import numpy as np
+from compas.data import DataEncoder, DataDecoder
+
+from utils import LOGGER
+
+# Per-process state of a sampling worker, filled by `_init_worker`
+_WORKER = {}
+
+# Pools kept alive across the planning cases, keyed by id(process) and number of workers: (process, pool)
+_SAMPLER_POOLS = {}
+
+##########################################
+
+def _init_worker(process_json, options, stop_event, worker_index, num_workers, seed):
+    # imported here so that the parent process does not need a pybullet world to create the pool
+    from world_pool import get_robot_world
+
+    # each worker explores a different part of the gantry / IK sample space
+    random.seed(seed + worker_index)
+    np.random.seed(seed + worker_index)
+
+    process = json.loads(process_json, cls=DataDecoder)
+    client, robot = get_robot_world(process, options, viewer=False, verbose=False)
+    options['cancel_fn'] = stop_event.is_set
+
+    _WORKER.update({
+        'index' : worker_index,
+        'client' : client,
+        'robot' : robot,
+        'process' : process,
+        'options' : options,
+        'num_workers' : num_workers,
+        'generation' : 0,
+        'gen_fns' : {},
+        'generators' : {},
+    })
+
+
+def _reset_worker(generation):
+    # a new planning case started, the world is restored to its initial state and the samplers are recreated
+    from world_pool import get_robot_world
+    from experience_sampler import save_gantry_experiences
+
+    save_gantry_experiences()
+    get_robot_world(_WORKER['process'], _WORKER['options'], viewer=False, verbose=False)
+    _WORKER['generation'] = generation
+    _WORKER['gen_fns'] = {}
+    _WORKER['generators'] = {}
+
+
+def _get_worker_gen_fn(stream_name, split_gantry_attempts):
+    from stream_samplers_stateless import get_gen_fn_plan_motion_for_beam_assembly_stateless, get_gen_fn_plan_motion_for_clamp_stateless
+
+    key = (stream_name, split_gantry_attempts)
+    if key not in _WORKER['gen_fns']:
+        client, robot, process, options = _WORKER['client'], _WORKER['robot'], _WORKER['process'], _WORKER['options']
+        if split_gantry_attempts:
+            # each worker draws its own slice of the ranked gantry candidates (see `reachability_map`)
+            options = dict(options, sample_slice=(_WORKER['index'], _WORKER['num_workers']))
+            if 'gantry_attempts' in options:
+                options['gantry_attempts'] = int(math.ceil(options['gantry_attempts'] / float(_WORKER['num_workers'])))
+        if stream_name == 'plan_motion_for_beam_assembly':
+            gen_fn = get_gen_fn_plan_motion_for_beam_assembly_stateless(client, robot, process, options=options)
+        elif stream_name == 'plan_motion_for_attach_clamp':
+            gen_fn = get_gen_fn_plan_motion_for_clamp_stateless(client, robot, process, operation='attach', options=options)
+        elif stream_name == 'plan_motion_for_detach_clamp':
+            gen_fn = get_gen_fn_plan_motion_for_clamp_stateless(client, robot, process, operation='detach', options=options)
+        else:
+            raise ValueError('Unknown stream {} for parallel sampling.'.format(stream_name))
+        _WORKER['gen_fns'][key] = gen_fn
+    return _WORKER['gen_fns'][key]
+
+
+def _sample_worker(request):
+    # one generator is kept per stream instance, so that each task continues where the previous one stopped
+    generation, task, split_gantry_attempts = request
+    if generation != _WORKER['generation']:
+        _reset_worker(generation)
+    stream_name, inputs = task
+    key = (task, split_gantry_attempts)
+    if key not in _WORKER['generators']:
+        _WORKER['generators'][key] = _get_worker_gen_fn(stream_name, split_gantry_attempts)(*inputs)
+    # None if cancelled or if this worker's generator is exhausted
+    output = next(_WORKER['generators'][key], None)
+    if output is None:
+        return task, None, _WORKER['index']
+    return task, json.dumps(list(output), cls=DataEncoder), _WORKER['index']
+
+##########################################
+
+class ParallelSamplerPool(object):
+    """Worker processes, each holding its own headless pybullet world. Each worker is a pool of one process,
+    so that a request can be sent to a given worker.
+
+    With `sample`, one request is sent to each worker, each one draws its own gantry / IK samples
+    (`gantry_attempts` is split among the workers and each worker takes its own slice of the ranked gantry candidates).
+    The first valid trajectory is returned and the other workers are cancelled, the trajectories that other workers
+    found before the cancellation are buffered and returned by the next calls for the same stream instance.
+    With `map_samples`, independent requests are distributed over the workers, a worker gets the next request
+    when it returns the previous one, and all outputs are returned
+    (each worker uses all the `gantry_attempts` unless `split_gantry_attempts`).
+    With `submit`, a single request is sent to the least busy worker and its output is passed to a callback (see `speculative_sampler`).
+    The workers keep one sampler per stream instance and split mode, so the same pool serves all of these requests.
+    The pool can be reused by the next planning case after `reset`, see `get_parallel_sampler_pool`.
+    """
+
+    def __init__(self, process, options=None, num_workers=None, seed=0):
+        options = options or {}
+        self.num_workers = num_workers or multiprocessing.cpu_count()
+        worker_options = {key : value for key, value in options.items() if key not in ['viewer', 'diagnosis', 'cancel_fn']}
+
+        # spawn instead of fork, the pybullet connection of the parent process must not be shared
+        context = multiprocessing.get_context('spawn')
+        self.stop_event = context.Event()
+        # incremented by `reset`, the workers reset their world when they receive a request of a new generation
+        self.generation = 0
+        process_json = json.dumps(process, cls=DataEncoder)
+        self.pools = [context.Pool(1, initializer=_init_worker,
+            initargs=(process_json, worker_options, self.stop_event, worker_index, self.num_workers, seed)) \
+            for worker_index in range(self.num_workers)]
+        # pending_counts[worker_index] = number of requests sent to the worker and not returned yet
+        self.pending_counts = [0] * self.num_workers
+        self.lock = threading.Lock()
+        # buffers[(stream_name, inputs)] = outputs found by `sample` after the first one of a request
+        self.buffers = defaultdict(deque)
+        atexit.register(self.close)
+        LOGGER.info('Parallel sampler started with {} workers.'.format(self.num_workers))
+
+    def _send(self, worker_index, request, callback):
+        # `callback(task, output_json, worker_index)` is called from the worker pool's result thread
+        stream_name, inputs = request[1]
+        with self.lock:
+            self.pending_counts[worker_index] += 1
+
+        def on_result(result):
+            with self.lock:
+                self.pending_counts[worker_index] -= 1
+            callback(*result)
+
+        def on_error(error):
+            LOGGER.warning('{}{} failed in worker {}: {}'.format(stream_name, inputs, worker_index, error))
+            with self.lock:
+                self.pending_counts[worker_index] -= 1
+            callback(request[1], None, None)
+
+        self.pools[worker_index].apply_async(_sample_worker, (request,), callback=on_result, error_callback=on_error)
+
+    def sample(self, stream_name, inputs):
+        """Returns the next output found by any worker, None if all workers ran out of samples.
+        """
+        task = (stream_name, tuple(inputs))
+        if self.buffers[task]:
+            return self.buffers[task].popleft()
+        self.stop_event.clear()
+        results = queue.Queue()
+        for worker_index in range(self.num_workers):
+            self._send(worker_index, (self.generation, task, True), lambda *result: results.put(result))
+        output = None
+        # wait for every worker so that no cancelled request is left running for the next call
+        for _ in range(self.num_workers):
+            _, output_json, _ = results.get()
+            if output_json is None:
+                continue
+            if output is None:
+                output = tuple(json.loads(output_json, cls=DataDecoder))
+                self.stop_event.set()
+            else:
+                self.buffers[task].append(tuple(json.loads(output_json, cls=DataDecoder)))
+        self.stop_event.clear()
+        return output
+
+    def map_samples(self, tasks, split_gantry_attempts=False):
+        """Yields (stream_name, inputs, output) for each (stream_name, inputs) task, in completion order.
+        The output is None if the worker ran out of samples.
+        """
+        self.stop_event.clear()
+        tasks = deque((stream_name, tuple(inputs)) for stream_name, inputs in tasks)
+        results = queue.Queue()
+
+        def send(worker_index):
+            self._send(worker_index, (self.generation, tasks.popleft(), split_gantry_attempts), lambda *result: results.put((worker_index,) + result))
+
+        num_running = 0
+        for worker_index in range(min(self.num_workers, len(tasks))):
+            send(worker_index)
+            num_running += 1
+        while num_running:
+            worker_index, (stream_name, inputs), output_json, _ = results.get()
+            num_running -= 1
+            if tasks:
+                send(worker_index)
+                num_running += 1
+            output = None if output_json is None else tuple(json.loads(output_json, cls=DataDecoder))
+            yield stream_name, inputs, output
+
+    def submit(self, stream_name, inputs, callback, split_gantry_attempts=True):
+        """Sends a single request to the least busy worker without waiting for it. `callback(stream_name, inputs, output, worker_index)`
+        is called from the pool's result thread, the output is None if the worker ran out of samples or failed
+        (the worker index is then None).
+        """
+        def on_result(task, output_json, worker_index):
+            callback(stream_name, inputs, None if output_json is None else tuple(json.loads(output_json, cls=DataDecoder)), worker_index)
+
+        with self.lock:
+            worker_index = min(range(self.num_workers), key=self.pending_counts.__getitem__)
+        self._send(worker_index, (self.generation, (stream_name, tuple(inputs)), split_gantry_attempts), on_result)
+
+    def is_running(self):
+        return self.pools is not None
+
+    def reset(self):
+        """Starts a new generation, the samplers and the buffered outputs of the previous planning case are dropped.
+        """
+        self.generation += 1
+        self.buffers.clear()
+
+    def close(self):
+        if self.pools is not None:
+            for pool in self.pools:
+                pool.terminate()
+            self.pools = None
+
+
+def get_parallel_sampler_pool(process, options=None, num_workers=None):
+    """Returns a sampler pool for the process, the pool created by a previous planning case (or by the precompute stage)
+    is reset and reused so that the workers load their pybullet world only once.
+    """
+    num_workers = num_workers or multiprocessing.cpu_count()
+    key = (id(process), num_workers)
+    if key in _SAMPLER_POOLS and _SAMPLER_POOLS[key][1].is_running():
+        sampler_pool = _SAMPLER_POOLS[key][1]
+        sampler_pool.reset()
+    else:
+        sampler_pool = ParallelSamplerPool(process, options, num_workers=num_workers)
+        _SAMPLER_POOLS[key] = (process, sampler_pool)
+    return sampler_pool
+
+
+def get_parallel_gen_fn(sampler_pool, stream_name):
+    def gen_fn(*inputs):
+        while True:
+            output = sampler_pool.sample(stream_name, inputs)
+            if output is None:
+                LOGGER.debug('{}{} running out of samples in all {} workers'.format(stream_name, inputs, sampler_pool.num_workers))
+                return
+            yield output
+    return gen_fn
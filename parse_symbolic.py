@@ -226,6 +226,59 @@ def process_to_init_goal_clamps(
     return init, goal
 
 
+def process_to_init_goal_collision_pairs(
+        process: RobotClampAssemblyProcess,
+        init=[], goal=[],
+        num_elements_to_export=-1,
+        include_clamps=False,
+):
+    """Declare the (held, other) pairs whose collision checks are needed.
+    All pairs are declared here, the ones that can never collide are removed by `static_pruning`.
+    """
+    beam_ids = []
+    for i, beam_id in enumerate(process.assembly.sequence):
+        if (num_elements_to_export > -1) & (i >= num_elements_to_export):
+            break
+        # Skip scaffolding elements
+        if process.assembly.get_assembly_method(beam_id) == BeamAssemblyMethod.MANUAL_ASSEMBLY:
+            continue
+        beam_ids.append(beam_id)
+
+    # * Robot holding a beam and an assembled beam
+    for heldbeam in beam_ids:
+        for otherbeam in beam_ids:
+            if otherbeam != heldbeam:
+                init.extend([
+                    ('BeamMayCollide', heldbeam, otherbeam),
+                ])
+
+    # * Robot moving a clamp at a joint and an assembled beam
+    if include_clamps:
+        for beam_id in beam_ids:
+            #  Skip non clamped elements
+            if process.assembly.get_assembly_method(beam_id) != BeamAssemblyMethod.CLAMPED:
+                continue
+            for neighbor_id in process.assembly.get_already_built_neighbors(beam_id):
+                for otherbeam in beam_ids:
+                    init.extend([
+                        ('ClampTrajMayCollideWithBeam', neighbor_id, beam_id, otherbeam),
+                    ])
+
+    # * Robot moving a clamp at a joint and a clamp at another joint
+    if include_clamps:
+        joint_ids = [(neighbor_id, beam_id) for beam_id in beam_ids \
+            if process.assembly.get_assembly_method(beam_id) == BeamAssemblyMethod.CLAMPED \
+            for neighbor_id in process.assembly.get_already_built_neighbors(beam_id)]
+        for joint_id in joint_ids:
+            for otherjoint_id in joint_ids:
+                if otherjoint_id != joint_id:
+                    init.extend([
+                        ('ClampsMayCollide',) + joint_id + otherjoint_id,
+                    ])
+
+    return init, goal
+
+
 def process_to_init_goal_scaffolding(
         process: RobotClampAssemblyProcess,
         init=[], goal=[],
@@ -338,6 +391,8 @@ def process_to_init_goal_by_case(
             process,  init, goal, num_elements_to_export=num_elements_to_export)
         init, goal = process_to_init_goal_grippers(
             process, init, goal, num_elements_to_export=num_elements_to_export)
+        init, goal = process_to_init_goal_collision_pairs(
+            process, init, goal, num_elements_to_export=num_elements_to_export)
 
     if case_number == 5:
         init, goal = process_to_init_goal_beams(
@@ -364,6 +419,8 @@ def process_to_init_goal_by_case(
             process, init, goal, num_elements_to_export=num_elements_to_export)
         # init, goal = process_to_init_goal_scaffolding(process, init, goal, num_elements_to_export=num_elements_to_export, declare_static=True) # Probably not necessary
         init, goal = process_to_init_goal_fixed_assembly_order(process, init, goal, num_elements_to_export=num_elements_to_export)
+        init, goal = process_to_init_goal_collision_pairs(
+            process, init, goal, num_elements_to_export=num_elements_to_export, include_clamps=True)
 
     unioned_goal = And(*goal)
     return init, unioned_goal
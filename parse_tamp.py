@@ -19,6 +19,14 @@ from parse_symbolic import process_to_init_goal_by_case, export_pddl
 from stream_samplers import get_sample_fn_plan_motion_for_beam_assembly, get_test_fn_beam_assembly_collision_check, \
     get_sample_fn_plan_motion_for_clamp, get_test_fn_clamp_clamp_collision_check, get_test_fn_clamp_beam_collision_check
 from utils import LOGGER, print_pddl_task_object_names
+from stream_cache import StreamCache, get_cached_gen_fn
+from parallel_sampler import get_parallel_sampler_pool, get_parallel_gen_fn
+from precompute_streams import PLAN_MOTION_STREAMS_FROM_CASE, precompute_stream_outputs, get_stream_instances
+from speculative_sampler import get_speculative_sampler, get_speculative_gen_fn
+from instrumentation import get_profiled_gen_fn, get_profiled_test_fn
+from process_index import get_process_geometry_index
+from world_pool import get_robot_world
+from static_pruning import prune_static_collision_facts
 
 def get_pddlstream_problem(
         process: RobotClampAssemblyProcess,
@@ -50,21 +58,46 @@ def get_pddlstream_problem(
         LOGGER.warning('Case {} is a symbolic-only domain, stream is disabled.'.format(case_number))
 
     if enable_stream:
-        # * Connect to path planning backend and initialize robot parameters
-        client, robot, _ = load_RFL_world(viewer=viewer or diagnosis, verbose=True)
-
-        # frame, conf compare, joint flip and allowable collision tolerances are set here
-        options.update(get_tolerances(robot))
-
-        # * initialize collision objects and tools in the scene
-        assert set_initial_state(client, robot, process, initialize=True, options=options), 'Setting initial state failed.'
+        # * Connect to path planning backend, initialize robot parameters and the collision objects and tools in the scene
+        # the world is loaded by the first case and restored from its initial state snapshot by the next ones
+        client, robot = get_robot_world(process, options, viewer=viewer or diagnosis, verbose=True)
+
+        # * poses, grasps and movement targets shared by all streams, saved to disk before the workers load it
+        get_process_geometry_index(client, process, options)
+
+        # * collision pairs that can never collide are left out of the init, so that their tests are never instantiated
+        init = prune_static_collision_facts(client, robot, process, init, options)
+
+        # * on-disk cache of sampled trajectories, reused across runs
+        stream_cache = None
+        precompute_samples = options.get('precompute_samples', 0)
+        if options.get('stream_cache', False) or precompute_samples > 0:
+            stream_cache = StreamCache(process, robot, options, max_size_mb=options.get('stream_cache_max_size_mb', 500.0))
+
+        # * sample trajectories for all stream instances in parallel before the search, served from the stream cache
+        if precompute_samples > 0 and case_number in PLAN_MOTION_STREAMS_FROM_CASE:
+            num_workers = options.get('num_workers', 1)
+            # with a single worker the search samples in this process, the precompute pool is closed when it is done
+            precompute_stream_outputs(process, init, PLAN_MOTION_STREAMS_FROM_CASE[case_number], stream_cache, options,
+                num_samples=precompute_samples, num_workers=num_workers if num_workers > 1 else None, close_pool=num_workers <= 1)
+
+        # * worker processes with their own pybullet world for the motion planning samplers
+        sampler_pool = None
+        if options.get('num_workers', 1) > 1:
+            sampler_pool = get_parallel_sampler_pool(process, options, num_workers=options['num_workers'])
+
+        # * opt-in: the workers sample the stream instances ahead of the search, ranked by past requests and init order
+        speculative_sampler = None
+        if sampler_pool is not None and options.get('speculative_sampling', False) and case_number in PLAN_MOTION_STREAMS_FROM_CASE:
+            speculative_sampler = get_speculative_sampler(sampler_pool,
+                get_stream_instances(init, PLAN_MOTION_STREAMS_FROM_CASE[case_number]), options)
 
         stream_map = {}
         if case_number == 4:
-            stream_map.update(get_beam_assembly_streams(client, robot, process, options))
+            stream_map.update(get_beam_assembly_streams(client, robot, process, options, stream_cache, sampler_pool, speculative_sampler))
         elif case_number == 6:
-            stream_map.update(get_beam_assembly_streams(client, robot, process, options))
-            stream_map.update(get_clamp_transfer_streams(client, robot, process, options))
+            stream_map.update(get_beam_assembly_streams(client, robot, process, options, stream_cache, sampler_pool, speculative_sampler))
+            stream_map.update(get_clamp_transfer_streams(client, robot, process, options, stream_cache, sampler_pool, speculative_sampler))
     else:
         stream_map = DEBUG
 
@@ -76,23 +109,41 @@ def get_pddlstream_problem(
 
     return pddlstream_problem
 
-from stream_samplers_stateless import get_sample_fn_plan_motion_for_beam_assembly_stateless, get_test_fn_beam_assembly_collision_check_stateless, \
-get_sample_fn_plan_motion_for_clamp_stateless, get_test_fn_clamp_beam_collision_check_stateless
-
-def get_beam_assembly_streams(client, robot, process, options):
+from stream_samplers_stateless import get_gen_fn_plan_motion_for_beam_assembly_stateless, get_test_fn_beam_assembly_collision_check_stateless, \
+get_gen_fn_plan_motion_for_clamp_stateless, get_test_fn_clamp_beam_collision_check_stateless, get_test_fn_clamp_clamp_collision_check_stateless
+
+def get_plan_motion_gen_fn(client, robot, process, stream_name, options, stream_cache=None, sampler_pool=None, speculative_sampler=None):
+    if speculative_sampler is not None:
+        gen_fn = get_speculative_gen_fn(speculative_sampler, stream_name)
+    elif sampler_pool is not None:
+        gen_fn = get_parallel_gen_fn(sampler_pool, stream_name)
+    elif stream_name == 'plan_motion_for_beam_assembly':
+        gen_fn = get_gen_fn_plan_motion_for_beam_assembly_stateless(client, robot, process, options=options)
+    elif stream_name == 'plan_motion_for_attach_clamp':
+        gen_fn = get_gen_fn_plan_motion_for_clamp_stateless(client, robot, process, operation='attach', options=options)
+    elif stream_name == 'plan_motion_for_detach_clamp':
+        gen_fn = get_gen_fn_plan_motion_for_clamp_stateless(client, robot, process, operation='detach', options=options)
+    return get_profiled_gen_fn(stream_name, get_cached_gen_fn(stream_cache, stream_name, gen_fn))
+
+def get_beam_assembly_streams(client, robot, process, options, stream_cache=None, sampler_pool=None, speculative_sampler=None):
     return {
-            'plan_motion_for_beam_assembly':  from_sampler(get_sample_fn_plan_motion_for_beam_assembly_stateless(client, robot, process, options=options)),
-            'beam_assembly_collision_check': from_test(get_test_fn_beam_assembly_collision_check_stateless(client, robot, process, options=options)),
+            'plan_motion_for_beam_assembly':  from_gen_fn(get_plan_motion_gen_fn(client, robot, process, 'plan_motion_for_beam_assembly', options, stream_cache, sampler_pool, speculative_sampler)),
+            'beam_assembly_collision_check': from_test(get_profiled_test_fn('beam_assembly_collision_check',
+                get_test_fn_beam_assembly_collision_check_stateless(client, robot, process, options=options))),
         }
 
-def get_clamp_transfer_streams(client, robot, process, options):
+def get_clamp_transfer_streams(client, robot, process, options, stream_cache=None, sampler_pool=None, speculative_sampler=None):
     return {
-            'plan_motion_for_attach_clamp':  from_sampler(get_sample_fn_plan_motion_for_clamp_stateless(client, robot, process, operation='attach', options=options)),
-            'plan_motion_for_detach_clamp':  from_sampler(get_sample_fn_plan_motion_for_clamp_stateless(client, robot, process, operation='detach', options=options)),
-
-            # 'attach_clamp_clamp_collision_check': from_test(get_test_fn_clamp_clamp_collision_check(client, robot, process, options=options)),
-            # 'detach_clamp_clamp_collision_check': from_test(get_test_fn_clamp_clamp_collision_check(client, robot, process, options=options)),
-
-            'attach_clamp_beam_collision_check': from_test(get_test_fn_clamp_beam_collision_check_stateless(client, robot, process, options=options)),
-            'detach_clamp_beam_collision_check': from_test(get_test_fn_clamp_beam_collision_check_stateless(client, robot, process, options=options)),
+            'plan_motion_for_attach_clamp':  from_gen_fn(get_plan_motion_gen_fn(client, robot, process, 'plan_motion_for_attach_clamp', options, stream_cache, sampler_pool, speculative_sampler)),
+            'plan_motion_for_detach_clamp':  from_gen_fn(get_plan_motion_gen_fn(client, robot, process, 'plan_motion_for_detach_clamp', options, stream_cache, sampler_pool, speculative_sampler)),
+
+            'attach_clamp_clamp_collision_check': from_test(get_profiled_test_fn('attach_clamp_clamp_collision_check',
+                get_test_fn_clamp_clamp_collision_check_stateless(client, robot, process, options=options, stream_name='attach_clamp_clamp_collision_check'))),
+            'detach_clamp_clamp_collision_check': from_test(get_profiled_test_fn('detach_clamp_clamp_collision_check',
+                get_test_fn_clamp_clamp_collision_check_stateless(client, robot, process, options=options, stream_name='detach_clamp_clamp_collision_check'))),
+
+            'attach_clamp_beam_collision_check': from_test(get_profiled_test_fn('attach_clamp_beam_collision_check',
+                get_test_fn_clamp_beam_collision_check_stateless(client, robot, process, options=options, stream_name='attach_clamp_beam_collision_check'))),
+            'detach_clamp_beam_collision_check': from_test(get_profiled_test_fn('detach_clamp_beam_collision_check',
+                get_test_fn_clamp_beam_collision_check_stateless(client, robot, process, options=options, stream_name='detach_clamp_beam_collision_check'))),
         }
\ No newline at end of file
@@ -0,0 +1,50 @@
+import numpy as np
+import pybullet
+import pybullet_planning as pp
+
+##########################################
+
+def get_path_sanity_fn(robot_uid, joints, joint_names, custom_limits=None, options=None):
+    """Returns a function that checks a path (sequence of joint values of `joints`) without any pybullet query
+    and returns the rejection reason, or None if the path is plausible:
+    - 'joint_jump': only if `options['path_joint_jump_check']` is set, a joint moves more than its
+      `options['joint_jump_tolerances']` between two points (`options['path_joint_jump_threshold']` for the joints
+      without tolerance), e.g. an IK branch flip. The tolerances are per-step limits of densely interpolated paths,
+      the Cartesian paths have one point per movement target pose and may take larger valid steps
+    - 'joint_limits': a point is outside the joint limits, restricted by the `custom_limits`
+    - 'path_length': only if `options['path_length_check']` is set, the joint space length of the path is more than
+      `options['path_length_ratio']` times the distance between its end points, plus a slack. The prismatic (m)
+      and revolute (rad) joints are measured separately, with slacks `options['path_length_slack_prismatic']`
+      and `options['path_length_slack_revolute']`
+    """
+    options = options or {}
+    jump_check = options.get('path_joint_jump_check', False)
+    joint_jump_tolerances = options.get('joint_jump_tolerances', {})
+    default_jump = options.get('path_joint_jump_threshold', 0.5)
+    max_jumps = np.array([joint_jump_tolerances.get(name, default_jump) for name in joint_names])
+    lower_limits, upper_limits = map(np.array, pp.get_custom_limits(robot_uid, joints, custom_limits or {}))
+    length_check = options.get('path_length_check', False)
+    length_ratio = options.get('path_length_ratio', 3.0)
+    prismatic = np.array([pp.get_joint_type(robot_uid, joint) == pybullet.JOINT_PRISMATIC for joint in joints], dtype=bool)
+    # (joint mask, slack) of each unit
+    length_groups = [(mask, slack) for mask, slack in [
+        (prismatic, options.get('path_length_slack_prismatic', 0.2)),
+        (~prismatic, options.get('path_length_slack_revolute', 0.5))] if np.any(mask)]
+
+    def path_sanity_fn(path):
+        values = np.asarray(path, dtype=float)
+        if len(values) == 0:
+            return None
+        steps = np.diff(values, axis=0)
+        if jump_check and np.any(np.abs(steps) > max_jumps):
+            return 'joint_jump'
+        if np.any(values < lower_limits) or np.any(values > upper_limits):
+            return 'joint_limits'
+        if length_check:
+            for mask, slack in length_groups:
+                length = np.linalg.norm(steps[:, mask], axis=1).sum()
+                if length > length_ratio * np.linalg.norm(values[-1, mask] - values[0, mask]) + slack:
+                    return 'path_length'
+        return None
+
+    return path_sanity_fn
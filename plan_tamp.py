@@ -16,6 +16,9 @@ from integral_timber_joints.planning.parsing import parse_process
 from utils import LOGGER, print_itj_pddl_plan, save_plan_text, save_plan_dict
 from parse_symbolic import PDDL_FOLDERS
 from parse_tamp import get_pddlstream_problem
+from stream_cache import clear_stream_cache
+from experience_sampler import save_gantry_experiences
+from instrumentation import PROFILER
 
 import time
 ##################################
@@ -41,6 +44,18 @@ def main():
     
     # * PDDLStream configs
     parser.add_argument('--costs', action='store_true', help='Use user-defined costs for actions.')
+    parser.add_argument('--stream_cache', action='store_true', help='Reuse sampled trajectories stored on disk from previous runs, and store the new ones.')
+    parser.add_argument('--clear_stream_cache', action='store_true', help='Remove all stored trajectories before planning.')
+    parser.add_argument('--stream_cache_max_size_mb', type=float, default=500.0, help='Size limit of the stream cache folder, least recently used entries are evicted first.')
+    parser.add_argument('--num_workers', type=int, default=1, help='Number of worker processes sampling motion plans in parallel, 1 disables the parallel sampling.')
+    parser.add_argument('--precompute_samples', type=int, default=0, help='Number of trajectories to sample for every beam and clamp joint before the search (stored in the stream cache). Uses --num_workers processes, or all cores if --num_workers is 1.')
+    parser.add_argument('--disable_static_pruning', action='store_true', help='Keep the collision checks of the beam and clamp pairs that can never collide (see static_pruning.py).')
+    parser.add_argument('--disable_beam_obb', action='store_true', help='Check the robot against the beams with pybullet at every trajectory point, without the analytic OBB test (see beam_obb.py).')
+    parser.add_argument('--fk_cache_memory', type=float, default=256, help='Memory budget in MB of the trajectory link pose cache (see fk_cache.py), 0 disables it.')
+    parser.add_argument('--speculative_sampling', action='store_true', help='With --num_workers, sample the stream instances ahead of the search instead of only the ones it asks for, ranked by past requests and assembly order (see speculative_sampler.py).')
+    parser.add_argument('--reachability_map', action='store_true', help='Propose the gantry base samples from the reachability map (see reachability_map.py, build it offline with `python reachability_map.py`), with gantry_base_generator as fallback.')
+    parser.add_argument('--experience_sampler', action='store_true', help='Propose the gantry base samples from the successful samples of previous runs, and record the new ones under experience/ (see experience_sampler.py).')
+    parser.add_argument('--collision_proxies', action='store_true', help='Check collisions on simplified collision geometry before the exact meshes (see collision_geometry.py).')
     # ! pyplanner config
     # parser.add_argument('--pp_h', default='ff', help='pyplanner heuristic configuration.')
     # parser.add_argument('--pp_search', default='eager', help='pyplanner search configuration.')
@@ -67,14 +82,30 @@ def main():
         'diagnosis' : args.diagnosis,
         # 'reinit_tool' : args.reinit_tool,
         'gantry_attempts' : 500, 
+        'stream_cache' : args.stream_cache,
+        'stream_cache_max_size_mb' : args.stream_cache_max_size_mb,
+        'num_workers' : args.num_workers,
+        'speculative_sampling' : args.speculative_sampling,
+        'precompute_samples' : args.precompute_samples,
+        'reachability_map' : args.reachability_map,
+        'experience_sampler' : args.experience_sampler,
+        'static_pruning' : not args.disable_static_pruning,
+        'collision_proxies' : args.collision_proxies,
+        'beam_obb' : not args.disable_beam_obb,
+        'fk_cache' : args.fk_cache_memory > 0,
+        'fk_cache_memory' : args.fk_cache_memory,
     }
 
     #########
     # * Load process and convert to PDDLStream problem
     process = parse_process(args.design_dir, args.process) # , subdir=args.problem_subdir
 
+    if args.clear_stream_cache:
+        clear_stream_cache()
+
     for case_number in args.planning_cases:
         pddl_folder = PDDL_FOLDERS[case_number - 1]
+        PROFILER.reset()
         pddlstream_problem = get_pddlstream_problem(
             process = process,
             case_number = case_number,
@@ -111,6 +142,8 @@ def main():
                         search_sample_ratio=1.5, # the desired ratio of sample time / search time
                         )
         end_time = time.time()
+        # * gantry configurations recorded during this case
+        save_gantry_experiences()
         
         # solution = solve(pddlstream_problem,
         #                  max_time=INF,
@@ -155,6 +188,17 @@ def main():
         else:
             LOGGER.info('No plan found, no result saved.')
 
+        # Stream profile, saved next to the plan results
+        if not args.disable_stream:
+            PROFILER.log_summary()
+            profile_file_name = 'profile_' + args.process + '_case{}.json'.format(case_number)
+            PROFILER.save_report(pddl_folder, profile_file_name, extra={
+                'case_number' : case_number,
+                'plan_success' : plan_success,
+                'planning_time' : end_time - start_time,
+            })
+            LOGGER.info('Stream profile saved to {}.'.format(profile_file_name))
+
 
 
 if __name__ == '__main__':
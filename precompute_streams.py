@@ -0,0 +1,76 @@
+import time
+from collections import Counter
+
+from parallel_sampler import get_parallel_sampler_pool
+from utils import LOGGER
+
+# Stream names of the motion planning samplers used in each planning case
+PLAN_MOTION_STREAMS_FROM_CASE = {
+    4 : ['plan_motion_for_beam_assembly'],
+    6 : ['plan_motion_for_beam_assembly', 'plan_motion_for_attach_clamp', 'plan_motion_for_detach_clamp'],
+}
+
+##########################################
+
+def get_stream_instances(init, stream_names):
+    """Stream inputs of all motion planning stream instances, following the `:domain` of the streams in stream.pddl.
+    Returns a list of (stream_name, inputs).
+    """
+    clamps_from_type = {}
+    for fact in init:
+        if fact[0] == 'ClampOfType':
+            _, clamp, clamp_type = fact
+            clamps_from_type.setdefault(clamp_type, []).append(clamp)
+
+    instances = []
+    for fact in init:
+        if fact[0] == 'BeamNeedsGripperType' and 'plan_motion_for_beam_assembly' in stream_names:
+            # (?beam ?grippertype)
+            _, beam, gripper_type = fact
+            instances.append(('plan_motion_for_beam_assembly', (beam, gripper_type)))
+        elif fact[0] == 'JointNeedsClampType':
+            # (?heldclamp ?clamptype ?beam1 ?beam2)
+            _, beam1, beam2, clamp_type = fact
+            for stream_name in ['plan_motion_for_attach_clamp', 'plan_motion_for_detach_clamp']:
+                if stream_name not in stream_names:
+                    continue
+                for clamp in clamps_from_type.get(clamp_type, []):
+                    instances.append((stream_name, (clamp, clamp_type, beam1, beam2)))
+    return instances
+
+
+def precompute_stream_outputs(process, init, stream_names, stream_cache, options=None, num_samples=1, num_workers=None, close_pool=False):
+    """Sample `num_samples` trajectories for every motion planning stream instance in parallel,
+    before the search starts, and store them in the stream cache.
+    The streams then serve these trajectories from the cache during the search.
+    Instances that already have enough stored trajectories are skipped.
+    The pool of `num_workers` workers (all cores by default) is kept for the search, unless `close_pool`.
+    """
+    options = options or {}
+    tasks = []
+    for stream_name, inputs in get_stream_instances(init, stream_names):
+        num_missing = num_samples - len(stream_cache.load(stream_name, inputs))
+        tasks.extend([(stream_name, inputs)] * num_missing)
+    if not tasks:
+        LOGGER.info('Precompute: all stream instances already have {} samples.'.format(num_samples))
+        return
+
+    start_time = time.time()
+    # the pool is kept alive for the search and the next planning cases (closed at exit), unless `close_pool`
+    sampler_pool = get_parallel_sampler_pool(process, options, num_workers=num_workers)
+    success_counter = Counter()
+    failure_counter = Counter()
+    try:
+        for stream_name, inputs, output in sampler_pool.map_samples(tasks, split_gantry_attempts=False):
+            if output is None:
+                failure_counter[stream_name] += 1
+                continue
+            stream_cache.save(stream_name, inputs, list(output))
+            success_counter[stream_name] += 1
+    finally:
+        if close_pool:
+            sampler_pool.close()
+
+    for stream_name in stream_names:
+        LOGGER.info('Precompute {}: {} samples stored, {} failed.'.format(stream_name, success_counter[stream_name], failure_counter[stream_name]))
+    LOGGER.info('Precompute time: {:.2f} s with {} workers.'.format(time.time() - start_time, sampler_pool.num_workers))
@@ -0,0 +1,247 @@
+import os
+import json
+from collections import defaultdict
+
+import numpy as np
+
+from compas_fab_pychoreo.conversions import pose_from_frame, pose_from_transformation
+
+from integral_timber_joints.process import RoboticMovement
+from integral_timber_joints.assembly import BeamAssemblyMethod
+from integral_timber_joints.process.action import BeamPlacementWithClampsAction, BeamPlacementWithoutClampsAction, AssembleBeamWithScrewdriversAction, PlaceClampToStructureAction, PickClampFromStructureAction
+
+from load_pddlstream import HERE
+from stream_cache import hash_from_data
+from utils import LOGGER
+
+# Bump this whenever the content of the index changes, old index files are then rebuilt.
+PROCESS_INDEX_VERSION = 2
+PROCESS_INDEX_DIR = os.path.join(HERE, 'process_index')
+
+CLAMP_OPERATIONS = ['attach', 'detach']
+
+# Indices built in this process, keyed by id(process): (process, index), the process is kept so that its id cannot be recycled
+_PROCESS_INDICES = {}
+
+##########################################
+
+def _pose(pose):
+    point, quat = pose
+    return (tuple(point), tuple(quat))
+
+
+def _get_movement_target_poses(process, action):
+    # target poses (in meter) of the robotic movements of the action that need an IK solution
+    action.create_movements(process)
+    target_poses = []
+    for movement in action.movements:
+        # * trigger state diff computation
+        movement.create_state_diff(process)
+
+        # * skip non-robotic movements for IK computation
+        if not isinstance(movement, RoboticMovement):
+            continue
+
+        # * skip if there exists a taught conf
+        if movement.target_configuration is not None:
+            continue
+
+        if movement.target_frame is None:
+            LOGGER.error(f'Target frame is None in {movement.short_summary}')
+
+        target_poses.append(pose_from_frame(movement.target_frame, scale=1e-3))
+    return target_poses
+
+
+class ProcessGeometryIndex(object):
+    """Geometric data of a process shared by all the stream factories.
+
+    - beam_ids: beams that are not manually assembled, in assembly order
+    - beam_assembled_poses[beam_id]: pose at `assembly_wcf_final`
+    - beam_grasps[beam_id]: flange from beam pose
+    - beam_neighbours[beam_id]: already built neighbours
+    - beam_target_poses[beam_id]: IK target poses of the beam's assembly movements
+    - clamp_grasp: flange from clamp pose, the same for every clamp
+    - joint_target_poses[operation][joint_id]: IK target poses of the clamp attach / detach movements
+    - clamp_at_joint_poses[joint_id]: pose of a clamp attached at the joint, at `clamp_wcf_final`
+
+    All poses are in meter. The index only depends on the process, it is saved as json under `index_dir`
+    (keyed by a hash of the process) and loaded on later runs, which skips the movement computations.
+    Body handles depend on the pybullet world and are resolved by `bind`.
+    `certified_clamp_trajectories[operation][(clamp, joint_id)]` collects the clamp trajectories found
+    during this run (not saved), so that the attach and detach samplers can reuse each other's trajectories.
+    """
+
+    def __init__(self):
+        self.beam_ids = []
+        self.beam_assembled_poses = {}
+        self.beam_grasps = {}
+        self.beam_neighbours = {}
+        self.beam_target_poses = {}
+        self.clamp_grasp = None
+        self.joint_target_poses = {operation : {} for operation in CLAMP_OPERATIONS}
+        self.clamp_at_joint_poses = {}
+        self.certified_clamp_trajectories = {operation : defaultdict(list) for operation in CLAMP_OPERATIONS}
+
+        self.client = None
+        self.beam_bodies = {}
+        self.clamp_bodies = {}
+        self.static_obstacles = []
+
+    @classmethod
+    def from_process(cls, process):
+        index = cls()
+        gripper_names_from_type = defaultdict(list)
+        for gripper in process.grippers:
+            if gripper.type_name:
+                gripper_names_from_type[gripper.type_name].append(gripper.name)
+        for screwdriver in process.screwdrivers:
+            if screwdriver.type_name:
+                gripper_names_from_type[screwdriver.type_name].append(screwdriver.name)
+
+        toolchanger = process.robot_toolchanger
+        flange_from_toolchanger_base = toolchanger.t_t0cf_from_tcf
+        # all clamp use the same grasp transformation from the tool changer
+        index.clamp_grasp = _pose(pose_from_transformation(toolchanger.t_t0cf_from_tcf, scale=1e-3))
+
+        for beam_id in process.assembly.sequence:
+            # Skip scaffolding elements
+            assembly_method = process.assembly.get_assembly_method(beam_id)
+            if assembly_method == BeamAssemblyMethod.MANUAL_ASSEMBLY:
+                continue
+            index.beam_ids.append(beam_id)
+
+            # Cache all beam's frame at asssembled position
+            index.beam_assembled_poses[beam_id] = _pose(pose_from_frame(process.assembly.get_beam_attribute(beam_id, 'assembly_wcf_final'), scale=1e-3))
+            index.beam_neighbours[beam_id] = list(process.assembly.get_already_built_neighbors(beam_id))
+
+            # Cache all grasp transformations
+            t_gripper_tcf_from_beam = process.assembly.get_t_gripper_tcf_from_beam(beam_id)
+            beam_gripper_id = process.assembly.get_beam_attribute(beam_id, "gripper_id")
+            beam_gripper = process.tool(beam_gripper_id)
+            flange_from_beam = flange_from_toolchanger_base * beam_gripper.t_t0cf_from_tcf * t_gripper_tcf_from_beam
+            # scale the translation part of the transformation to meter
+            for k in range(3):
+                flange_from_beam[k,3] *= 1e-3
+            index.beam_grasps[beam_id] = _pose(pose_from_transformation(flange_from_beam))
+
+            # * target frames of the beam's assembly action
+            gripper_type = process.assembly.get_beam_attribute(beam_id, "gripper_type")
+            assert gripper_type in gripper_names_from_type
+            # randomly assign one suitable gripper to each beam just for sampling purposes
+            gripper_id = gripper_names_from_type[gripper_type][0]
+
+            if assembly_method == BeamAssemblyMethod.GROUND_CONTACT:
+                action = BeamPlacementWithoutClampsAction(beam_id=beam_id, gripper_id=gripper_id)
+            elif assembly_method == BeamAssemblyMethod.CLAMPED:
+                # we can leave joint_ids and clamp_ids empty beacuse we don't need ACM here
+                action = BeamPlacementWithClampsAction(beam_id=beam_id, joint_ids=[], gripper_id=gripper_id, clamp_ids=[])
+            elif assembly_method in [BeamAssemblyMethod.SCREWED_WITH_GRIPPER, BeamAssemblyMethod.SCREWED_WITHOUT_GRIPPER]:
+                # we can leave joint_ids and clamp_ids empty beacuse we don't need ACM here
+                action = AssembleBeamWithScrewdriversAction(beam_id=beam_id, joint_ids=[], gripper_id=gripper_id, screwdriver_ids=[])
+            else:
+                action = None
+            if action is not None:
+                index.beam_target_poses[beam_id] = [_pose(pose) for pose in _get_movement_target_poses(process, action)]
+
+            # * target frames of the clamp attach / detach actions at each joint of a clamped beam
+            if assembly_method != BeamAssemblyMethod.CLAMPED:
+                continue
+            for neighbor_id in index.beam_neighbours[beam_id]:
+                joint_id = (neighbor_id, beam_id)
+                index.clamp_at_joint_poses[joint_id] = _pose(pose_from_frame(process.assembly.get_joint_attribute(joint_id, 'clamp_wcf_final'), scale=1e-3))
+                joint_clamp_type = process.assembly.get_joint_attribute(joint_id, 'tool_type')
+                # any tool_id assignment is fine here as long as the tool_type is correct
+                tool_id = process.assembly.get_joint_attribute(joint_id, 'tool_id')
+                for operation, action_cls in zip(CLAMP_OPERATIONS, [PlaceClampToStructureAction, PickClampFromStructureAction]):
+                    action = action_cls(joint_id=joint_id, tool_type=joint_clamp_type, tool_id=tool_id)
+                    index.joint_target_poses[operation][joint_id] = [_pose(pose) for pose in _get_movement_target_poses(process, action)]
+        return index
+
+    def are_clamp_targets_reversed(self, joint_id, tolerance=1e-6):
+        """True if the detach target poses of the joint are the attach target poses in reverse order.
+        """
+        attach_poses = self.joint_target_poses['attach'].get(joint_id, [])
+        detach_poses = self.joint_target_poses['detach'].get(joint_id, [])
+        if not attach_poses or len(attach_poses) != len(detach_poses):
+            return False
+        for attach_pose, detach_pose in zip(attach_poses, reversed(detach_poses)):
+            if not np.allclose(np.concatenate(attach_pose), np.concatenate(detach_pose), atol=tolerance):
+                return False
+        return True
+
+    def bind(self, client, process):
+        """Resolves the body handles in the world of `client`, nothing is done if it is already bound to it.
+        """
+        if client is self.client:
+            return
+        self.client = client
+        self.beam_bodies = {beam_id : client._get_bodies('^{}$'.format(beam_id))[0] for beam_id in self.beam_ids}
+        self.clamp_bodies = {clamp.name : client._get_bodies('^{}$'.format(clamp.name))[0] for clamp in process.clamps}
+        self.static_obstacles = []
+        for env_name in process.environment_models:
+            self.static_obstacles.extend(client._get_bodies('^{}$'.format(env_name)))
+
+    def to_data(self):
+        return {
+            'version' : PROCESS_INDEX_VERSION,
+            'beam_ids' : self.beam_ids,
+            'beam_assembled_poses' : self.beam_assembled_poses,
+            'beam_grasps' : self.beam_grasps,
+            'beam_neighbours' : self.beam_neighbours,
+            'beam_target_poses' : self.beam_target_poses,
+            'clamp_grasp' : self.clamp_grasp,
+            # json keys must be strings, joint ids are stored as pairs
+            'joint_target_poses' : {operation : [[list(joint_id), poses] for joint_id, poses in self.joint_target_poses[operation].items()] \
+                for operation in CLAMP_OPERATIONS},
+            'clamp_at_joint_poses' : [[list(joint_id), pose] for joint_id, pose in self.clamp_at_joint_poses.items()],
+        }
+
+    @classmethod
+    def from_data(cls, data):
+        index = cls()
+        index.beam_ids = data['beam_ids']
+        index.beam_assembled_poses = {beam_id : _pose(pose) for beam_id, pose in data['beam_assembled_poses'].items()}
+        index.beam_grasps = {beam_id : _pose(pose) for beam_id, pose in data['beam_grasps'].items()}
+        index.beam_neighbours = data['beam_neighbours']
+        index.beam_target_poses = {beam_id : [_pose(pose) for pose in poses] for beam_id, poses in data['beam_target_poses'].items()}
+        index.clamp_grasp = _pose(data['clamp_grasp'])
+        index.joint_target_poses = {operation : {tuple(joint_id) : [_pose(pose) for pose in poses] for joint_id, poses in data['joint_target_poses'][operation]} \
+            for operation in CLAMP_OPERATIONS}
+        index.clamp_at_joint_poses = {tuple(joint_id) : _pose(pose) for joint_id, pose in data['clamp_at_joint_poses']}
+        return index
+
+##########################################
+
+def get_process_geometry_index(client, process, options=None, index_dir=PROCESS_INDEX_DIR):
+    """Returns the geometry index of the process bound to the world of `client`.
+    It is built once per process (or loaded from `index_dir` if `options['process_index_cache']`, default True)
+    and shared by all the stream factories.
+    """
+    options = options or {}
+    if id(process) not in _PROCESS_INDICES:
+        index = None
+        path = None
+        if options.get('process_index_cache', True):
+            path = os.path.join(index_dir, hash_from_data([PROCESS_INDEX_VERSION, process]) + '.json')
+            if os.path.exists(path):
+                try:
+                    with open(path, 'r') as f:
+                        index = ProcessGeometryIndex.from_data(json.load(f))
+                    LOGGER.debug('Process geometry index loaded from {}'.format(path))
+                except (ValueError, KeyError, OSError) as e:
+                    LOGGER.warning('Process geometry index {} is unreadable and will be rebuilt: {}'.format(path, e))
+        if index is None:
+            index = ProcessGeometryIndex.from_process(process)
+            if path is not None:
+                if not os.path.exists(index_dir):
+                    os.makedirs(index_dir)
+                # write and rename, several worker processes may save the same index
+                tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+                with open(tmp_path, 'w') as f:
+                    json.dump(index.to_data(), f)
+                os.replace(tmp_path, path)
+        _PROCESS_INDICES[id(process)] = (process, index)
+    index = _PROCESS_INDICES[id(process)][1]
+    index.bind(client, process)
+    return index
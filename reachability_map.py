@@ -0,0 +1,280 @@
+import os
+import json
+import random
+import logging
+import argparse
+
+import numpy as np
+import pybullet_planning as pp
+from compas_fab.robots import Configuration
+
+from integral_timber_joints.planning.parsing import parse_process
+
+from load_pddlstream import HERE
+from stream_cache import hash_from_data
+from process_index import get_process_geometry_index
+from world_pool import get_robot_world
+from batch_ik import _rotation_from_quat, add_joint_turns, batch_arm_ik_in_base_frame, filter_joint_limits, get_gantry_arm_kinematics
+from utils import LOGGER
+
+# Bump this whenever the map computation changes, old map files are then recomputed.
+REACHABILITY_MAP_VERSION = 2
+REACHABILITY_MAP_DIR = os.path.join(HERE, 'reachability')
+
+# Entries of the kinematics dict that the map depends on, they are part of the map file key.
+KINEMATICS_KEYS = ['a1', 'd1', 'a2', 'a3', 'd4', 'tool_rotation', 'wrist_from_tool', 'lower_limits', 'upper_limits']
+
+# Loaded maps, keyed by map file path, shared by all samplers of this process
+_REACHABILITY_MAPS = {}
+
+##########################################
+
+def _canonical_quat(quat):
+    # q and -q are the same rotation, keep the one with a positive largest component
+    quat = np.array(quat, dtype=float)
+    return quat if quat[np.argmax(np.abs(quat))] > 0 else -quat
+
+
+class ReachabilityMap(object):
+    """Precomputed map of where the arm base should be placed to reach a tool pose.
+
+    The tool orientation relative to the arm base does not change with the (prismatic) gantry,
+    so the map is binned by the quantized tool orientation in the arm base frame. Each bin holds the grid of
+    tool positions relative to the arm base (`resolution` in meter) that have at least one IK solution
+    within the joint limits at the bin's orientation, with the number of such solutions as score.
+    A query at another orientation of the bin shifts the cells so that the wrist centers stay in place,
+    the orientation difference then only changes the wrist joint values, which the IK at the exact pose checks.
+    The bins of the target poses of a process are built offline (`build_reachability_map`, see `main`),
+    the bins of other orientations are computed with the batch IK on first use.
+    The map is persisted as json under `map_dir`, the file name is a hash of the arm kinematics, joint limits and resolutions.
+    """
+
+    def __init__(self, kinematics, resolution=0.15, orientation_resolution=0.1, map_dir=REACHABILITY_MAP_DIR):
+        self.kinematics = kinematics
+        self.resolution = resolution
+        self.orientation_resolution = orientation_resolution
+        self.map_dir = map_dir
+        kinematics_data = {key : np.asarray(kinematics[key]).tolist() for key in KINEMATICS_KEYS}
+        self.key = hash_from_data([REACHABILITY_MAP_VERSION, kinematics_data, resolution, orientation_resolution])
+        self.path = os.path.join(map_dir, self.key + '.json')
+        # bins[orientation_key] = (grid indices (M, 3) int array, scores (M,) int array)
+        self.bins = {}
+        self.modified = False
+
+        # the tool can not be further away from the arm base than the sum of the link lengths
+        k = kinematics
+        self.reach = abs(k['d1']) + abs(k['a1']) + abs(k['a2']) + np.hypot(k['a3'], k['d4']) + np.linalg.norm(k['wrist_from_tool'])
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, 'r') as f:
+                data = json.load(f)
+        except (ValueError, OSError) as e:
+            LOGGER.warning('Reachability map {} is unreadable and will be recomputed: {}'.format(self.path, e))
+            return
+        for orientation_key, (indices, scores) in data['bins'].items():
+            self.bins[orientation_key] = (np.array(indices, dtype=int).reshape(-1, 3), np.array(scores, dtype=int))
+        LOGGER.debug('Reachability map loaded from {} with {} bins.'.format(self.path, len(self.bins)))
+
+    def save(self):
+        """Writes the map if new bins were computed since it was loaded.
+        """
+        if not self.modified:
+            return
+        if not os.path.exists(self.map_dir):
+            os.makedirs(self.map_dir)
+        data = {
+            'version' : REACHABILITY_MAP_VERSION,
+            'resolution' : self.resolution,
+            'orientation_resolution' : self.orientation_resolution,
+            'bins' : {orientation_key : [indices.tolist(), scores.tolist()] for orientation_key, (indices, scores) in self.bins.items()},
+        }
+        # write and rename, several worker processes may save the same map
+        tmp_path = '{}.{}.tmp'.format(self.path, os.getpid())
+        with open(tmp_path, 'w') as f:
+            json.dump(data, f)
+        os.replace(tmp_path, self.path)
+        self.modified = False
+        LOGGER.debug('Reachability map saved to {} with {} bins.'.format(self.path, len(self.bins)))
+
+    def _orientation_key(self, tool_rotation):
+        quat = _canonical_quat(pp.quat_from_matrix(tool_rotation))
+        quantized = np.round(quat / self.orientation_resolution).astype(int)
+        return ','.join(str(v) for v in quantized)
+
+    def _bin_rotation(self, orientation_key):
+        quat = np.array([int(v) for v in orientation_key.split(',')], dtype=float)
+        return _rotation_from_quat(quat / np.linalg.norm(quat))
+
+    def _compute_bin(self, orientation_key):
+        # the map is computed for the bin's representative orientation, not for the queried one,
+        # so that it does not depend on the query order
+        tool_rotation = self._bin_rotation(orientation_key)
+
+        num_steps = int(np.ceil(self.reach / self.resolution))
+        steps = np.arange(-num_steps, num_steps + 1)
+        indices = np.array(np.meshgrid(steps, steps, steps, indexing='ij')).reshape(3, -1).T
+        offsets = indices * self.resolution
+        inside = np.linalg.norm(offsets, axis=1) <= self.reach + self.resolution
+        indices, offsets = indices[inside], offsets[inside]
+
+        solutions = add_joint_turns(batch_arm_ik_in_base_frame(self.kinematics, offsets, tool_rotation))
+        scores = filter_joint_limits(solutions, self.kinematics['lower_limits'], self.kinematics['upper_limits']).sum(axis=1)
+        reachable = scores > 0
+        LOGGER.debug('Reachability map bin {}: {}/{} reachable cells.'.format(orientation_key, reachable.sum(), len(scores)))
+        return indices[reachable], scores[reachable]
+
+    def build_bin(self, tool_rotation):
+        """Computes the bin of a tool orientation (in the arm base frame) if it is not in the map yet.
+        Returns the orientation key of the bin.
+        """
+        orientation_key = self._orientation_key(tool_rotation)
+        if orientation_key not in self.bins:
+            self.bins[orientation_key] = self._compute_bin(orientation_key)
+            self.modified = True
+        return orientation_key
+
+    def get_bin(self, tool_rotation):
+        """Returns the reachable offsets (tool position relative to the arm base, in the arm base frame)
+        and their scores for a tool orientation given in the arm base frame.
+        """
+        orientation_key = self.build_bin(tool_rotation)
+        indices, scores = self.bins[orientation_key]
+        # same wrist centers as the cells of the bin's orientation
+        wrist_from_tool = self.kinematics['wrist_from_tool']
+        shift = (self._bin_rotation(orientation_key) - tool_rotation).dot(wrist_from_tool)
+        return indices * self.resolution + shift, scores
+
+    def get_gantry_candidates(self, world_from_tool, reachable_range=None):
+        """Gantry joint values that place the arm base on the reachable cells of the tool pose,
+        within the gantry joint limits and at a tool distance within `reachable_range` (as for `gantry_base_generator`),
+        sorted by decreasing score.
+        Returns a (M, num_gantry_joints) array and the (M,) scores.
+        """
+        k = self.kinematics
+        base_rotation = k['base_rotation']
+        tool_rotation = base_rotation.T.dot(_rotation_from_quat(world_from_tool[1]))
+        offsets, scores = self.get_bin(tool_rotation)
+        if reachable_range is not None:
+            distances = np.linalg.norm(offsets, axis=1)
+            in_range = (distances >= reachable_range[0]) & (distances <= reachable_range[1])
+            offsets, scores = offsets[in_range], scores[in_range]
+
+        # base_point + gantry_values @ gantry_directions = tool_point - base_rotation @ offset
+        base_points = np.array(world_from_tool[0]) - offsets.dot(base_rotation.T)
+        gantry_values = np.linalg.lstsq(k['gantry_directions'].T, (base_points - k['base_point']).T, rcond=None)[0].T
+        # cells that the gantry can not reach exactly (less than 3 gantry axes) are dropped
+        residuals = np.linalg.norm(k['base_point'] + gantry_values.dot(k['gantry_directions']) - base_points, axis=1)
+        valid = (residuals < self.resolution / 2) & \
+            np.all(gantry_values >= k['gantry_lower_limits'], axis=1) & np.all(gantry_values <= k['gantry_upper_limits'], axis=1)
+        gantry_values, scores = gantry_values[valid], scores[valid]
+        order = np.argsort(-scores, kind='stable')
+        return gantry_values[order], scores[order]
+
+    def gantry_sampler(self, world_from_tool, base_sampler, reachable_range=None, exploration=0.3, sample_slice=(0, 1)):
+        """Yields gantry base configurations for the tool pose: first every reachable cell by decreasing score
+        (only the cells `index`, `index + count`, ... of this `sample_slice` = (index, count), e.g. one slice per worker),
+        then score-weighted random cells, or a sample of `base_sampler` (e.g. `gantry_base_generator`)
+        with probability `exploration`. Only `base_sampler` is used if no cell can be reached by the gantry.
+        Each cell sample is jittered within its cell.
+        The gantry joints are set in the world before each yield, as for `gantry_base_generator`.
+        Stops when `base_sampler` is exhausted.
+        """
+        gantry_values, scores = self.get_gantry_candidates(world_from_tool, reachable_range)
+        k = self.kinematics
+        # jitter of the base position within a cell, converted to gantry joint values
+        jitter_from_base = np.linalg.pinv(k['gantry_directions'])
+        weights = scores / float(scores.sum()) if len(scores) else scores
+
+        def sample_cell(index):
+            jitter = np.random.uniform(-self.resolution / 2, self.resolution / 2, 3).dot(jitter_from_base)
+            values = np.clip(gantry_values[index] + jitter, k['gantry_lower_limits'], k['gantry_upper_limits'])
+            pp.set_joint_positions(k['robot_uid'], k['gantry_joints'], values)
+            return Configuration(values.tolist(), k['gantry_joint_types'], k['gantry_joint_names'])
+
+        def gen():
+            for index in range(sample_slice[0], len(scores), sample_slice[1]):
+                yield sample_cell(index)
+            while True:
+                if len(scores) == 0 or random.random() < exploration:
+                    base_conf = next(base_sampler, None)
+                    if base_conf is None:
+                        return
+                    yield base_conf
+                    continue
+                yield sample_cell(np.random.choice(len(scores), p=weights))
+        return gen()
+
+##########################################
+
+def get_reachability_map(client, robot, options=None):
+    """Returns the reachability map of the robot, loaded from disk on first use in this process.
+    Returns None if not enabled with `options['reachability_map']` or if the robot kinematics is not supported by the batch IK.
+    """
+    options = options or {}
+    if not options.get('reachability_map', False):
+        return None
+    kinematics = get_gantry_arm_kinematics(client, robot, options)
+    if kinematics is None:
+        LOGGER.warning('Reachability map: unsupported robot kinematics, falling back to random gantry sampling.')
+        return None
+    reachability_map = ReachabilityMap(kinematics,
+        resolution=options.get('reachability_resolution', 0.15),
+        orientation_resolution=options.get('reachability_orientation_resolution', 0.1))
+    if reachability_map.path not in _REACHABILITY_MAPS:
+        reachability_map.load()
+        _REACHABILITY_MAPS[reachability_map.path] = reachability_map
+    reachability_map = _REACHABILITY_MAPS[reachability_map.path]
+    # the world may have been reloaded since the map was created, keep the current body and joint ids
+    reachability_map.kinematics = kinematics
+    return reachability_map
+
+
+def build_reachability_map(client, robot, process, options=None):
+    """Computes the bins of the beam and clamp target poses of the process and saves the map.
+    """
+    options = dict(options or {}, reachability_map=True)
+    reachability_map = get_reachability_map(client, robot, options)
+    if reachability_map is None:
+        return None
+    index = get_process_geometry_index(client, process, options)
+    target_poses = [poses[0] for poses in index.beam_target_poses.values()]
+    for joint_target_poses in index.joint_target_poses.values():
+        target_poses.extend(poses[0] for poses in joint_target_poses.values())
+
+    base_rotation = reachability_map.kinematics['base_rotation']
+    orientation_keys = set()
+    for world_from_tool in target_poses:
+        orientation_keys.add(reachability_map.build_bin(base_rotation.T.dot(_rotation_from_quat(world_from_tool[1]))))
+    reachability_map.save()
+    LOGGER.info('Reachability map: {} target poses in {} bins, {} bins in total, saved to {}'.format(
+        len(target_poses), len(orientation_keys), len(reachability_map.bins), reachability_map.path))
+    return reachability_map
+
+##########################################
+
+def main():
+    parser = argparse.ArgumentParser(description='Builds the reachability map bins of the target poses of a process.')
+    parser.add_argument('--process', default='CantiBoxLeft_process.json', help='The name of the problem (json file\'s name).')
+    parser.add_argument('--design_dir', default='220407_CantiBoxLeft', help='problem json\'s containing folder\'s name.')
+    parser.add_argument('--resolution', type=float, default=0.15, help='Size of the grid cells in meter.')
+    parser.add_argument('--orientation_resolution', type=float, default=0.1, help='Quantization step of the tool orientation quaternion.')
+    parser.add_argument('--debug', action='store_true', help='Debug mode.')
+    args = parser.parse_args()
+    LOGGER.setLevel(logging.DEBUG if args.debug else logging.INFO)
+
+    process = parse_process(args.design_dir, args.process)
+    options = {
+        'reachability_resolution' : args.resolution,
+        'reachability_orientation_resolution' : args.orientation_resolution,
+    }
+    client, robot = get_robot_world(process, options, viewer=False, verbose=False)
+    try:
+        build_reachability_map(client, robot, process, options)
+    finally:
+        client.disconnect()
+
+if __name__ == '__main__':
+    main()
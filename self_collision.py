@@ -0,0 +1,170 @@
+import os
+import json
+import argparse
+import logging
+import multiprocessing
+from collections import Counter
+
+import numpy as np
+import pybullet
+import pybullet_planning as pp
+
+from load_pddlstream import HERE
+from integral_timber_joints.planning.robot_setup import load_RFL_world, get_tolerances, GANTRY_ARM_GROUP
+
+from stream_cache import hash_from_data
+from utils import LOGGER
+
+# Bump this whenever the classification changes, old pair files are then ignored.
+SELF_COLLISION_VERSION = 2
+SELF_COLLISION_DIR = os.path.join(HERE, 'self_collision')
+
+# Disabled link pairs (by link names) loaded from the pair file, keyed by id(robot), shared by all samplers of this process
+_DISABLED_SELF_COLLISIONS = {}
+
+##########################################
+
+def get_sampling_limits(client, robot):
+    """(joints, lower limits, upper limits) of the gantry arm joints sampled by `compute_self_collision_pairs`:
+    the custom limits of the robot's tolerances. The link geometry of a revolute joint repeats every turn,
+    so a revolute joint whose range covers a full turn is sampled in [-pi, pi], the prismatic joints keep their limits.
+    """
+    robot_uid = client.get_robot_pybullet_uid(robot)
+    joints = pp.joints_from_names(robot_uid, robot.get_configurable_joint_names(group=GANTRY_ARM_GROUP))
+    joint_custom_limits = get_tolerances(robot).get('joint_custom_limits', {})
+    custom_limits = {pp.joint_from_name(robot_uid, jn) : lims for jn, lims in joint_custom_limits.items()}
+    lower_limits, upper_limits = map(np.array, pp.get_custom_limits(robot_uid, joints, custom_limits))
+    full_turn = np.array([pp.get_joint_type(robot_uid, joint) != pybullet.JOINT_PRISMATIC for joint in joints]) & \
+        (upper_limits - lower_limits >= 2 * np.pi)
+    lower_limits = np.where(full_turn, -np.pi, lower_limits)
+    upper_limits = np.where(full_turn, np.pi, upper_limits)
+    return joints, lower_limits, upper_limits
+
+
+def get_self_collision_path(client, robot, pair_dir=SELF_COLLISION_DIR):
+    """Pair file of the robot model, the file name is a hash of the model (links, joints, limits and meshes)
+    and of the sampled joint limits (see `get_sampling_limits`).
+    """
+    _, lower_limits, upper_limits = get_sampling_limits(client, robot)
+    limits = [np.round(lower_limits, 6).tolist(), np.round(upper_limits, 6).tolist()]
+    return os.path.join(pair_dir, hash_from_data([SELF_COLLISION_VERSION, robot.model, GANTRY_ARM_GROUP, limits]) + '.json')
+
+
+def get_candidate_link_pairs(client, robot):
+    """Self-collision link pairs that the collision functions of the gantry arm check: pairs with a moving link,
+    not adjacent and not disabled by the SRDF.
+    """
+    robot_uid = client.get_robot_pybullet_uid(robot)
+    joints = pp.joints_from_names(robot_uid, robot.get_configurable_joint_names(group=GANTRY_ARM_GROUP))
+    return pp.get_self_link_pairs(robot_uid, joints, disabled_collisions=client.get_self_collision_link_ids(robot))
+
+
+def _sample_link_pair_collisions(num_samples, seed):
+    # worker: loads its own world, returns the number of samples in collision of each candidate pair (by link names)
+    client, robot, _ = load_RFL_world(viewer=False, verbose=False)
+    try:
+        robot_uid = client.get_robot_pybullet_uid(robot)
+        joints, lower_limits, upper_limits = get_sampling_limits(client, robot)
+
+        link_pairs = get_candidate_link_pairs(client, robot)
+        links = sorted({link for pair in link_pairs for link in pair})
+        rng = np.random.default_rng(seed)
+        counts = Counter()
+        for conf in rng.uniform(lower_limits, upper_limits, size=(num_samples, len(joints))):
+            pp.set_joint_positions(robot_uid, joints, conf)
+            # the AABB overlap is checked first, most pairs are far apart
+            aabbs = {link : pp.get_aabb(robot_uid, link) for link in links}
+            for link1, link2 in link_pairs:
+                if pp.aabb_overlap(aabbs[link1], aabbs[link2]) and pp.pairwise_link_collision(robot_uid, link1, robot_uid, link2):
+                    counts[link1, link2] += 1
+        return {(pp.get_link_name(robot_uid, link1), pp.get_link_name(robot_uid, link2)) : counts[link1, link2] \
+            for link1, link2 in link_pairs}
+    finally:
+        client.disconnect()
+
+
+def compute_self_collision_pairs(client, robot, num_samples=int(1e6), num_workers=None, batch_size=10000, seed=0, pair_dir=SELF_COLLISION_DIR):
+    """Samples uniform configurations of the gantry arm in worker processes and classifies the candidate link pairs:
+    - never: in collision in none of the samples
+    - always: in collision in all the samples
+    The pairs of the two classes are written to the robot's pair file as the pairs to disable.
+    The adjacent links are not candidates, pybullet does not check them.
+    """
+    num_workers = num_workers or multiprocessing.cpu_count()
+    batches = [(min(batch_size, num_samples - start), seed + i) for i, start in enumerate(range(0, num_samples, batch_size))]
+    LOGGER.info('Self-collision pairs: sampling {} configurations in {} batches with {} workers.'.format(num_samples, len(batches), num_workers))
+
+    counts = Counter()
+    context = multiprocessing.get_context('spawn')
+    with context.Pool(num_workers) as pool:
+        for batch_counts in pool.starmap(_sample_link_pair_collisions, batches):
+            # the pairs with a zero count are kept as keys
+            counts.update(batch_counts)
+
+    pairs = sorted(counts)
+    data = {
+        'version' : SELF_COLLISION_VERSION,
+        'num_samples' : num_samples,
+        'never' : [list(pair) for pair in pairs if counts[pair] == 0],
+        'always' : [list(pair) for pair in pairs if counts[pair] == num_samples],
+        'collision_counts' : [[name1, name2, counts[name1, name2]] for name1, name2 in pairs],
+    }
+    if not os.path.exists(pair_dir):
+        os.makedirs(pair_dir)
+    path = get_self_collision_path(client, robot, pair_dir)
+    with open(path, 'w') as f:
+        json.dump(data, f, indent=1)
+    LOGGER.info('Self-collision pairs: {} candidates, {} never, {} always, saved to {}'.format(
+        len(pairs), len(data['never']), len(data['always']), path))
+    return data
+
+##########################################
+
+def get_disabled_self_collisions(client, robot, options=None):
+    """Self-collision link pairs to skip: the SRDF pairs (`client.get_self_collision_link_ids`) and the pairs
+    of the robot's pair file (see `compute_self_collision_pairs`) if it exists and `options['self_collision_pairs']` is set.
+    """
+    options = options or {}
+    disabled_collisions = set(client.get_self_collision_link_ids(robot))
+    if not options.get('self_collision_pairs', True):
+        return disabled_collisions
+
+    # the robot is kept in the entry so that its id cannot be recycled
+    if id(robot) not in _DISABLED_SELF_COLLISIONS:
+        path = get_self_collision_path(client, robot)
+        pair_names = []
+        if os.path.exists(path):
+            with open(path, 'r') as f:
+                data = json.load(f)
+            pair_names = data['never'] + data['always']
+            LOGGER.debug('Self-collision pairs loaded from {}: {} pairs disabled.'.format(path, len(pair_names)))
+        else:
+            LOGGER.debug('No self-collision pair file {}, only the SRDF pairs are disabled.'.format(path))
+        _DISABLED_SELF_COLLISIONS[id(robot)] = (robot, pair_names)
+
+    robot_uid = client.get_robot_pybullet_uid(robot)
+    for name1, name2 in _DISABLED_SELF_COLLISIONS[id(robot)][1]:
+        disabled_collisions.add((pp.link_from_name(robot_uid, name1), pp.link_from_name(robot_uid, name2)))
+    return disabled_collisions
+
+##########################################
+
+def main():
+    parser = argparse.ArgumentParser(description='Computes the self-collision link pairs of the robot that the samplers can skip.')
+    parser.add_argument('--num_samples', type=int, default=int(1e6), help='Number of gantry arm configurations to sample.')
+    parser.add_argument('--num_workers', type=int, default=0, help='Number of worker processes, 0 uses all cores.')
+    parser.add_argument('--batch_size', type=int, default=10000, help='Number of configurations sampled by a worker per task.')
+    parser.add_argument('--seed', type=int, default=0, help='Random seed of the first batch.')
+    parser.add_argument('--debug', action='store_true', help='Debug mode.')
+    args = parser.parse_args()
+    LOGGER.setLevel(logging.DEBUG if args.debug else logging.INFO)
+
+    client, robot, _ = load_RFL_world(viewer=False, verbose=False)
+    try:
+        compute_self_collision_pairs(client, robot, num_samples=args.num_samples, num_workers=args.num_workers or None,
+            batch_size=args.batch_size, seed=args.seed)
+    finally:
+        client.disconnect()
+
+if __name__ == '__main__':
+    main()
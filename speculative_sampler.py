@@ -0,0 +1,164 @@
+import time
+import threading
+from collections import Counter, defaultdict, deque
+
+from utils import LOGGER
+
+# Speculative sampler of each sampler pool, keyed by id(pool): (pool, sampler)
+# the sampler of a previous planning case is stopped when it is replaced
+_SPECULATIVE_SAMPLERS = {}
+
+##########################################
+
+class SpeculativeSampler(object):
+    """Samples the motion planning stream instances in the workers of a `ParallelSamplerPool` while the search runs.
+
+    Up to `max_in_flight` requests (one per worker by default) are kept running in the background, and each
+    instance keeps at most `max_buffered` outputs ready (buffered plus running). The instances are ranked by
+    expected use, approximated without access to the search's skeleton queue: first the instances the search has
+    asked for, the most requested first (their outputs failed the downstream tests of the current skeletons and
+    more are needed), then the other `instances` in their order (the init order follows the assembly sequence). When the search asks for an instance, a buffered
+    output is returned at once, otherwise it waits for the running request, or sends one.
+    A request goes to any free worker, and each worker keeps its own sampler of the instance. The instance is
+    exhausted once every worker has run out of samples for it, or after `max_failures` consecutive empty outputs
+    (failed requests, or requests that keep landing on the same exhausted workers).
+    The search waits at most `timeout` seconds for an instance without any output (a request can be lost
+    if its worker dies), the instance is then given up. Nothing is waited for once the pool is closed.
+    """
+
+    def __init__(self, sampler_pool, instances=(), max_in_flight=None, max_buffered=2, max_failures=None, timeout=600.0, poll_interval=1.0):
+        self.sampler_pool = sampler_pool
+        self.prior_rank = {(stream_name, tuple(inputs)) : rank for rank, (stream_name, inputs) in enumerate(instances)}
+        self.max_in_flight = max_in_flight or sampler_pool.num_workers
+        self.max_buffered = max_buffered
+        self.condition = threading.Condition()
+        # buffers[task] = outputs sampled ahead of the search, with task = (stream_name, inputs)
+        self.buffers = defaultdict(deque)
+        self.pending = Counter()
+        # exhausted_workers[task] = indices of the workers that ran out of samples for the instance
+        self.exhausted_workers = defaultdict(set)
+        self.failures = Counter()
+        self.max_failures = max_failures or 3 * sampler_pool.num_workers
+        self.timeout = timeout
+        self.poll_interval = poll_interval
+        # instances given up after a timeout
+        self.timed_out = set()
+        self.request_counts = Counter()
+        self.stopped = False
+        self.hit_count = 0
+        self.wait_count = 0
+
+    def start(self):
+        with self.condition:
+            self._refill()
+
+    def stop(self):
+        """Stops sending speculative requests, the running ones finish in the workers.
+        """
+        with self.condition:
+            self.stopped = True
+        LOGGER.debug(self.stats_str())
+
+    def is_exhausted(self, task):
+        return len(self.exhausted_workers[task]) >= self.sampler_pool.num_workers or \
+            self.failures[task] >= self.max_failures or task in self.timed_out
+
+    def _submit(self, task):
+        self.pending[task] += 1
+        self.sampler_pool.submit(task[0], task[1], self._on_output)
+
+    def _refill(self):
+        # called with the condition held
+        if self.stopped:
+            return
+        num_free = self.max_in_flight - sum(self.pending.values())
+        if num_free <= 0:
+            return
+        candidates = [task for task in set(self.request_counts) | set(self.prior_rank) \
+            if not self.is_exhausted(task) and len(self.buffers[task]) + self.pending[task] < self.max_buffered]
+        candidates.sort(key=lambda task: (-self.request_counts[task], self.prior_rank.get(task, len(self.prior_rank))))
+        for task in candidates[:num_free]:
+            self._submit(task)
+
+    def _on_output(self, stream_name, inputs, output, worker_index):
+        task = (stream_name, tuple(inputs))
+        with self.condition:
+            # a timed out instance may have dropped its pending requests
+            self.pending[task] = max(0, self.pending[task] - 1)
+            if output is None:
+                self.failures[task] += 1
+                if worker_index is not None:
+                    self.exhausted_workers[task].add(worker_index)
+            else:
+                self.failures[task] = 0
+                self.exhausted_workers[task].discard(worker_index)
+                self.buffers[task].append(output)
+            self._refill()
+            self.condition.notify_all()
+
+    def get(self, stream_name, inputs):
+        """Next output of the stream instance, None if it is exhausted, timed out or if the pool is closed.
+        """
+        task = (stream_name, tuple(inputs))
+        with self.condition:
+            self.request_counts[task] += 1
+            if self.buffers[task]:
+                self.hit_count += 1
+            else:
+                self.wait_count += 1
+            start_time = time.time()
+            num_outputs = self.failures[task]
+            while not self.buffers[task]:
+                if self.is_exhausted(task) or not self.sampler_pool.is_running():
+                    return None
+                if self.failures[task] != num_outputs:
+                    # an empty output came back, the instance is still progressing
+                    start_time, num_outputs = time.time(), self.failures[task]
+                elif self.timeout is not None and time.time() - start_time > self.timeout:
+                    LOGGER.warning('{}{} gave no output in {:.0f} s, the instance is given up.'.format(stream_name, inputs, self.timeout))
+                    self.timed_out.add(task)
+                    # the requests may be lost, they no longer take a slot of the speculative requests
+                    self.pending[task] = 0
+                    return None
+                # the search waits for this instance, it does not count against the speculative requests
+                if self.pending[task] == 0:
+                    self._submit(task)
+                self.condition.wait(self.poll_interval)
+            output = self.buffers[task].popleft()
+            self._refill()
+            return output
+
+    def stats_str(self):
+        return 'Speculative sampler: {} outputs ready when asked, {} waited for, {} outputs unused.'.format(
+            self.hit_count, self.wait_count, sum(len(buffer) for buffer in self.buffers.values()))
+
+##########################################
+
+def get_speculative_sampler(sampler_pool, instances, options=None):
+    """Starts a speculative sampler on the pool for the stream `instances` [(stream_name, inputs)],
+    the sampler of the previous planning case on the same pool is stopped.
+    """
+    options = options or {}
+    key = id(sampler_pool)
+    if key in _SPECULATIVE_SAMPLERS:
+        _SPECULATIVE_SAMPLERS[key][1].stop()
+    speculative_sampler = SpeculativeSampler(sampler_pool, instances,
+        max_in_flight=options.get('speculative_max_in_flight', None),
+        max_buffered=options.get('speculative_max_buffered', 2),
+        max_failures=options.get('speculative_max_failures', None),
+        timeout=options.get('speculative_timeout', 600.0))
+    _SPECULATIVE_SAMPLERS[key] = (sampler_pool, speculative_sampler)
+    speculative_sampler.start()
+    LOGGER.info('Speculative sampling of {} stream instances with {} workers.'.format(len(instances), sampler_pool.num_workers))
+    return speculative_sampler
+
+
+def get_speculative_gen_fn(speculative_sampler, stream_name):
+    def gen_fn(*inputs):
+        while True:
+            output = speculative_sampler.get(stream_name, inputs)
+            if output is None:
+                LOGGER.debug('{}{} running out of samples in all {} workers'.format(stream_name, inputs, speculative_sampler.sampler_pool.num_workers))
+                return
+            yield output
+    return gen_fn
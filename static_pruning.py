@@ -0,0 +1,203 @@
+import numpy as np
+import pybullet_planning as pp
+
+from integral_timber_joints.planning.robot_setup import BARE_ARM_GROUP, GANTRY_ARM_GROUP
+
+from aabb_tree import AABBTree
+from batch_ik import get_gantry_arm_kinematics
+from beam_obb import local_box
+from process_index import get_process_geometry_index, CLAMP_OPERATIONS
+from utils import LOGGER
+
+##########################################
+
+def _max_distance_to_aabb(point, aabb):
+    # distance from the point to the farthest AABB corner, bounds the distance to any point of the AABB
+    lower, upper = np.array(aabb[0]), np.array(aabb[1])
+    return np.linalg.norm(np.maximum(np.abs(lower - point), np.abs(upper - point)))
+
+
+class RobotEnvelope(object):
+    """Conservative bound of the space occupied by the gantry arm links when the tool is at given points.
+
+    The collision tests only check trajectory points, which are the IK solutions of the movement target poses,
+    so the envelope of a trajectory only depends on its target tool points:
+    - arm links: within `arm_radius` of the tool point, bounded by the lengths of the kinematic chain
+      from each link's joint to the tool and by the link's own extent
+    - gantry links: the gantry joints are prismatic, so each gantry link is an axis-aligned box
+      relative to the arm base (`gantry_link_boxes`, grown over the range of the gantry joints between them),
+      and the arm base is within `base_radius` of the tool point
+    """
+
+    def __init__(self, arm_radius, base_radius, gantry_link_boxes):
+        self.arm_radius = arm_radius
+        self.base_radius = base_radius
+        self.gantry_link_boxes = gantry_link_boxes
+
+    def get_aabbs(self, tool_points, margin=0.0):
+        tool_points = np.array(tool_points)
+        lower, upper = tool_points.min(axis=0), tool_points.max(axis=0)
+        aabbs = [pp.AABB(lower - self.arm_radius - margin, upper + self.arm_radius + margin)]
+        for box_lower, box_upper in self.gantry_link_boxes:
+            aabbs.append(pp.AABB(lower - self.base_radius + box_lower - margin, upper + self.base_radius + box_upper + margin))
+        return aabbs
+
+    def may_collide(self, tool_points, aabb, margin=0.0):
+        """False if no robot link can overlap `aabb` at any of the tool points.
+        """
+        return any(pp.aabb_overlap(envelope_aabb, aabb) for envelope_aabb in self.get_aabbs(tool_points, margin))
+
+
+def get_robot_envelope(client, robot, options=None):
+    """Envelope of the gantry arm links, measured on the pybullet model.
+    Returns None if the gantry is not prismatic (see `batch_ik.extract_gantry_arm_kinematics`).
+    """
+    kinematics = get_gantry_arm_kinematics(client, robot, options)
+    if kinematics is None:
+        return None
+    robot_uid = kinematics['robot_uid']
+    gantry_joints = kinematics['gantry_joints']
+    arm_joints = pp.joints_from_names(robot_uid, robot.get_configurable_joint_names(group=BARE_ARM_GROUP))
+    arm_base_link = pp.link_from_name(robot_uid, robot.get_base_link_name(group=BARE_ARM_GROUP))
+    tool_link = pp.link_from_name(robot_uid, robot.get_end_effector_link_name(group=GANTRY_ARM_GROUP))
+    links = pp.get_moving_links(robot_uid, list(gantry_joints) + list(arm_joints))
+
+    # * distance from the arm base and from each arm joint origin to the tool, along the kinematic chain
+    chain_points = [np.array(pp.get_link_pose(robot_uid, arm_base_link)[0])] + \
+        [np.array(pp.get_link_pose(robot_uid, pp.child_link_from_joint(joint))[0]) for joint in arm_joints] + \
+        [np.array(pp.get_link_pose(robot_uid, tool_link)[0])]
+    segment_lengths = [np.linalg.norm(end - start) for start, end in zip(chain_points[:-1], chain_points[1:])]
+    chain_lengths = np.cumsum(segment_lengths[::-1])[::-1]
+    base_point = chain_points[0]
+
+    # * arm links, around the origin of the last arm joint that moves them
+    arm_moving_links = [set(pp.get_moving_links(robot_uid, [joint])) for joint in arm_joints]
+    arm_radius = 0.0
+    gantry_links = []
+    for link in links:
+        moved_by = [k for k, moving_links in enumerate(arm_moving_links) if link in moving_links]
+        if not moved_by:
+            gantry_links.append(link)
+            continue
+        k = moved_by[-1]
+        arm_radius = max(arm_radius, chain_lengths[k + 1] + _max_distance_to_aabb(chain_points[k + 1], pp.get_aabb(robot_uid, link)))
+
+    # * gantry links, relative to the arm base and grown by the gantry joints that move one but not the other
+    gantry_link_boxes = {link : [np.array(pp.get_aabb(robot_uid, link)[0]) - base_point,
+                                 np.array(pp.get_aabb(robot_uid, link)[1]) - base_point] for link in gantry_links}
+    gantry_values = np.array(pp.get_joint_positions(robot_uid, gantry_joints))
+    for i, joint in enumerate(gantry_joints):
+        moving_links = set(pp.get_moving_links(robot_uid, [joint]))
+        base_direction = kinematics['gantry_directions'][i] if arm_base_link in moving_links else np.zeros(3)
+        for link, (box_lower, box_upper) in gantry_link_boxes.items():
+            link_direction = kinematics['gantry_directions'][i] if link in moving_links else np.zeros(3)
+            for value in [kinematics['gantry_lower_limits'][i], kinematics['gantry_upper_limits'][i]]:
+                shift = (link_direction - base_direction) * (value - gantry_values[i])
+                box_lower[:] = np.minimum(box_lower, box_lower + shift)
+                box_upper[:] = np.maximum(box_upper, box_upper + shift)
+
+    return RobotEnvelope(arm_radius, chain_lengths[0], list(gantry_link_boxes.values()))
+
+##########################################
+
+def _held_object_radius(body, grasp):
+    # bound of the distance from the attachment link origin to any point of the held object
+    box = local_box(body)
+    if box is None:
+        return 0.0
+    center, extents = box
+    return np.linalg.norm(grasp[0]) + np.linalg.norm(center) + np.linalg.norm(extents)
+
+
+def prune_static_collision_facts(client, robot, process, init, options=None):
+    """Removes the `BeamMayCollide` and `ClampTrajMayCollideWithBeam` facts (see `parse_symbolic.process_to_init_goal_collision_pairs`)
+    of the pairs where the robot envelope at the movement target points is disjoint from the assembled beam,
+    and the `ClampsMayCollide` facts of the joint pairs where the robot envelope and the held clamp at the movement
+    target points of a joint are disjoint from the clamps placed at the other joint.
+    The collision test of these pairs always succeeds, so its stream is never instantiated.
+    Disabled with `options['static_pruning']`, the margin is set by `options['static_pruning_margin']`.
+    """
+    options = options or {}
+    if not options.get('static_pruning', True):
+        return init
+    envelope = get_robot_envelope(client, robot, options)
+    if envelope is None:
+        LOGGER.warning('Static pruning: unsupported robot kinematics, all collision pairs are kept.')
+        return init
+    margin = options.get('static_pruning_margin', 0.05)
+
+    index = get_process_geometry_index(client, process, options)
+    beam_aabbs = {}
+    with pp.WorldSaver():
+        for beam_id, beam_body in index.beam_bodies.items():
+            pp.set_pose(beam_body, index.beam_assembled_poses[beam_id])
+            beam_aabbs[beam_id] = pp.get_aabb(beam_body)
+
+    # tool points of the trajectories of each beam and of the clamps at each joint
+    beam_tool_points = {beam_id : [pose[0] for pose in poses] for beam_id, poses in index.beam_target_poses.items()}
+    joint_tool_points = {}
+    for operation in CLAMP_OPERATIONS:
+        for joint_id, poses in index.joint_target_poses[operation].items():
+            joint_tool_points.setdefault(joint_id, []).extend(pose[0] for pose in poses)
+
+    # * the beams close to the envelope of a trajectory are found in the hierarchy of the beam AABBs
+    beam_tree = AABBTree()
+    beam_tree.build(beam_aabbs)
+    # nearby_beams[key] = names of the beams that overlap the envelope at the tool points of the beam or joint `key`
+    nearby_beams = {}
+
+    def may_collide(key, tool_points, otherbeam):
+        if not tool_points or otherbeam not in beam_aabbs:
+            return True
+        if key not in nearby_beams:
+            nearby_beams[key] = {name for aabb in envelope.get_aabbs(tool_points, margin) for name in beam_tree.query(aabb)}
+        return otherbeam in nearby_beams[key]
+
+    # * clamps placed at each joint (any clamp of the joint's type may be placed there)
+    clamp_aabbs = {}
+    held_clamp_radius = 0.0
+    with pp.WorldSaver():
+        for joint_id, pose in index.clamp_at_joint_poses.items():
+            clamp_type = process.assembly.get_joint_attribute(joint_id, 'tool_type')
+            aabbs = []
+            for clamp in process.clamps:
+                if clamp.type_name == clamp_type:
+                    pp.set_pose(index.clamp_bodies[clamp.name], pose)
+                    aabbs.append(pp.get_aabb(index.clamp_bodies[clamp.name]))
+            if aabbs:
+                clamp_aabbs[joint_id] = pp.aabb_union(aabbs)
+    for clamp_body in index.clamp_bodies.values():
+        held_clamp_radius = max(held_clamp_radius, _held_object_radius(clamp_body, index.clamp_grasp))
+
+    def clamps_may_collide(joint_id, otherjoint_id):
+        tool_points = joint_tool_points.get(joint_id)
+        if not tool_points or otherjoint_id not in clamp_aabbs:
+            return True
+        other_aabb = clamp_aabbs[otherjoint_id]
+        if envelope.may_collide(tool_points, other_aabb, margin):
+            return True
+        tool_points = np.array(tool_points)
+        radius = held_clamp_radius + margin
+        return pp.aabb_overlap(pp.AABB(tool_points.min(axis=0) - radius, tool_points.max(axis=0) + radius), other_aabb)
+
+    pruned_facts = set()
+    num_pairs = 0
+    for fact in init:
+        if fact[0] == 'BeamMayCollide':
+            num_pairs += 1
+            _, heldbeam, otherbeam = fact
+            if not may_collide(heldbeam, beam_tool_points.get(heldbeam), otherbeam):
+                pruned_facts.add(fact)
+        elif fact[0] == 'ClampTrajMayCollideWithBeam':
+            num_pairs += 1
+            _, beam1, beam2, otherbeam = fact
+            if not may_collide((beam1, beam2), joint_tool_points.get((beam1, beam2)), otherbeam):
+                pruned_facts.add(fact)
+        elif fact[0] == 'ClampsMayCollide':
+            num_pairs += 1
+            _, beam1, beam2, otherbeam1, otherbeam2 = fact
+            if not clamps_may_collide((beam1, beam2), (otherbeam1, otherbeam2)):
+                pruned_facts.add(fact)
+
+    LOGGER.info('Static pruning: {} of {} collision pairs can never collide.'.format(len(pruned_facts), num_pairs))
+    return [fact for fact in init if fact not in pruned_facts]
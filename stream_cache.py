@@ -0,0 +1,152 @@
+import os
+import json
+import atexit
+import hashlib
+
+from compas.data import DataEncoder, DataDecoder
+
+from load_pddlstream import HERE
+from utils import LOGGER
+
+# Bump this whenever the sampler logic changes in a way that invalidates previously stored trajectories.
+STREAM_CACHE_VERSION = 2
+STREAM_CACHE_DIR = os.path.join(HERE, 'stream_cache')
+
+# Options that change the geometric outcome of the samplers, they are part of the cache key.
+GEOMETRY_OPTION_KEYS = ['reachable_range', 'joint_custom_limits', 'collision_distance_threshold', 'collision_buffer_distance_threshold']
+
+# Cache directories evicted by this process, the eviction runs once when the first cache of a directory is opened
+# and once at exit
+_EVICTED_DIRS = set()
+
+##########################################
+
+def hash_from_data(data):
+    """Stable sha1 hex digest of any json-serializable (or compas Data) object.
+    """
+    data_str = json.dumps(data, cls=DataEncoder, sort_keys=True)
+    return hashlib.sha1(data_str.encode('utf-8')).hexdigest()
+
+
+def get_geometry_hash(process, robot, options=None):
+    """Hash of everything that the sampled trajectories depend on:
+    the process (assembly geometry, tools, environment), the robot model and the geometric options.
+    """
+    options = options or {}
+    geometry_options = {key : options[key] for key in GEOMETRY_OPTION_KEYS if key in options}
+    return hash_from_data([STREAM_CACHE_VERSION, process, robot.model, geometry_options])
+
+##########################################
+
+class StreamCache(object):
+    """Content-addressed on-disk cache of certified stream outputs.
+
+    Each (geometry hash, stream name, stream inputs) key maps to a json lines file holding one output per line,
+    new outputs are appended to it. Stored outputs are yielded before any new sample is generated.
+    Invalidation: the geometry hash covers the process, the robot model, the geometric options and
+    `STREAM_CACHE_VERSION`, so any change to them results in a different key and old entries are never hit.
+    Eviction: when the total size exceeds `max_size_mb`, the least recently used entries are removed,
+    when the first cache of the directory is opened in this process and at exit.
+    """
+
+    def __init__(self, process, robot, options=None, cache_dir=STREAM_CACHE_DIR, max_size_mb=500.0):
+        self.cache_dir = cache_dir
+        self.max_size_bytes = max_size_mb * 1e6
+        self.geometry_hash = get_geometry_hash(process, robot, options)
+        self.hits = 0
+        self.misses = 0
+        if not os.path.exists(self.cache_dir):
+            os.makedirs(self.cache_dir)
+        if self.cache_dir not in _EVICTED_DIRS:
+            _EVICTED_DIRS.add(self.cache_dir)
+            self.evict()
+            atexit.register(self.evict)
+
+    def _key(self, stream_name, inputs):
+        return hash_from_data([self.geometry_hash, stream_name, list(inputs)])
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key + '.jsonl')
+
+    def load(self, stream_name, inputs):
+        """Returns the list of outputs stored for this stream instance, empty if there is none.
+        """
+        path = self._path(self._key(stream_name, inputs))
+        if not os.path.exists(path):
+            return []
+        outputs = []
+        try:
+            with open(path, 'r') as f:
+                for line in f:
+                    try:
+                        outputs.append(json.loads(line, cls=DataDecoder))
+                    except ValueError as e:
+                        # e.g. the last line of a run that was killed while appending
+                        LOGGER.warning('Stream cache entry {} has an unreadable line, skipped: {}'.format(path, e))
+        except OSError as e:
+            LOGGER.warning('Stream cache entry {} is unreadable: {}'.format(path, e))
+            return []
+        # touch the file for LRU eviction
+        os.utime(path, None)
+        return outputs
+
+    def save(self, stream_name, inputs, output):
+        """Appends one output to the stored outputs of this stream instance.
+        """
+        path = self._path(self._key(stream_name, inputs))
+        with open(path, 'a') as f:
+            f.write(json.dumps(output, cls=DataEncoder) + '\n')
+
+    def evict(self):
+        """Removes the least recently used entries until the cache fits in `max_size_mb`.
+        """
+        if not os.path.exists(self.cache_dir):
+            return
+        entries = []
+        for file_name in os.listdir(self.cache_dir):
+            if not file_name.endswith('.jsonl'):
+                continue
+            path = os.path.join(self.cache_dir, file_name)
+            stat = os.stat(path)
+            entries.append((stat.st_mtime, stat.st_size, path))
+        total_size = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total_size <= self.max_size_bytes:
+                break
+            os.remove(path)
+            total_size -= size
+            LOGGER.debug('Stream cache evicted {}'.format(path))
+
+##########################################
+
+def clear_stream_cache(cache_dir=STREAM_CACHE_DIR):
+    """Removes every entry in the cache directory.
+    """
+    if not os.path.exists(cache_dir):
+        return
+    for file_name in os.listdir(cache_dir):
+        # .json entries are left by the previous versions of the cache
+        if file_name.endswith('.jsonl') or file_name.endswith('.json'):
+            os.remove(os.path.join(cache_dir, file_name))
+    LOGGER.info('Stream cache cleared at {}'.format(cache_dir))
+
+
+def get_cached_gen_fn(stream_cache, stream_name, gen_fn):
+    """Wraps a stream generator so that stored outputs are yielded first,
+    then newly generated outputs are yielded and written to the cache.
+    """
+    if stream_cache is None:
+        return gen_fn
+
+    def cached_gen_fn(*inputs):
+        for output in stream_cache.load(stream_name, inputs):
+            stream_cache.hits += 1
+            LOGGER.debug('Stream cache hit for {}{}'.format(stream_name, inputs))
+            yield tuple(output)
+        for output in gen_fn(*inputs):
+            if output is not None:
+                stream_cache.misses += 1
+                stream_cache.save(stream_name, inputs, list(output))
+            yield output
+
+    return cached_gen_fn
@@ -5,7 +5,7 @@ from termcolor import colored
 import pybullet_planning as pp
 from compas_fab.robots import Configuration, Robot, AttachedCollisionMesh, CollisionMesh, JointTrajectory
 from compas_fab_pychoreo.client import PyChoreoClient
-from compas_fab_pychoreo.conversions import pose_from_frame
+from compas_fab_pychoreo.conversions import pose_from_frame, pose_from_transformation
 
 from integral_timber_joints.process import RobotClampAssemblyProcess, RoboticMovement
 from integral_timber_joints.planning.robot_setup import GANTRY_ARM_GROUP
@@ -15,6 +15,8 @@ from integral_timber_joints.assembly import BeamAssemblyMethod
 from integral_timber_joints.process.action import BeamPlacementWithClampsAction, BeamPlacementWithoutClampsAction, AssembleBeamWithScrewdriversAction, RoboticMovement, PlaceClampToStructureAction, PickClampFromStructureAction
 
 from utils import LOGGER
+from broad_phase import BroadPhaseIndex
+from stream_state import StreamStateLayer
 
 def get_sample_fn_plan_motion_for_beam_assembly(client, robot, process, options=None):
     options = options or {}
@@ -100,18 +102,14 @@ def get_sample_fn_plan_motion_for_beam_assembly(client, robot, process, options=
     flange_link_name = process.ROBOT_END_LINK
     touched_robot_links = []
     attached_object_base_link_name = None
+    # the Cartesian planner of the client checks its attached objects, so the heldbeam is still attached to the client
+    state = StreamStateLayer(client, robot, process, options=options)
  
     def sample_fn(beam_id: str, gripper_type: str):
-        with pp.WorldSaver():
-            # Create attachments for the heldbeam
-            client.add_attached_collision_mesh(
-                AttachedCollisionMesh(CollisionMesh(None, beam_id),
-                                      flange_link_name, touch_links=touched_robot_links),
-                options={'robot': robot,
-                         'attached_child_link_name': attached_object_base_link_name,
-                         'parent_link_from_child_link_transformation' : beam_grasps[beam_id],
-                         })
-
+        # Create attachments for the heldbeam, before the state snapshot and removed after it is restored
+        with state.attached_object(beam_id, flange_link_name, beam_grasps[beam_id],
+                touch_links=touched_robot_links, attached_child_link_name=attached_object_base_link_name), \
+                state.saved_state():
             gantry_base_gen_fn = gantry_base_generator(client, robot, target_frames_from_beam_id[beam_id][0], 
                 reachable_range=reachable_range, scale=1.0, options=options)
             trajectory = compute_linear_motion_segements(
@@ -120,11 +118,6 @@ def get_sample_fn_plan_motion_for_beam_assembly(client, robot, process, options=
                 sample_ik_fn, cartesian_move_group, 
                 options)
 
-            # clean up the attached object and ACM
-            client.detach_attached_collision_mesh(beam_id, options={})
-            # if temp_name in client.extra_disabled_collision_links:
-            #     del client.extra_disabled_collision_links[temp_name]
-
         if trajectory is not None:
             return (trajectory,)
 
@@ -180,6 +173,29 @@ def compute_linear_motion_segements(
 
 ##########################################
 
+def get_broad_phase_index(client, robot, process, beam_assembled_frames, options=None):
+    """AABB prefilter of the beams at their assembled position.
+    Returns the index, the robot's flange link and the beam bodies (needed to create attachments).
+    """
+    options = options or {}
+    robot_uid = client.get_robot_pybullet_uid(robot)
+    tool_attach_link = pp.link_from_name(robot_uid, process.ROBOT_END_LINK)
+    gantry_arm_joints = pp.joints_from_names(robot_uid, robot.get_configurable_joint_names(group=GANTRY_ARM_GROUP))
+    gantry_arm_links = pp.get_moving_links(robot_uid, gantry_arm_joints)
+
+    # the collision functions report the pairs closer than the buffer distance, the AABBs are grown at least as much
+    margin = max(options.get('broad_phase_margin', 0.01), options.get('collision_buffer_distance_threshold', 0.0))
+    broad_phase = BroadPhaseIndex(client, robot_uid, gantry_arm_links, margin=margin,
+        memo_size=options.get('traj_memo_size', 1000))
+    beam_bodies = {}
+    with pp.WorldSaver():
+        for beam_id, f_world_from_beam_final in beam_assembled_frames.items():
+            beam_bodies[beam_id] = client._get_bodies('^{}$'.format(beam_id))[0]
+            broad_phase.add_object(beam_id, beam_bodies[beam_id], pose_from_frame(f_world_from_beam_final, scale=1))
+    return broad_phase, tool_attach_link, beam_bodies
+
+##########################################
+
 def get_test_fn_beam_assembly_collision_check(
         client: PyChoreoClient, 
         robot: Robot, 
@@ -214,54 +230,38 @@ def get_test_fn_beam_assembly_collision_check(
 
         beam_grasps[beam_id] = flange_from_beam
 
-    flange_link_name = process.ROBOT_END_LINK
-    touched_robot_links = []
-    attached_object_base_link_name = None
+    diagnosis = options.get('diagnosis', False)
+    # precreated attachments and collision functions, the client's attachments and ACM are not changed
+    state = StreamStateLayer(client, robot, process, beam_grasps=beam_grasps, options=options)
+
+    broad_phase = None
+    if options.get('broad_phase', True):
+        broad_phase, tool_attach_link, beam_bodies = get_broad_phase_index(client, robot, process, beam_assembled_frames, options)
 
     def test_fn(traj, heldbeam: str, otherbeam: str):
         # Returns: AssembleBeamNotInCollision
         # return True
 
+        # * the robot, the heldbeam and the client's attachments never get close to the otherbeam
+        if broad_phase is not None:
+            with state.saved_state():
+                if not broad_phase.may_collide(traj, otherbeam, state.get_attachments(heldbeam)):
+                    LOGGER.debug('Tested beam assembly not in collision (broad phase) held {} - {}'.format(heldbeam, otherbeam))
+                    return True
+
         # set the otherbeam to the assembled position
-        assemble_beam_not_in_collision = False
-        with pp.WorldSaver():
+        with state.saved_state():
             client.set_object_frame('^{}$'.format(otherbeam), beam_assembled_frames[otherbeam])
 
-            # Create attachments for the heldbeam
-            client.add_attached_collision_mesh(
-                AttachedCollisionMesh(CollisionMesh(None, heldbeam),
-                                      flange_link_name, touch_links=touched_robot_links),
-                options={'robot': robot,
-                         'attached_child_link_name': attached_object_base_link_name,
-                         'parent_link_from_child_link_transformation' : beam_grasps[heldbeam],
-                         })
-
             # if there is a joint between the heldbeam and the otherbeam, disable collision checking between them
-            temp_name = '_disable_joint_collision_{}-{}'.format(otherbeam, heldbeam)
+            acm = frozenset()
             if otherbeam in process.assembly.get_already_built_neighbors(heldbeam):
-                otherbeam_bodies = client._get_bodies('^{}'.format(otherbeam))
-                heldbeam_bodies = client._get_bodies('^{}'.format(heldbeam))
-                for parent_body, child_body in product(otherbeam_bodies, heldbeam_bodies):
-                    client.extra_disabled_collision_links[temp_name].add(
-                        ((parent_body, None), (child_body, None))
-                    )
-
-            for conf in traj.points:
-                # check robot and heldbeam collision with the otherbeam using FK
-                # ! this checks a lot more than what we need here
-                # so there are rooms for acceleration, but the code will get more complicated
-                # options['diagnosis'] = True
-                assemble_beam_not_in_collision = not client.check_collisions(robot, conf, options=options)
-                # options['diagnosis'] = False
-
-                if not assemble_beam_not_in_collision:
-                    # early return if collision found
-                    break
-
-            # clean up the attached object and ACM
-            client.detach_attached_collision_mesh(heldbeam, options={})
-            if temp_name in client.extra_disabled_collision_links:
-                del client.extra_disabled_collision_links[temp_name]
+                acm = state.get_acm([(otherbeam, heldbeam)])
+
+            # check robot and heldbeam collision with the otherbeam using FK
+            # ! this checks a lot more than what we need here
+            assemble_beam_not_in_collision = not state.trajectory_in_collision(heldbeam, traj, acm, diagnosis=diagnosis)
+
         if not assemble_beam_not_in_collision:
             LOGGER.debug('Tested beam assembly IN COLLISION held {} - {}'.format(heldbeam, otherbeam))
         else:
@@ -336,20 +336,16 @@ def get_sample_fn_plan_motion_for_clamp(client, robot, process, operation: str,
     flange_link_name = process.ROBOT_END_LINK
     touched_robot_links = []
     attached_object_base_link_name = None
+    # the Cartesian planner of the client checks its attached objects, so the heldclamp is still attached to the client
+    state = StreamStateLayer(client, robot, process, options=options)
  
     def sample_fn(heldclamp: str, clamptype: str, beam1: str, beam2: str):
         # :inputs (?heldclamp ?clamptype ?beam1 ?beam2)
         joint_id = (beam1, beam2)
-        with pp.WorldSaver():
-            # Create attachments for the heldclamp
-            client.add_attached_collision_mesh(
-                AttachedCollisionMesh(CollisionMesh(None, heldclamp),
-                                      flange_link_name, touch_links=touched_robot_links),
-                options={'robot': robot,
-                         'attached_child_link_name': attached_object_base_link_name,
-                         'parent_link_from_child_link_transformation' : clamp_grasp,
-                         })
-
+        # Create attachments for the heldclamp, before the state snapshot and removed after it is restored
+        with state.attached_object(heldclamp, flange_link_name, clamp_grasp,
+                touch_links=touched_robot_links, attached_child_link_name=attached_object_base_link_name), \
+                state.saved_state():
             # * ACM setup
             temp_name = 'clamp_movement_acm'
             # for o1_name, o2_name in .allowed_collision_matrix:
@@ -368,8 +364,7 @@ def get_sample_fn_plan_motion_for_clamp(client, robot, process, operation: str,
                 sample_ik_fn, cartesian_move_group, 
                 options)
 
-            # clean up the attached object and ACM
-            client.detach_attached_collision_mesh(heldclamp, options={})
+            # clean up the ACM
             if temp_name in client.extra_disabled_collision_links:
                 del client.extra_disabled_collision_links[temp_name]
 
@@ -411,59 +406,31 @@ def get_test_fn_clamp_clamp_collision_check(
             f_world_from_clamp.point *= 1e-3
             clamp_at_joint_frames[joint_id] = f_world_from_clamp
 
-    flange_link_name = process.ROBOT_END_LINK
-    touched_robot_links = []
-    attached_object_base_link_name = None
+    diagnosis = options.get('diagnosis', False)
+    # precreated attachments and collision functions, the client's attachments and ACM are not changed
+    state = StreamStateLayer(client, robot, process, clamp_grasp=clamp_grasp, options=options)
 
     def test_fn(heldclamp, beam1, beam2, traj, otherclamp, otherbeam1, otherbeam2, otherclamp_type):
         # :inputs (?heldclamp ?beam1 ?beam2 ?traj ?otherclamp ?otherbeam1 ?otherbeam2 ?otherclamptype)
         # Returns: ClampTrajNotInCollisionWithClamp
         LOGGER.debug('Testing clamp-clamp collision for {}-{}-{}-{}-{}-{}'.format(heldclamp, beam1, beam2, otherclamp, otherbeam1, otherbeam2))
-        return False
-        # return True
 
-        # set the otherbeam to the assembled position
         joint_id = (beam1, beam2)
         otherjoint_id = (otherbeam1, otherbeam2)
-        clamp_traj_not_in_collision_with_clamp = False
-        with pp.WorldSaver():
+        # * the held clamp cannot also be at another joint, and a joint holds a single clamp
+        if otherclamp == heldclamp or otherjoint_id == joint_id:
+            return True
+
+        # set the otherclamp to its pose at the joint
+        with state.saved_state():
             client.set_object_frame('^{}$'.format(otherclamp), clamp_at_joint_frames[otherjoint_id])
 
-            # Create attachments for the heldbeam
-            client.add_attached_collision_mesh(
-                AttachedCollisionMesh(CollisionMesh(None, heldclamp),
-                                      flange_link_name, touch_links=touched_robot_links),
-                options={'robot': robot,
-                         'attached_child_link_name': attached_object_base_link_name,
-                         'parent_link_from_child_link_transformation' : clamp_grasp,
-                         })
+            # the heldclamp touches the tool changer and the beams of its joint
+            acm = state.get_acm([('tool_changer', heldclamp), (joint_id[0], heldclamp), (joint_id[1], heldclamp)])
 
-            # if there is a joint between the heldbeam and the otherbeam, disable collision checking between them
-            temp_name = '_clamp_joint_{}-{}'.format(heldclamp, otherclamp)
-            client.extra_disabled_collision_links[temp_name].update(
-                {
-                    (('tool_changer', None), (heldclamp, None)),
-                    ((joint_id[0], None), (heldclamp, None)),
-                    ((joint_id[1], None), (heldclamp, None)),
-                }
-                )
-
-            for conf in traj.points:
-                # check robot and heldbeam collision with the otherbeam using FK
-                # ! this checks a lot more than what we need here
-                # so there are rooms for acceleration, but the code will get more complicated
-                # options['diagnosis'] = True
-                clamp_traj_not_in_collision_with_clamp = not client.check_collisions(robot, conf, options=options)
-                # options['diagnosis'] = False
-
-                if not clamp_traj_not_in_collision_with_clamp:
-                    # early return if collision found
-                    break
-
-            # clean up the attached object and ACM
-            client.detach_attached_collision_mesh(heldclamp, options={})
-            if temp_name in client.extra_disabled_collision_links:
-                del client.extra_disabled_collision_links[temp_name]
+            # check robot and heldclamp collision with the otherclamp using FK
+            # ! this checks a lot more than what we need here
+            clamp_traj_not_in_collision_with_clamp = not state.trajectory_in_collision(heldclamp, traj, acm, diagnosis=diagnosis)
 
         return clamp_traj_not_in_collision_with_clamp
 
@@ -509,59 +476,43 @@ def get_test_fn_clamp_beam_collision_check(
     for k in range(3):
         clamp_grasp[k,3] *= 1e-3
 
-    flange_link_name = process.ROBOT_END_LINK
-    touched_robot_links = []
-    attached_object_base_link_name = None
+    diagnosis = options.get('diagnosis', False)
+    # precreated attachments and collision functions, the client's attachments and ACM are not changed
+    state = StreamStateLayer(client, robot, process, clamp_grasp=clamp_grasp, options=options)
+
+    broad_phase = None
+    if options.get('broad_phase', True):
+        broad_phase, _, _ = get_broad_phase_index(client, robot, process, beam_assembled_frames, options)
 
     def test_fn(heldclamp, beam1, beam2, traj, otherbeam):
         # (?heldclamp ?beam1 ?beam2 ?traj ?otherbeam)
         # Returns: ClampTrajNotInCollisionWithBeam
         # return True
 
+        # * the robot, the heldclamp and the client's attachments never get close to the otherbeam
+        if broad_phase is not None:
+            with state.saved_state():
+                if not broad_phase.may_collide(traj, otherbeam, state.get_attachments(heldclamp)):
+                    LOGGER.debug('Testing clamp-beam not in collision (broad phase) for held {} at ({},{}) - {}'.format(heldclamp, beam1, beam2, otherbeam))
+                    return True
+
         # set the otherbeam to the assembled position
-        clamp_traj_not_in_collision_with_beam = False
-        with pp.WorldSaver():
+        with state.saved_state():
             client.set_object_frame('^{}$'.format(otherbeam), beam_assembled_frames[otherbeam])
 
-            # Create attachments for the heldbeam
-            client.add_attached_collision_mesh(
-                AttachedCollisionMesh(CollisionMesh(None, heldclamp),
-                                      flange_link_name, touch_links=touched_robot_links),
-                options={'robot': robot,
-                         'attached_child_link_name': attached_object_base_link_name,
-                         'parent_link_from_child_link_transformation' : clamp_grasp,
-                         })
-
-            temp_name = 'clamp_beam_{}-{}'.format(heldclamp, otherbeam)
+            # the heldclamp touches the beams of its joint
+            acm = frozenset()
             if otherbeam == beam1 or otherbeam == beam2:
-                otherbeam_bodies = client._get_bodies('^{}'.format(otherbeam))
-                heldclamp_bodies = client._get_bodies('^{}'.format(heldclamp))
-                for parent_body, child_body in product(otherbeam_bodies, heldclamp_bodies):
-                    client.extra_disabled_collision_links[temp_name].add(
-                        ((parent_body, None), (child_body, None))
-                    )
-
-            for conf in traj.points:
-                # check robot and heldbeam collision with the otherbeam using FK
-                # ! this checks a lot more than what we need here
-                # so there are rooms for acceleration, but the code will get more complicated
-                # options['diagnosis'] = True
-                clamp_traj_not_in_collision_with_beam = not client.check_collisions(robot, conf, options=options)
-                # options['diagnosis'] = False
-
-                if not clamp_traj_not_in_collision_with_beam:
-                    # early return if collision found
-                    break
+                acm = state.get_acm([(otherbeam, heldclamp)])
+
+            # check robot and heldclamp collision with the otherbeam using FK
+            # ! this checks a lot more than what we need here
+            clamp_traj_not_in_collision_with_beam = not state.trajectory_in_collision(heldclamp, traj, acm, diagnosis=diagnosis)
 
             # if not clamp_traj_not_in_collision_with_beam:
             #     LOGGER.debug('Testing clamp-beam IN COLLISION for held {} at ({},{}) - {}'.format(heldclamp, beam1, beam2, otherbeam))
             #     pp.wait_if_gui()
 
-            # clean up the attached object and ACM
-            client.detach_attached_collision_mesh(heldclamp, options={})
-            if temp_name in client.extra_disabled_collision_links:
-                del client.extra_disabled_collision_links[temp_name]
-
         if not clamp_traj_not_in_collision_with_beam:
             LOGGER.debug('Testing clamp-beam IN COLLISION for held {} at ({},{}) - {}'.format(heldclamp, beam1, beam2, otherbeam))
         else:
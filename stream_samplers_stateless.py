@@ -1,7 +1,9 @@
+import time
 from collections import defaultdict
 from itertools import product
 from termcolor import colored
 
+import numpy as np
 import pybullet_planning as pp
 from compas_fab.robots import Configuration, Robot, AttachedCollisionMesh, CollisionMesh, JointTrajectory, JointTrajectoryPoint, Duration
 from compas_fab_pychoreo.client import PyChoreoClient
@@ -15,88 +17,54 @@ from integral_timber_joints.planning.stream import _get_sample_bare_arm_ik_fn
 from integral_timber_joints.assembly import BeamAssemblyMethod
 from integral_timber_joints.process.action import BeamPlacementWithClampsAction, BeamPlacementWithoutClampsAction, AssembleBeamWithScrewdriversAction, RoboticMovement, PlaceClampToStructureAction, PickClampFromStructureAction
 
-from utils import LOGGER
-
-def get_sample_fn_plan_motion_for_beam_assembly_stateless(client, robot, process, options=None):
+from utils import LOGGER, TrajectoryMemo
+from broad_phase import BroadPhaseIndex
+from beam_obb import BeamOBBChecker
+from batch_ik import get_batch_ik_fn, gantry_ik_gen
+from reachability_map import get_reachability_map
+from experience_sampler import get_gantry_experience
+from instrumentation import PROFILER
+from cartesian_cache import CartesianPathCache
+from trajectory import CompactTrajectory, replay_trajectory
+from process_index import get_process_geometry_index
+from collision_geometry import get_link_pair_collision_fns
+from fk_cache import get_fk_cache
+from path_sanity import get_path_sanity_fn
+from self_collision import get_disabled_self_collisions
+
+def get_gen_fn_plan_motion_for_beam_assembly_stateless(client, robot, process, options=None):
     options = options or {}
 
-    # Precompute and cache all target frames for each beam's assembly action
-    gripper_names_from_type = defaultdict(list)
-    for gripper in process.grippers:
-        if gripper.type_name:
-            gripper_names_from_type[gripper.type_name].append(gripper.name)
-    for screwdriver in process.screwdrivers:
-        if screwdriver.type_name:
-            gripper_names_from_type[screwdriver.type_name].append(screwdriver.name)
-
-    toolchanger = process.robot_toolchanger
-    flange_from_toolchanger_base = toolchanger.t_t0cf_from_tcf
+    # target frames, grasps and bodies of each beam, shared by all stream factories
+    index = get_process_geometry_index(client, process, options)
+    beam_target_poses = index.beam_target_poses
+    beam_grasps = index.beam_grasps
+    beam_bodies = index.beam_bodies
+
     gantry_attempts = options.get('gantry_attempts', 500) #int(1e8)
     reachable_range = options.get('reachable_range', (0.2, 2.4))
 
-    beam_target_poses = defaultdict(list)
-    beam_grasps = {}
-    beam_bodies = {}
     beam_gantry_sampler = {}
-    for i, beam_id in enumerate(process.assembly.sequence):
-        #  Skip scaffolding elements
-        if process.assembly.get_assembly_method(beam_id) == BeamAssemblyMethod.MANUAL_ASSEMBLY:
-            continue
-
-        gripper_type = process.assembly.get_beam_attribute(
-            beam_id, "gripper_type")
-        assert gripper_type in gripper_names_from_type
-        # randomly assign one suitable gripper to each beam just for sampling purposes
-        gripper_id = gripper_names_from_type[gripper_type][0]
-
-        if process.assembly.get_assembly_method(beam_id) == BeamAssemblyMethod.GROUND_CONTACT:
-            action = BeamPlacementWithoutClampsAction(beam_id=beam_id, gripper_id=gripper_id)
-
-        elif process.assembly.get_assembly_method(beam_id) == BeamAssemblyMethod.CLAMPED:
-            # we can leave joint_ids and clamp_ids empty beacuse we don't need ACM here
-            action = BeamPlacementWithClampsAction(beam_id=beam_id, joint_ids=[], gripper_id=gripper_id, clamp_ids=[])
-
-        elif (process.assembly.get_assembly_method(beam_id) == BeamAssemblyMethod.SCREWED_WITH_GRIPPER or \
-              process.assembly.get_assembly_method(beam_id) == BeamAssemblyMethod.SCREWED_WITHOUT_GRIPPER):
-            # we can leave joint_ids and clamp_ids empty beacuse we don't need ACM here
-            action = AssembleBeamWithScrewdriversAction(beam_id=beam_id, joint_ids=[], gripper_id=gripper_id, screwdriver_ids=[])
-
-        else:
-            continue
-
-        # * compute movements from action
-        action.create_movements(process)
-        for movement in action.movements:
-            # * trigger state diff computation
-            movement.create_state_diff(process)
-
-            # * skip non-robotic movements for IK computation
-            if not isinstance(movement, RoboticMovement):
-               continue
-
-            # * skip if there exists a taught conf
-            if movement.target_configuration is not None:
-                continue
-
-            if movement.target_frame is None:
-                LOGGER.error(f'Target frame is None in {movement.short_summary}')
-
-            beam_target_poses[beam_id].append(pose_from_frame(movement.target_frame, scale=1e-3))
-
-        # * Cache all grasp transformations
-        t_gripper_tcf_from_beam = process.assembly.get_t_gripper_tcf_from_beam(beam_id)
-        beam_gripper_id = process.assembly.get_beam_attribute(beam_id, "gripper_id")
-        beam_gripper = process.tool(beam_gripper_id)
-        flange_from_beam = flange_from_toolchanger_base * beam_gripper.t_t0cf_from_tcf * t_gripper_tcf_from_beam
-        # scale the translation part of the transformation to meter
-        for k in range(3):
-            flange_from_beam[k,3] *= 1e-3
-        beam_grasps[beam_id] = pose_from_transformation(flange_from_beam)
-        beam_bodies[beam_id] = client._get_bodies('^{}$'.format(beam_id))[0]
-
+    reachability_map = get_reachability_map(client, robot, options)
+    reachability_exploration = options.get('reachability_exploration', 0.3)
+    # (index, count) of the parallel sampling worker, see `parallel_sampler`
+    sample_slice = options.get('sample_slice', (0, 1))
+    gantry_experience = get_gantry_experience(client, robot, options)
+    experience_exploration = options.get('experience_exploration', 0.3)
+    for beam_id in beam_target_poses:
         beam_gantry_sampler[beam_id] = gantry_base_generator(client, robot, frame_from_pose(beam_target_poses[beam_id][0]), reachable_range=reachable_range, scale=1.0, options=options)
+        if reachability_map is not None:
+            beam_gantry_sampler[beam_id] = reachability_map.gantry_sampler(beam_target_poses[beam_id][0], beam_gantry_sampler[beam_id],
+                reachable_range=reachable_range, exploration=reachability_exploration, sample_slice=sample_slice)
+        if gantry_experience is not None:
+            beam_gantry_sampler[beam_id] = gantry_experience.gantry_sampler(beam_target_poses[beam_id][0], beam_gantry_sampler[beam_id], exploration=experience_exploration)
+
+    if reachability_map is not None:
+        reachability_map.save()
 
     arm_sample_ik_fn = _get_sample_bare_arm_ik_fn(client, robot)
+    batch_ik_fn = get_batch_ik_fn(client, robot, options) if options.get('batch_ik', True) else None
+    ik_batch_size = options.get('ik_batch_size', 50)
     gantry_arm_joint_names = robot.get_configurable_joint_names(group=GANTRY_ARM_GROUP)
     gantry_arm_joint_types = robot.get_joint_types_by_names(gantry_arm_joint_names)
 
@@ -111,9 +79,7 @@ def get_sample_fn_plan_motion_for_beam_assembly_stateless(client, robot, process
     tool_link_name = robot.get_end_effector_link_name(group=cartesian_move_group)
     tool_link = pp.link_from_name(robot_uid, tool_link_name)
 
-    static_obstacles = [] 
-    for env_name in process.environment_models:
-        static_obstacles.extend(client._get_bodies('^{}$'.format(env_name)))
+    static_obstacles = index.static_obstacles
 
     joint_custom_limits = options.get('joint_custom_limits', {})
     pb_custom_limits = {pp.joint_from_name(robot_uid, jn) : lims \
@@ -125,10 +91,14 @@ def get_sample_fn_plan_motion_for_beam_assembly_stateless(client, robot, process
     body_name_from_id=client._name_from_body_id
     gantry_arm_joints = pp.joints_from_names(robot_uid, gantry_arm_joint_names)
     gantry_arm_links = pp.get_moving_links(robot_uid, gantry_arm_joints)
+    # * checked on the simplified collision geometry first, if the world has some
+    any_link_pair_collision, pairwise_collision = get_link_pair_collision_fns(client)
+    # * link poses of the certified trajectories, shared by all the tests of a trajectory
+    fk_cache = get_fk_cache(client, robot_uid, gantry_arm_links, options)
     robot_env_collision_fn = pp.get_collision_fn(robot_uid, gantry_arm_joints, obstacles=static_obstacles,
                                     attachments=[], 
                                     self_collisions=True,
-                                    disabled_collisions=client.get_self_collision_link_ids(robot), # get disabled self-collision links (srdf)
+                                    disabled_collisions=get_disabled_self_collisions(client, robot, options), # srdf and never colliding links (see self_collision.py)
                                     # extra_disabled_collisions=extra_disabled_collisions,
                                     custom_limits=pb_custom_limits,
                                     body_name_from_id=body_name_from_id,
@@ -137,18 +107,59 @@ def get_sample_fn_plan_motion_for_beam_assembly_stateless(client, robot, process
     diagnosis = options.get('diagnosis', False)
     # diagnosis = True 
 
-    def traj_sampler_fn(heldbeam: str, gripper_type: str):
+    # optional callable that returns True when the sampling should be abandoned (e.g. another worker succeeded)
+    cancel_fn = options.get('cancel_fn', None)
+
+    # * Cartesian paths memoized by target poses and quantized start configuration, off by default:
+    # the gantry and IK samples rarely repeat a start configuration
+    cartesian_cache = None
+    if options.get('cartesian_cache', False):
+        cartesian_cache = CartesianPathCache(max_entries=options.get('cartesian_cache_size', 10000),
+            resolution=options.get('cartesian_cache_resolution', 1e-3))
+
+    path_sanity_fn = get_path_sanity_fn(robot_uid, gantry_arm_joints, gantry_arm_joint_names, pb_custom_limits, options)
+
+    def path_in_collision_fn(attachment, conf_vals):
+        # check collisions for each conf in the path
+        for conf_val in conf_vals:
+            if robot_env_collision_fn(conf_val, diagnosis=diagnosis):
+                return True
+            # check collisions between robot and the attached object
+            attachment.assign()
+            if any_link_pair_collision(robot_uid, gantry_arm_links, attachment.child):
+                return True
+        return False
+
+    def plan_cartesian_fn(start_conf_value, target_poses):
+        def plan_fn(poses):
+            return plan_cartesian_motion_from_links(robot_uid, selected_links, tool_link,
+                poses, custom_limits=pb_custom_limits, get_sub_conf=True, options=options)
+        if cartesian_cache is None:
+            return plan_fn(target_poses)
+        return cartesian_cache.plan(plan_fn, robot_uid, gantry_arm_joints, start_conf_value, target_poses)
+
+    def traj_gen_fn(heldbeam: str, gripper_type: str):
+        # yields one trajectory per call, the gantry and IK iteration resumes where it stopped on the next call
         # plan a motion to follow the target frames for inserting beam_id
         # while ensuring there is no collision between
         # - robot self collisions
         # - robot and the heldbeam
 
+        stream_name = 'plan_motion_for_beam_assembly'
         # Create attachments for the heldbeam
         attachment = pp.Attachment(robot_uid, tool_attach_link, beam_grasps[heldbeam], beam_bodies[heldbeam])
 
-        for gantry_iter, base_conf in zip(range(gantry_attempts), beam_gantry_sampler[heldbeam]):
-            # * bare-arm IK sampler
-            arm_conf_vals = arm_sample_ik_fn(beam_target_poses[heldbeam][0])
+        # * bare-arm IK for each gantry sample
+        ik_gen = gantry_ik_gen(beam_gantry_sampler[heldbeam], gantry_attempts, beam_target_poses[heldbeam][0],
+            arm_sample_ik_fn, batch_ik_fn, ik_batch_size)
+        for gantry_iter, base_conf, arm_conf_vals in PROFILER.timed_iter(stream_name, 'gantry_ik', ik_gen):
+            if cancel_fn is not None and cancel_fn():
+                # no output for this call, the next call continues from this gantry sample
+                LOGGER.debug(f'Assembly plan {heldbeam} cancelled after {gantry_iter} gantry iters.')
+                yield None
+
+            if not arm_conf_vals:
+                PROFILER.count_rejection(stream_name, 'no_ik')
 
             # * iterate through all 6-axis IK solution
             for arm_conf_val in arm_conf_vals:
@@ -159,62 +170,69 @@ def get_sample_fn_plan_motion_for_beam_assembly_stateless(client, robot, process
                 # check collisions for this starting configuration among
                 #     - robot self-collision 
                 #     - between (robot links) and obstacles
-                if robot_env_collision_fn(start_conf_value, diagnosis=diagnosis):
+                with PROFILER.stage(stream_name, 'env_collision'):
+                    in_collision = robot_env_collision_fn(start_conf_value, diagnosis=diagnosis)
+                if in_collision:
                     # LOGGER.debug(f'Cartesian plan {heldbeam}: robot env collision.')
+                    PROFILER.count_rejection(stream_name, 'env_collision')
                     continue
                     # break
 
                 # check collisions between robot and the attached beam
-                attachment.assign()
-                if pp.any_link_pair_collision(robot_uid, gantry_arm_links, attachment.child):
+                with PROFILER.stage(stream_name, 'attachment_collision'):
+                    attachment.assign()
+                    in_collision = any_link_pair_collision(robot_uid, gantry_arm_links, attachment.child)
+                if in_collision:
                     # LOGGER.debug(f'Cartesian plan {heldbeam}: robot beam collision.')
+                    PROFILER.count_rejection(stream_name, 'attachment_collision')
                     if diagnosis:
                         cr = pp.any_link_pair_collision_info(robot_uid, gantry_arm_links, attachment.child)
                         pp.draw_collision_diagnosis(cr, body_name_from_id=body_name_from_id)
                     continue
                     # break
 
-                path = plan_cartesian_motion_from_links(robot_uid, selected_links, tool_link,
-                    beam_target_poses[heldbeam], custom_limits=pb_custom_limits, get_sub_conf=True, options=options)
+                with PROFILER.stage(stream_name, 'cartesian_plan'):
+                    path = plan_cartesian_fn(start_conf_value, beam_target_poses[heldbeam])
 
                 if path is None:
                     LOGGER.debug(f'Assembly plan {heldbeam}: no path found.')
+                    PROFILER.count_rejection(stream_name, 'no_cartesian_path')
+                    continue
+
+                # reject joint flips, limit violations and detours before any collision check
+                with PROFILER.stage(stream_name, 'path_sanity'):
+                    rejection = path_sanity_fn(path)
+                if rejection is not None:
+                    PROFILER.count_rejection(stream_name, rejection)
                     continue
 
                 # check collisions for each conf in the path
-                path_in_collisions = False
-                for conf_val in path[1:]:
-                    if robot_env_collision_fn(conf_val, diagnosis=diagnosis):
-                        path_in_collisions = True
-                        break
-                    # check collisions between robot and the attached beam
-                    attachment.assign()
-                    if pp.any_link_pair_collision(robot_uid, gantry_arm_links, attachment.child):
-                        path_in_collisions = True
-                        break
-                    # TODO joint flip check
+                with PROFILER.stage(stream_name, 'path_collision'):
+                    path_in_collisions = path_in_collision_fn(attachment, path[1:])
 
                 if path_in_collisions:
                     LOGGER.debug(f'Assembly plan {heldbeam} path collision.')
+                    PROFILER.count_rejection(stream_name, 'path_collision')
                     continue
                 else:
-                    # convert path to trajectory
-                    jt_traj_pts = []
-                    for i, arm_conf_value in enumerate(path):
-                        jt_traj_pt = JointTrajectoryPoint(joint_values=arm_conf_value, joint_names=gantry_arm_joint_names, joint_types=gantry_arm_joint_types)
-                        jt_traj_pt.time_from_start = Duration(i*1,0)
-                        jt_traj_pts.append(jt_traj_pt)
-                    trajectory = JointTrajectory(trajectory_points=jt_traj_pts,
-                        joint_names=jt_traj_pts[0].joint_names, start_configuration=jt_traj_pts[0], fraction=1.0)
+                    # convert path to trajectory, the compas JointTrajectory is only created when the plan is saved
+                    trajectory = CompactTrajectory(path, gantry_arm_joint_names, gantry_arm_joint_types)
                     LOGGER.debug(f'Assembly plan {heldbeam} sample found after {gantry_iter} gantry iters.')
+                    PROFILER.record_gantry_iters(stream_name, gantry_iter + 1)
+                    if gantry_experience is not None:
+                        gantry_experience.record(beam_target_poses[heldbeam][0], base_conf)
+                    if fk_cache is not None:
+                        fk_cache.add(trajectory)
+
+                    yield (trajectory,)
 
-                    # yield (trajectory,)
-                    return (trajectory,)
-        else:
-            # LOGGER.debug(f'Cartesian plan running out of samples {gantry_iter}')
-            raise ValueError(f'Assembly plan running out of samples {gantry_iter}')
+        LOGGER.debug(f'Assembly plan {heldbeam} running out of samples.')
+        if cartesian_cache is not None:
+            LOGGER.debug(cartesian_cache.stats_str())
+        if fk_cache is not None:
+            LOGGER.debug(fk_cache.stats_str())
 
-    return traj_sampler_fn
+    return traj_gen_fn
 
 ##########################################
 
@@ -227,72 +245,92 @@ def get_test_fn_beam_assembly_collision_check_stateless(
     # - robot    and the otherbeam
     options = options or {}
 
-    toolchanger = process.robot_toolchanger
-    flange_from_toolchanger_base = toolchanger.t_t0cf_from_tcf
-    beam_assembled_poses = {}
-    beam_grasps = {}
-    beam_bodies = {}
-    beam_neighbours = {}
-    for beam_id in process.assembly.sequence:
-        # Skip scaffolding elements
-        if process.assembly.get_assembly_method(beam_id) == BeamAssemblyMethod.MANUAL_ASSEMBLY:
-            continue
-
-        # Cache all beam's frame at asssembled position
-        beam_assembled_poses[beam_id] = pose_from_frame(process.assembly.get_beam_attribute(beam_id, 'assembly_wcf_final'), scale=1e-3)
-
-        # Cache all grasp transformations
-        t_gripper_tcf_from_beam = process.assembly.get_t_gripper_tcf_from_beam(beam_id)
-        beam_gripper_id = process.assembly.get_beam_attribute(beam_id, "gripper_id")
-        beam_gripper = process.tool(beam_gripper_id)
-        flange_from_beam = flange_from_toolchanger_base * beam_gripper.t_t0cf_from_tcf * t_gripper_tcf_from_beam
-        # scale the translation part of the transformation to meter
-        for k in range(3):
-            flange_from_beam[k,3] *= 1e-3
-
-        beam_grasps[beam_id] = pose_from_transformation(flange_from_beam)
-        beam_bodies[beam_id] = client._get_bodies('^{}$'.format(beam_id))[0]
-        beam_neighbours[beam_id] = process.assembly.get_already_built_neighbors(beam_id)
+    index = get_process_geometry_index(client, process, options)
+    beam_assembled_poses = index.beam_assembled_poses
+    beam_bodies = index.beam_bodies
 
     robot_uid = client.get_robot_pybullet_uid(robot)
     body_name_from_id=client._name_from_body_id
     gantry_arm_joint_names = robot.get_configurable_joint_names(group=GANTRY_ARM_GROUP)
     gantry_arm_joints = pp.joints_from_names(robot_uid, gantry_arm_joint_names)
     gantry_arm_links = pp.get_moving_links(robot_uid, gantry_arm_joints)
+    # * checked on the simplified collision geometry first, if the world has some
+    any_link_pair_collision, pairwise_collision = get_link_pair_collision_fns(client)
+    # * link poses of the certified trajectories, shared by all the tests of a trajectory
+    fk_cache = get_fk_cache(client, robot_uid, gantry_arm_links, options)
 
     diagnosis = options.get('diagnosis', False)
 
+    # * AABB prefilter of the assembled beams
+    broad_phase = None
+    if options.get('broad_phase', True):
+        broad_phase = BroadPhaseIndex(client, robot_uid, gantry_arm_links, margin=options.get('broad_phase_margin', 0.01), fk_cache=fk_cache,
+            memo_size=options.get('traj_memo_size', 1000))
+        for beam_id, beam_body in beam_bodies.items():
+            broad_phase.add_object(beam_id, beam_body, beam_assembled_poses[beam_id])
+
+    # * analytic OBB test of the robot links against the assembled beams, pybullet only checks the overlapping points
+    obb_checker = None
+    if options.get('beam_obb', True):
+        obb_checker = BeamOBBChecker(client, robot_uid, gantry_arm_links, margin=options.get('beam_obb_margin', 0.01), fk_cache=fk_cache,
+            memo_size=options.get('traj_memo_size', 1000))
+        for beam_id, beam_body in beam_bodies.items():
+            obb_checker.add_beam(beam_id, beam_body, beam_assembled_poses[beam_id])
+
+    # * Collision results are memoized per trajectory, for the `traj_memo_size` most recently tested trajectories.
+    # traj_collision_cache[traj] = {otherbeam : not_in_collision}
+    traj_collision_cache = TrajectoryMemo(options.get('traj_memo_size', 1000))
+
+    def batch_check_fn(traj):
+        # Replay the trajectory once and check every beam (at assembled position) at each configuration.
+        # Beams that are found in collision are dropped from the remaining checks.
+        remaining_beams = list(beam_bodies.keys())
+        if broad_phase is not None:
+            # beams outside the swept volume of the trajectory cannot collide with it
+            candidates = set(broad_phase.get_candidates(traj))
+            remaining_beams = [beam_id for beam_id in remaining_beams if beam_id in candidates]
+        # ambiguous_from_beam[beam_id] = bool array of the points where a robot link box overlaps the beam box
+        ambiguous_from_beam = None
+        point_indices = None
+        if obb_checker is not None and remaining_beams:
+            ambiguous = obb_checker.get_ambiguous_points(traj, remaining_beams)
+            ambiguous_from_beam = {beam_id : ambiguous[:, k] for k, beam_id in enumerate(remaining_beams)}
+            remaining_beams = [beam_id for beam_id in remaining_beams if ambiguous_from_beam[beam_id].any()]
+            point_indices = np.flatnonzero(ambiguous.any(axis=1))
+        for beam_id in remaining_beams:
+            pp.set_pose(beam_bodies[beam_id], beam_assembled_poses[beam_id])
+
+        colliding_beams = set()
+        for i in replay_trajectory(client, robot_uid, traj, point_indices):
+            for beam_id in remaining_beams:
+                if ambiguous_from_beam is not None and not ambiguous_from_beam[beam_id][i]:
+                    continue
+                # * check between robot body and the otherbeam
+                if any_link_pair_collision(robot_uid, gantry_arm_links, beam_bodies[beam_id]):
+                    if diagnosis:
+                        cr = pp.any_link_pair_collision_info(robot_uid, gantry_arm_links, beam_bodies[beam_id])
+                        pp.draw_collision_diagnosis(cr, body_name_from_id=body_name_from_id)
+                    colliding_beams.add(beam_id)
+            remaining_beams = [beam_id for beam_id in remaining_beams if beam_id not in colliding_beams]
+            if not remaining_beams:
+                break
+
+        return {beam_id : beam_id not in colliding_beams for beam_id in beam_bodies}
+
     def test_fn(traj, heldbeam: str, otherbeam: str):
         # Returns: AssembleBeamNotInCollision
         LOGGER.debug("Entering fn: get_test_fn_beam_assembly_collision_check_stateless")
 
-        assemble_beam_not_in_collision = True
-        heldbeam_body = beam_bodies[heldbeam]
-        otherbeam_body = beam_bodies[otherbeam]
+        if traj not in traj_collision_cache:
+            with PROFILER.stage('beam_assembly_collision_check', 'batch_check'):
+                traj_collision_cache[traj] = batch_check_fn(traj)
+        not_in_collision_from_beam = traj_collision_cache[traj]
+        assemble_beam_not_in_collision = not_in_collision_from_beam[otherbeam]
 
-        # set the otherbeam to the assembled position
-        pp.set_pose(otherbeam_body, beam_assembled_poses[otherbeam])
-        # attachment = pp.Attachment(robot_uid, tool_attach_link, beam_grasps[heldbeam], heldbeam_body)
+        # * check between the heldbeam and the otherbeam
         # ignore_beambeam_collisions = otherbeam in beam_neighbours[heldbeam]
-
-        for conf in traj.points:
-            client._set_body_configuration(robot_uid, conf)
-            # attachment.assign()
-
-            # * check between robot body and the otherbeam
-            if pp.any_link_pair_collision(robot_uid, gantry_arm_links, otherbeam_body):
-                # LOGGER.debug(f'Assembly {heldbeam} colliding with {otherbeam}')
-                if diagnosis:
-                # if True:
-                    cr = pp.any_link_pair_collision_info(robot_uid, gantry_arm_links, otherbeam_body)
-                    pp.draw_collision_diagnosis(cr, body_name_from_id=body_name_from_id)
-                assemble_beam_not_in_collision = False
-                break
-
-            # * check between the heldbeam and the otherbeam
-            # if not ignore_beambeam_collisions and pp.pairwise_collision(attachment.child, otherbeam_body):
-            #     assemble_beam_not_in_collision = False
-            #     break
+        # if not ignore_beambeam_collisions and pp.pairwise_collision(attachment.child, otherbeam_body):
+        #     assemble_beam_not_in_collision = False
 
         if not assemble_beam_not_in_collision:
             LOGGER.debug('Tested beam assembly IN COLLISION held {} - {} for {}'.format(heldbeam, otherbeam, traj))
@@ -305,65 +343,47 @@ def get_test_fn_beam_assembly_collision_check_stateless(
 
 ##########################################
 
-def get_sample_fn_plan_motion_for_clamp_stateless(client, robot, process, operation: str, options=None):
+def get_gen_fn_plan_motion_for_clamp_stateless(client, robot, process, operation: str, options=None):
     options = options or {}
 
-    # Precompute and cache all target frames for each clamp's attach action
-    toolchanger = process.robot_toolchanger
+    if operation not in ['attach', 'detach']:
+        raise ValueError('operation must be either attach or detach')
+
+    # target frames of each clamp's attach / detach action, grasps and bodies, shared by all stream factories
+    index = get_process_geometry_index(client, process, options)
+    joint_target_poses = index.joint_target_poses[operation]
+    clamp_grasp = index.clamp_grasp
+    clamp_bodies = index.clamp_bodies
 
-    # all clamp use the same grasp transformation from the tool changer
-    clamp_grasp = pose_from_transformation(toolchanger.t_t0cf_from_tcf, scale=1e-3)
+    # * trajectories of the opposite operation are reversed when the target poses mirror each other
+    other_operation = 'detach' if operation == 'attach' else 'attach'
+    reverse_trajectories = options.get('reverse_clamp_trajectories', True)
+    certified_trajectories = index.certified_clamp_trajectories
 
     gantry_attempts = options.get('gantry_attempts', int(1e8))
     reachable_range = options.get('reachable_range', (0.2, 2.4))
 
-    joint_target_poses = defaultdict(list)
     joint_gantry_sampler = {}
-    for i, beam_id in enumerate(process.assembly.sequence):
-        #  Skip non clamped elements
-        if process.assembly.get_assembly_method(beam_id) != BeamAssemblyMethod.CLAMPED:
-            continue
-
-        #  Iterate through the joints
-        for neighbor_id in process.assembly.get_already_built_neighbors(beam_id):
-            joint_id = (neighbor_id, beam_id)
-            joint_clamp_type = process.assembly.get_joint_attribute(joint_id, 'tool_type')
-            # any tool_id assignment is fine here as long as the tool_type is correct
-            tool_id = process.assembly.get_joint_attribute(joint_id, 'tool_id')
-
-            if operation == 'attach':
-                action = PlaceClampToStructureAction(joint_id=joint_id, tool_type=joint_clamp_type, tool_id=tool_id)
-            elif operation == 'detach':
-                action = PickClampFromStructureAction(joint_id=joint_id, tool_type=joint_clamp_type, tool_id=tool_id)
-            else:
-                raise ValueError('operation must be either attach or detach')
-
-            # * compute movements from action
-            action.create_movements(process)
-            for movement in action.movements:
-                # * trigger state diff computation
-                movement.create_state_diff(process)
-
-                # * skip non-robotic movements for IK computation
-                if not isinstance(movement, RoboticMovement):
-                   continue
-
-                # * skip if there exists a taught conf
-                if movement.target_configuration is not None:
-                    continue
-
-                if movement.target_frame is None:
-                    LOGGER.error(f'Target frame is None in {movement.short_summary}')
-
-                joint_target_poses[joint_id].append(pose_from_frame(movement.target_frame, scale=1e-3))
-
-            joint_gantry_sampler[joint_id] = gantry_base_generator(client, robot, frame_from_pose(joint_target_poses[joint_id][0]), reachable_range=reachable_range, scale=1.0, options=options)
-
-    clamp_bodies = {}
-    for clamp in process.clamps:
-        clamp_bodies[clamp.name] = client._get_bodies('^{}$'.format(clamp.name))[0]
+    reachability_map = get_reachability_map(client, robot, options)
+    reachability_exploration = options.get('reachability_exploration', 0.3)
+    # (index, count) of the parallel sampling worker, see `parallel_sampler`
+    sample_slice = options.get('sample_slice', (0, 1))
+    gantry_experience = get_gantry_experience(client, robot, options)
+    experience_exploration = options.get('experience_exploration', 0.3)
+    for joint_id in joint_target_poses:
+        joint_gantry_sampler[joint_id] = gantry_base_generator(client, robot, frame_from_pose(joint_target_poses[joint_id][0]), reachable_range=reachable_range, scale=1.0, options=options)
+        if reachability_map is not None:
+            joint_gantry_sampler[joint_id] = reachability_map.gantry_sampler(joint_target_poses[joint_id][0], joint_gantry_sampler[joint_id],
+                reachable_range=reachable_range, exploration=reachability_exploration, sample_slice=sample_slice)
+        if gantry_experience is not None:
+            joint_gantry_sampler[joint_id] = gantry_experience.gantry_sampler(joint_target_poses[joint_id][0], joint_gantry_sampler[joint_id], exploration=experience_exploration)
+
+    if reachability_map is not None:
+        reachability_map.save()
 
     arm_sample_ik_fn = _get_sample_bare_arm_ik_fn(client, robot)
+    batch_ik_fn = get_batch_ik_fn(client, robot, options) if options.get('batch_ik', True) else None
+    ik_batch_size = options.get('ik_batch_size', 50)
     gantry_arm_joint_names = robot.get_configurable_joint_names(group=GANTRY_ARM_GROUP)
     gantry_arm_joint_types = robot.get_joint_types_by_names(gantry_arm_joint_names)
 
@@ -378,9 +398,7 @@ def get_sample_fn_plan_motion_for_clamp_stateless(client, robot, process, operat
     tool_link_name = robot.get_end_effector_link_name(group=cartesian_move_group)
     tool_link = pp.link_from_name(robot_uid, tool_link_name)
 
-    static_obstacles = [] 
-    for env_name in process.environment_models:
-        static_obstacles.extend(client._get_bodies('^{}$'.format(env_name)))
+    static_obstacles = index.static_obstacles
 
     joint_custom_limits = options.get('joint_custom_limits', {})
     pb_custom_limits = {pp.joint_from_name(robot_uid, jn) : lims \
@@ -392,10 +410,14 @@ def get_sample_fn_plan_motion_for_clamp_stateless(client, robot, process, operat
     body_name_from_id=client._name_from_body_id
     gantry_arm_joints = pp.joints_from_names(robot_uid, gantry_arm_joint_names)
     gantry_arm_links = pp.get_moving_links(robot_uid, gantry_arm_joints)
+    # * checked on the simplified collision geometry first, if the world has some
+    any_link_pair_collision, pairwise_collision = get_link_pair_collision_fns(client)
+    # * link poses of the certified trajectories, shared by all the tests of a trajectory
+    fk_cache = get_fk_cache(client, robot_uid, gantry_arm_links, options)
     robot_env_collision_fn = pp.get_collision_fn(robot_uid, gantry_arm_joints, obstacles=static_obstacles,
                                     attachments=[], 
                                     self_collisions=True,
-                                    disabled_collisions=client.get_self_collision_link_ids(robot), # get disabled self-collision links (srdf)
+                                    disabled_collisions=get_disabled_self_collisions(client, robot, options), # srdf and never colliding links (see self_collision.py)
                                     # extra_disabled_collisions=extra_disabled_collisions,
                                     custom_limits=pb_custom_limits,
                                     body_name_from_id=body_name_from_id,
@@ -404,22 +426,92 @@ def get_sample_fn_plan_motion_for_clamp_stateless(client, robot, process, operat
     diagnosis = options.get('diagnosis', False)
     # diagnosis = True 
 
+    # optional callable that returns True when the sampling should be abandoned (e.g. another worker succeeded)
+    cancel_fn = options.get('cancel_fn', None)
+
+    # * Cartesian paths memoized by target poses and quantized start configuration, off by default:
+    # the gantry and IK samples rarely repeat a start configuration
+    cartesian_cache = None
+    if options.get('cartesian_cache', False):
+        cartesian_cache = CartesianPathCache(max_entries=options.get('cartesian_cache_size', 10000),
+            resolution=options.get('cartesian_cache_resolution', 1e-3))
+
+    path_sanity_fn = get_path_sanity_fn(robot_uid, gantry_arm_joints, gantry_arm_joint_names, pb_custom_limits, options)
 
-    def sample_fn(heldclamp: str, clamptype: str, beam1: str, beam2: str):
+    def path_in_collision_fn(attachment, conf_vals):
+        # check collisions for each conf in the path
+        for conf_val in conf_vals:
+            if robot_env_collision_fn(conf_val, diagnosis=diagnosis):
+                return True
+            # check collisions between robot and the attached object
+            attachment.assign()
+            if any_link_pair_collision(robot_uid, gantry_arm_links, attachment.child):
+                return True
+        return False
+
+    def plan_cartesian_fn(start_conf_value, target_poses):
+        def plan_fn(poses):
+            return plan_cartesian_motion_from_links(robot_uid, selected_links, tool_link,
+                poses, custom_limits=pb_custom_limits, get_sub_conf=True, options=options)
+        if cartesian_cache is None:
+            return plan_fn(target_poses)
+        return cartesian_cache.plan(plan_fn, robot_uid, gantry_arm_joints, start_conf_value, target_poses)
+
+
+    def traj_gen_fn(heldclamp: str, clamptype: str, beam1: str, beam2: str):
         # :inputs (?heldclamp ?clamptype ?beam1 ?beam2)
+        # yields one trajectory per call, the gantry and IK iteration resumes where it stopped on the next call
         # plan a motion to follow the target frames for inserting beam_id
         # while ensuring there is no collision between
         # - robot self collisions
         # - robot and the heldclamp
         joint_id = (beam1, beam2)
-        LOGGER.debug("Entering fn: get_sample_fn_plan_motion_for_clamp_stateless")
+        stream_name = f'plan_motion_for_{operation}_clamp'
+        LOGGER.debug("Entering fn: get_gen_fn_plan_motion_for_clamp_stateless")
 
         # Create attachments for the heldbeam
         attachment = pp.Attachment(robot_uid, tool_attach_link, clamp_grasp, clamp_bodies[heldclamp])
 
-        for gantry_iter, base_conf in zip(range(gantry_attempts), joint_gantry_sampler[joint_id]):
-            # * bare-arm IK sampler
-            arm_conf_vals = arm_sample_ik_fn(joint_target_poses[joint_id][0])
+        # trajectories of the opposite operation are certified for the same clamp and joint,
+        # the reversed trajectory only needs its collisions to be checked again
+        other_trajectories = certified_trajectories[other_operation][(heldclamp, joint_id)]
+        reversible = reverse_trajectories and index.are_clamp_targets_reversed(joint_id)
+        num_reversed = 0
+
+        def reversed_traj_gen():
+            nonlocal num_reversed
+            while reversible and num_reversed < len(other_trajectories):
+                other_trajectory = other_trajectories[num_reversed]
+                num_reversed += 1
+                trajectory = CompactTrajectory(other_trajectory.values[::-1], other_trajectory.joint_names, other_trajectory.joint_types)
+                with PROFILER.stage(stream_name, 'reverse_collision'):
+                    in_collision = path_in_collision_fn(attachment, trajectory.values)
+                if in_collision:
+                    PROFILER.count_rejection(stream_name, 'reverse_collision')
+                    continue
+                LOGGER.debug(f'Clamp {operation} plan {joint_id} reversed from a {other_operation} trajectory.')
+                if fk_cache is not None:
+                    fk_cache.add(trajectory, reversed_from=other_trajectory)
+                yield trajectory
+
+        for trajectory in reversed_traj_gen():
+            yield (trajectory,)
+
+        # * bare-arm IK for each gantry sample
+        ik_gen = gantry_ik_gen(joint_gantry_sampler[joint_id], gantry_attempts, joint_target_poses[joint_id][0],
+            arm_sample_ik_fn, batch_ik_fn, ik_batch_size)
+        for gantry_iter, base_conf, arm_conf_vals in PROFILER.timed_iter(stream_name, 'gantry_ik', ik_gen):
+            if cancel_fn is not None and cancel_fn():
+                # no output for this call, the next call continues from this gantry sample
+                LOGGER.debug(f'Clamp {operation} plan {joint_id} cancelled after {gantry_iter} gantry iters.')
+                yield None
+
+            # the opposite operation may have found new trajectories since the last gantry sample
+            for trajectory in reversed_traj_gen():
+                yield (trajectory,)
+
+            if not arm_conf_vals:
+                PROFILER.count_rejection(stream_name, 'no_ik')
 
             # * iterate through all 6-axis IK solution
             for arm_conf_val in arm_conf_vals:
@@ -430,59 +522,66 @@ def get_sample_fn_plan_motion_for_clamp_stateless(client, robot, process, operat
                 # check collisions for this starting configuration among
                 #     - robot self-collision 
                 #     - between (robot links) and obstacles
-                if robot_env_collision_fn(start_conf_value, diagnosis=diagnosis):
+                with PROFILER.stage(stream_name, 'env_collision'):
+                    in_collision = robot_env_collision_fn(start_conf_value, diagnosis=diagnosis)
+                if in_collision:
+                    PROFILER.count_rejection(stream_name, 'env_collision')
                     continue
 
                 # check collisions between robot and the attached beam
-                attachment.assign()
-                
-                if pp.any_link_pair_collision(robot_uid, gantry_arm_links, attachment.child):
+                with PROFILER.stage(stream_name, 'attachment_collision'):
+                    attachment.assign()
+                    in_collision = any_link_pair_collision(robot_uid, gantry_arm_links, attachment.child)
+                if in_collision:
+                    PROFILER.count_rejection(stream_name, 'attachment_collision')
                     if diagnosis:
                         cr = pp.any_link_pair_collision_info(robot_uid, gantry_arm_links, attachment.child)
                         pp.draw_collision_diagnosis(cr, body_name_from_id=body_name_from_id)
                     continue
 
-                path = plan_cartesian_motion_from_links(robot_uid, selected_links, tool_link,
-                    joint_target_poses[joint_id], custom_limits=pb_custom_limits, get_sub_conf=True, options=options)
+                with PROFILER.stage(stream_name, 'cartesian_plan'):
+                    path = plan_cartesian_fn(start_conf_value, joint_target_poses[joint_id])
 
                 if path is None:
                     LOGGER.debug(f'Clamp {operation} plan {joint_id}: no path found.')
+                    PROFILER.count_rejection(stream_name, 'no_cartesian_path')
+                    continue
+
+                # reject joint flips, limit violations and detours before any collision check
+                with PROFILER.stage(stream_name, 'path_sanity'):
+                    rejection = path_sanity_fn(path)
+                if rejection is not None:
+                    PROFILER.count_rejection(stream_name, rejection)
                     continue
 
                 # check collisions for each conf in the path
-                path_in_collisions = False
-                for conf_val in path[1:]:
-                    if robot_env_collision_fn(conf_val, diagnosis=diagnosis):
-                        path_in_collisions = True
-                        break
-                    # check collisions between robot and the attached beam
-                    attachment.assign()
-                    if pp.any_link_pair_collision(robot_uid, gantry_arm_links, attachment.child):
-                        path_in_collisions = True
-                        break
-                    # TODO joint flip check
+                with PROFILER.stage(stream_name, 'path_collision'):
+                    path_in_collisions = path_in_collision_fn(attachment, path[1:])
 
                 if path_in_collisions:
                     LOGGER.debug(f'Clamp {operation} plan {joint_id} path collision.')
+                    PROFILER.count_rejection(stream_name, 'path_collision')
                     continue
                 else:
-                    # convert path to trajectory
-                    jt_traj_pts = []
-                    for i, arm_conf_value in enumerate(path):
-                        jt_traj_pt = JointTrajectoryPoint(joint_values=arm_conf_value, joint_names=gantry_arm_joint_names, joint_types=gantry_arm_joint_types)
-                        jt_traj_pt.time_from_start = Duration(i*1,0)
-                        jt_traj_pts.append(jt_traj_pt)
-                    trajectory = JointTrajectory(trajectory_points=jt_traj_pts,
-                        joint_names=jt_traj_pts[0].joint_names, start_configuration=jt_traj_pts[0], fraction=1.0)
+                    # convert path to trajectory, the compas JointTrajectory is only created when the plan is saved
+                    trajectory = CompactTrajectory(path, gantry_arm_joint_names, gantry_arm_joint_types)
                     LOGGER.debug(f'Clamp {operation} plan {joint_id} sample found after {gantry_iter} gantry iters.')
+                    PROFILER.record_gantry_iters(stream_name, gantry_iter + 1)
+                    if gantry_experience is not None:
+                        gantry_experience.record(joint_target_poses[joint_id][0], base_conf)
+                    if fk_cache is not None:
+                        fk_cache.add(trajectory)
+                    certified_trajectories[operation][(heldclamp, joint_id)].append(trajectory)
+
+                    yield (trajectory,)
 
-                    # yield (trajectory,)
-                    return (trajectory,)
-        else:
-            # LOGGER.debug(f'Cartesian plan running out of samples {gantry_iter}')
-            raise ValueError(f'Clamp {operation} plan {joint_id} running out of samples {gantry_iter}')
+        LOGGER.debug(f'Clamp {operation} plan {joint_id} running out of samples.')
+        if cartesian_cache is not None:
+            LOGGER.debug(cartesian_cache.stats_str())
+        if fk_cache is not None:
+            LOGGER.debug(fk_cache.stats_str())
 
-    return sample_fn
+    return traj_gen_fn
 
 ##########################################
 
@@ -490,40 +589,15 @@ def get_test_fn_clamp_beam_collision_check_stateless(
         client: PyChoreoClient, 
         robot: Robot, 
         process: RobotClampAssemblyProcess,
-        options=None):
+        options=None,
+        stream_name='clamp_beam_collision_check'):
     options = options or {}
 
-    toolchanger = process.robot_toolchanger
-    flange_from_toolchanger_base = toolchanger.t_t0cf_from_tcf
-    # all clamp use the same grasp transformation from the tool changer
-    clamp_grasp = pose_from_transformation(toolchanger.t_t0cf_from_tcf, scale=1e-3)
-
-    beam_assembled_poses = {}
-    beam_bodies = {}
-    beam_neighbours = {}
-    for beam_id in process.assembly.sequence:
-        # Skip scaffolding elements
-        if process.assembly.get_assembly_method(beam_id) == BeamAssemblyMethod.MANUAL_ASSEMBLY:
-            continue
-
-        # Cache all beam's frame at asssembled position
-        beam_assembled_poses[beam_id] = pose_from_frame(process.assembly.get_beam_attribute(beam_id, 'assembly_wcf_final'), scale=1e-3)
-
-        # Cache all grasp transformations
-        t_gripper_tcf_from_beam = process.assembly.get_t_gripper_tcf_from_beam(beam_id)
-        beam_gripper_id = process.assembly.get_beam_attribute(beam_id, "gripper_id")
-        beam_gripper = process.tool(beam_gripper_id)
-        flange_from_beam = flange_from_toolchanger_base * beam_gripper.t_t0cf_from_tcf * t_gripper_tcf_from_beam
-        # scale the translation part of the transformation to meter
-        for k in range(3):
-            flange_from_beam[k,3] *= 1e-3
-
-        beam_bodies[beam_id] = client._get_bodies('^{}$'.format(beam_id))[0]
-        beam_neighbours[beam_id] = process.assembly.get_already_built_neighbors(beam_id)
-
-    clamp_bodies = {}
-    for clamp in process.clamps:
-        clamp_bodies[clamp.name] = client._get_bodies('^{}$'.format(clamp.name))[0]
+    index = get_process_geometry_index(client, process, options)
+    clamp_grasp = index.clamp_grasp
+    beam_assembled_poses = index.beam_assembled_poses
+    beam_bodies = index.beam_bodies
+    clamp_bodies = index.clamp_bodies
 
     robot_uid = client.get_robot_pybullet_uid(robot)
     flange_link_name = process.ROBOT_END_LINK
@@ -533,15 +607,41 @@ def get_test_fn_clamp_beam_collision_check_stateless(
     gantry_arm_joint_names = robot.get_configurable_joint_names(group=GANTRY_ARM_GROUP)
     gantry_arm_joints = pp.joints_from_names(robot_uid, gantry_arm_joint_names)
     gantry_arm_links = pp.get_moving_links(robot_uid, gantry_arm_joints)
+    # * checked on the simplified collision geometry first, if the world has some
+    any_link_pair_collision, pairwise_collision = get_link_pair_collision_fns(client)
+    # * link poses of the certified trajectories, shared by all the tests of a trajectory
+    fk_cache = get_fk_cache(client, robot_uid, gantry_arm_links, options)
 
     diagnosis = options.get('diagnosis', False)
 
+    # * AABB prefilter of the assembled beams
+    broad_phase = None
+    if options.get('broad_phase', True):
+        broad_phase = BroadPhaseIndex(client, robot_uid, gantry_arm_links, margin=options.get('broad_phase_margin', 0.01), fk_cache=fk_cache,
+            memo_size=options.get('traj_memo_size', 1000))
+        for beam_id, beam_body in beam_bodies.items():
+            broad_phase.add_object(beam_id, beam_body, beam_assembled_poses[beam_id])
+
+    # * analytic OBB test of the robot links against the assembled beams, pybullet only checks the overlapping points
+    obb_checker = None
+    if options.get('beam_obb', True):
+        obb_checker = BeamOBBChecker(client, robot_uid, gantry_arm_links, margin=options.get('beam_obb_margin', 0.01), fk_cache=fk_cache,
+            memo_size=options.get('traj_memo_size', 1000))
+        for beam_id, beam_body in beam_bodies.items():
+            obb_checker.add_beam(beam_id, beam_body, beam_assembled_poses[beam_id])
+
     def test_fn(heldclamp, beam1, beam2, traj, otherbeam):
         # (?heldclamp ?beam1 ?beam2 ?traj ?otherbeam)
         # Returns: ClampTrajNotInCollisionWithBeam
 
         LOGGER.debug("Entering fn: get_test_fn_clamp_beam_collision_check_stateless")
 
+        # * the robot never gets close to the otherbeam
+        if broad_phase is not None:
+            with PROFILER.stage(stream_name, 'broad_phase'):
+                may_collide = broad_phase.may_collide(traj, otherbeam)
+            if not may_collide:
+                return True
 
         clamp_traj_not_in_collision_with_beam = True
         heldclamp_body = clamp_bodies[heldclamp]
@@ -552,12 +652,21 @@ def get_test_fn_clamp_beam_collision_check_stateless(
         attachment = pp.Attachment(robot_uid, tool_attach_link, clamp_grasp, heldclamp_body)
         # ignore_beambeam_collisions = otherbeam in beam_neighbours[heldbeam]
 
-        for conf in traj.points:
-            client._set_body_configuration(robot_uid, conf)
+        # * only the points where a robot link box overlaps the beam box are checked
+        point_indices = None
+        if obb_checker is not None:
+            with PROFILER.stage(stream_name, 'obb'):
+                ambiguous = obb_checker.get_ambiguous_points(traj, [otherbeam])[:, 0]
+            if not ambiguous.any():
+                return True
+            point_indices = np.flatnonzero(ambiguous)
+
+        narrow_phase_start_time = time.perf_counter()
+        for _ in replay_trajectory(client, robot_uid, traj, point_indices):
             attachment.assign()
 
             # * check between robot body and the otherbeam
-            if pp.any_link_pair_collision(robot_uid, gantry_arm_links, otherbeam_body):
+            if any_link_pair_collision(robot_uid, gantry_arm_links, otherbeam_body):
                 # LOGGER.debug(f'Clamp traj {heldclamp} : robot colliding with {otherbeam}at {(beam1, beam2)}')
                 if diagnosis:
                 # if True:
@@ -579,6 +688,8 @@ def get_test_fn_clamp_beam_collision_check_stateless(
             #     clamp_traj_not_in_collision_with_beam = False
             #     break
 
+        PROFILER.add_stage_time(stream_name, 'narrow_phase', time.perf_counter() - narrow_phase_start_time)
+
         if not clamp_traj_not_in_collision_with_beam:
             LOGGER.debug('Tested clamp {} at {} IN COLLISION held {} - for {}'.format(heldclamp, (beam1, beam2), otherbeam, traj))
 
@@ -586,6 +697,105 @@ def get_test_fn_clamp_beam_collision_check_stateless(
 
     return test_fn
 
+##########################################
+
+def get_test_fn_clamp_clamp_collision_check_stateless(
+        client: PyChoreoClient, 
+        robot: Robot, 
+        process: RobotClampAssemblyProcess,
+        options=None,
+        stream_name='clamp_clamp_collision_check'):
+    options = options or {}
+
+    index = get_process_geometry_index(client, process, options)
+    clamp_grasp = index.clamp_grasp
+    clamp_at_joint_poses = index.clamp_at_joint_poses
+    clamp_bodies = index.clamp_bodies
+
+    robot_uid = client.get_robot_pybullet_uid(robot)
+    flange_link_name = process.ROBOT_END_LINK
+    tool_attach_link = pp.link_from_name(robot_uid, flange_link_name)
+
+    body_name_from_id=client._name_from_body_id
+    gantry_arm_joint_names = robot.get_configurable_joint_names(group=GANTRY_ARM_GROUP)
+    gantry_arm_joints = pp.joints_from_names(robot_uid, gantry_arm_joint_names)
+    gantry_arm_links = pp.get_moving_links(robot_uid, gantry_arm_joints)
+    # * checked on the simplified collision geometry first, if the world has some
+    any_link_pair_collision, pairwise_collision = get_link_pair_collision_fns(client)
+    # * link poses of the certified trajectories, shared by all the tests of a trajectory
+    fk_cache = get_fk_cache(client, robot_uid, gantry_arm_links, options)
+
+    diagnosis = options.get('diagnosis', False)
+
+    # * AABB prefilter of the clamps at the joints (at `clamp_wcf_final`), keyed by (clamp, joint_id)
+    # every clamp of the joint's tool type is registered up front, other placements on the first test that uses them
+    broad_phase = None
+    if options.get('broad_phase', True):
+        broad_phase = BroadPhaseIndex(client, robot_uid, gantry_arm_links, margin=options.get('broad_phase_margin', 0.01), fk_cache=fk_cache,
+            memo_size=options.get('traj_memo_size', 1000))
+        with pp.WorldSaver():
+            broad_phase.add_objects([((clamp.name, joint_id), clamp_bodies[clamp.name], pose) \
+                for joint_id, pose in clamp_at_joint_poses.items() for clamp in process.clamps \
+                if clamp.name in clamp_bodies and clamp.type_name == process.assembly.get_joint_attribute(joint_id, 'tool_type')])
+
+    def test_fn(heldclamp, beam1, beam2, traj, otherclamp, otherbeam1, otherbeam2, otherclamp_type):
+        # (?heldclamp ?beam1 ?beam2 ?traj ?otherclamp ?otherbeam1 ?otherbeam2 ?otherclamptype)
+        # Returns: ClampTrajNotInCollisionWithClamp
+
+        LOGGER.debug("Entering fn: get_test_fn_clamp_clamp_collision_check_stateless")
+
+        joint_id = (beam1, beam2)
+        otherjoint_id = (otherbeam1, otherbeam2)
+        # * the held clamp cannot also be at another joint, and a joint holds a single clamp
+        if otherclamp == heldclamp or otherjoint_id == joint_id:
+            return True
+
+        heldclamp_body = clamp_bodies[heldclamp]
+        otherclamp_body = clamp_bodies[otherclamp]
+        attachment = pp.Attachment(robot_uid, tool_attach_link, clamp_grasp, heldclamp_body)
+
+        # * only the trajectory points that get close to the otherclamp are checked
+        point_indices = None
+        if broad_phase is not None:
+            with PROFILER.stage(stream_name, 'broad_phase'):
+                object_name = (otherclamp, otherjoint_id)
+                if object_name not in broad_phase.object_aabbs:
+                    broad_phase.add_object(object_name, otherclamp_body, clamp_at_joint_poses[otherjoint_id])
+                point_indices = broad_phase.get_overlapping_points(traj, object_name, [attachment])
+            if not point_indices:
+                return True
+
+        clamp_traj_not_in_collision_with_clamp = True
+        # set the otherclamp to its pose at the joint
+        pp.set_pose(otherclamp_body, clamp_at_joint_poses[otherjoint_id])
+
+        with PROFILER.stage(stream_name, 'narrow_phase'):
+            for _ in replay_trajectory(client, robot_uid, traj, indices=point_indices):
+                attachment.assign()
+
+                # * check between robot body and the otherclamp
+                if any_link_pair_collision(robot_uid, gantry_arm_links, otherclamp_body):
+                    if diagnosis:
+                        cr = pp.any_link_pair_collision_info(robot_uid, gantry_arm_links, otherclamp_body)
+                        pp.draw_collision_diagnosis(cr, body_name_from_id=body_name_from_id)
+                    clamp_traj_not_in_collision_with_clamp = False
+                    break
+
+                # * check between the heldclamp and the otherclamp
+                if pairwise_collision(attachment.child, otherclamp_body):
+                    if diagnosis:
+                        cr = pp.pairwise_collision_info(attachment.child, otherclamp_body)
+                        pp.draw_collision_diagnosis(cr, body_name_from_id=body_name_from_id)
+                    clamp_traj_not_in_collision_with_clamp = False
+                    break
+
+        if not clamp_traj_not_in_collision_with_clamp:
+            LOGGER.debug('Tested clamp {} at {} IN COLLISION with clamp {} at {} - for {}'.format(heldclamp, joint_id, otherclamp, otherjoint_id, traj))
+
+        return clamp_traj_not_in_collision_with_clamp
+
+    return test_fn
+
     # #############
 
     # toolchanger = process.robot_toolchanger
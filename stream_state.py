@@ -0,0 +1,139 @@
+from contextlib import contextmanager
+from itertools import product
+
+import pybullet
+import pybullet_planning as pp
+from compas_fab.robots import AttachedCollisionMesh, CollisionMesh
+from compas_fab_pychoreo.conversions import pose_from_transformation
+
+from integral_timber_joints.planning.robot_setup import GANTRY_ARM_GROUP
+
+from self_collision import get_disabled_self_collisions
+from trajectory import trajectory_values
+
+##########################################
+
+class StreamStateLayer(object):
+    """Lightweight world state for the stateful stream functions of `stream_samplers`.
+
+    - `saved_state`: pybullet `saveState` / `restoreState` around a call, instead of `pp.WorldSaver`
+    - `attached_object`: the object attached to the robot in the client around a call, for the client's Cartesian planner
+    - `attachments[name]`: one `pp.Attachment` per beam (at its grasp) and per clamp, created once
+    - `get_acm(pairs)`: disabled collision link pairs between named objects, computed once per set of pairs
+    - `get_collision_fn(heldobject, acm)`: the collision function of the robot holding the object,
+      created once per held object and ACM and reused by every call
+
+    The collision functions check what `client.check_collisions` checks with the held object attached:
+    robot self-collisions, robot and attached objects (the held object and the client's attachments, e.g.
+    the tool changer) against the client's collision objects, without changing the client's attachments
+    and `extra_disabled_collision_links`.
+    """
+
+    def __init__(self, client, robot, process, beam_grasps=None, clamp_grasp=None, options=None):
+        options = options or {}
+        self.client = client
+        self.robot = robot
+        self.robot_uid = client.get_robot_pybullet_uid(robot)
+        self.joints = pp.joints_from_names(self.robot_uid, robot.get_configurable_joint_names(group=GANTRY_ARM_GROUP))
+        self.tool_attach_link = pp.link_from_name(self.robot_uid, process.ROBOT_END_LINK)
+
+        self.attachments = {}
+        for beam_id, flange_from_beam in (beam_grasps or {}).items():
+            self.attachments[beam_id] = pp.Attachment(self.robot_uid, self.tool_attach_link,
+                pose_from_transformation(flange_from_beam), self.get_body(beam_id))
+        if clamp_grasp is not None:
+            for clamp in process.clamps:
+                self.attachments[clamp.name] = pp.Attachment(self.robot_uid, self.tool_attach_link,
+                    pose_from_transformation(clamp_grasp), self.get_body(clamp.name))
+
+        joint_custom_limits = options.get('joint_custom_limits', {})
+        self.custom_limits = {pp.joint_from_name(self.robot_uid, jn) : lims for jn, lims in joint_custom_limits.items()}
+        self.distance_threshold = options.get('collision_distance_threshold', 0.0)
+        self.max_distance = options.get('collision_buffer_distance_threshold', 0.0)
+
+        # SRDF pairs and the pairs that never collide (see `self_collision.py`)
+        self.disabled_collisions = get_disabled_self_collisions(client, robot, options)
+        self.acms = {}
+        self.collision_fns = {}
+
+    def get_body(self, name):
+        return self.client._get_bodies('^{}$'.format(name))[0]
+
+    @contextmanager
+    def saved_state(self):
+        """Restores the poses and joint values of all the bodies on exit.
+        """
+        state_id = pybullet.saveState(physicsClientId=self.client.client_id)
+        try:
+            yield
+        finally:
+            pybullet.restoreState(stateId=state_id, physicsClientId=self.client.client_id)
+            pybullet.removeState(state_id, physicsClientId=self.client.client_id)
+
+    @contextmanager
+    def attached_object(self, name, flange_link_name, flange_from_object, touch_links=None, attached_child_link_name=None):
+        """Attaches the object to the robot in the client on entry, detaches it and puts it back at its pose on exit.
+        The client may create bodies and constraints when attaching, so this must enclose `saved_state`, not the other way around.
+        """
+        body = self.get_body(name)
+        pose = pp.get_pose(body)
+        self.client.add_attached_collision_mesh(
+            AttachedCollisionMesh(CollisionMesh(None, name), flange_link_name, touch_links=touch_links or []),
+            options={'robot': self.robot,
+                     'attached_child_link_name': attached_child_link_name,
+                     'parent_link_from_child_link_transformation' : flange_from_object,
+                     })
+        try:
+            yield
+        finally:
+            self.client.detach_attached_collision_mesh(name, options={})
+            pp.set_pose(body, pose)
+
+    def get_acm(self, pairs):
+        """Link pairs to ignore for the (name1, name2) object pairs, all links of both objects are disabled.
+        """
+        pairs = frozenset(pairs)
+        if pairs not in self.acms:
+            acm = set()
+            for name1, name2 in pairs:
+                for body1, body2 in product(self.client._get_bodies('^{}$'.format(name1)), self.client._get_bodies('^{}$'.format(name2))):
+                    for link1, link2 in product(pp.get_all_links(body1), pp.get_all_links(body2)):
+                        acm.add(((body1, link1), (body2, link2)))
+            self.acms[pairs] = frozenset(acm)
+        return self.acms[pairs]
+
+    def get_attachments(self, heldobject):
+        """Attachments checked by the collision function of the held object: the held object and the client's
+        attachments (e.g. the tool changer and the gripper).
+        """
+        attachments = [self.attachments[heldobject]]
+        for name, client_attachments in self.client.pychoreo_attachments.items():
+            if name != heldobject:
+                attachments.extend(client_attachments)
+        return attachments
+
+    def get_collision_fn(self, heldobject, acm=frozenset()):
+        key = (heldobject, acm)
+        if key not in self.collision_fns:
+            heldobject_bodies = set(self.client._get_bodies('^{}$'.format(heldobject)))
+            attachments = self.get_attachments(heldobject)
+            obstacles = [body for name, bodies in self.client.collision_objects.items() if name != heldobject \
+                for body in bodies if body not in heldobject_bodies]
+            self.collision_fns[key] = pp.get_collision_fn(self.robot_uid, self.joints, obstacles=obstacles,
+                attachments=attachments,
+                self_collisions=True,
+                disabled_collisions=self.disabled_collisions,
+                extra_disabled_collisions=acm,
+                custom_limits=self.custom_limits,
+                body_name_from_id=self.client._name_from_body_id,
+                distance_threshold=self.distance_threshold, max_distance=self.max_distance)
+        return self.collision_fns[key]
+
+    def trajectory_in_collision(self, heldobject, traj, acm=frozenset(), diagnosis=False):
+        """True if any point of the trajectory is in collision, see `get_collision_fn`.
+        """
+        collision_fn = self.get_collision_fn(heldobject, acm)
+        for conf_values in trajectory_values(traj):
+            if collision_fn(conf_values, diagnosis=diagnosis):
+                return True
+        return False
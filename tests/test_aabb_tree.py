@@ -0,0 +1,75 @@
+import random
+
+from aabb_tree import AABBTree
+
+NUM_OBJECTS = 200
+NUM_QUERIES = 100
+
+
+def random_aabb(rng, size=1.0, extent=10.0):
+    lower = [rng.uniform(-extent, extent) for _ in range(3)]
+    return (lower, [v + rng.uniform(0, size) for v in lower])
+
+
+def overlap(aabb1, aabb2):
+    return all(l1 <= u2 and l2 <= u1 for l1, u1, l2, u2 in zip(aabb1[0], aabb1[1], aabb2[0], aabb2[1]))
+
+
+def brute_force_query(aabb_from_name, aabb):
+    return {name for name, other in aabb_from_name.items() if overlap(other, aabb)}
+
+
+def check_tree(tree, aabb_from_name, rng):
+    assert len(tree) == len(aabb_from_name)
+    for _ in range(NUM_QUERIES):
+        aabb = random_aabb(rng, size=5.0)
+        names = tree.query(aabb)
+        # * each object is found once
+        assert len(names) == len(set(names))
+        assert set(names) == brute_force_query(aabb_from_name, aabb)
+
+
+def test_build_matches_brute_force():
+    rng = random.Random(0)
+    aabb_from_name = {k : random_aabb(rng) for k in range(NUM_OBJECTS)}
+    tree = AABBTree()
+    tree.build(aabb_from_name)
+    check_tree(tree, aabb_from_name, rng)
+
+
+def test_insert_remove_update_match_brute_force():
+    rng = random.Random(1)
+    aabb_from_name = {}
+    tree = AABBTree()
+    for k in range(NUM_OBJECTS):
+        aabb_from_name[k] = random_aabb(rng)
+        tree.insert(k, aabb_from_name[k])
+    check_tree(tree, aabb_from_name, rng)
+
+    for k in rng.sample(range(NUM_OBJECTS), NUM_OBJECTS // 2):
+        tree.remove(k)
+        del aabb_from_name[k]
+    check_tree(tree, aabb_from_name, rng)
+
+    for k in list(aabb_from_name)[::2]:
+        aabb_from_name[k] = random_aabb(rng)
+        tree.update(k, aabb_from_name[k])
+    check_tree(tree, aabb_from_name, rng)
+
+    # * inserting after a build keeps the tree consistent
+    tree.build(aabb_from_name)
+    aabb_from_name['new'] = random_aabb(rng)
+    tree.insert('new', aabb_from_name['new'])
+    check_tree(tree, aabb_from_name, rng)
+
+
+def test_empty_and_single():
+    tree = AABBTree()
+    assert tree.query(((0, 0, 0), (1, 1, 1))) == []
+    tree.insert('a', ((0, 0, 0), (1, 1, 1)))
+    assert tree.query(((0.5, 0.5, 0.5), (2, 2, 2))) == ['a']
+    assert tree.query(((2, 2, 2), (3, 3, 3))) == []
+    tree.remove('a')
+    assert len(tree) == 0 and tree.root is None
+    tree.build({})
+    assert tree.query(((0, 0, 0), (1, 1, 1))) == []
@@ -0,0 +1,66 @@
+import numpy as np
+import pytest
+
+pp = pytest.importorskip('pybullet_planning')
+pytest.importorskip('integral_timber_joints')
+
+from compas_fab.robots import Configuration
+from integral_timber_joints.planning.robot_setup import load_RFL_world, BARE_ARM_GROUP
+from integral_timber_joints.planning.stream import _get_sample_bare_arm_ik_fn
+
+from batch_ik import get_batch_ik_fn, get_gantry_arm_kinematics
+
+NUM_SAMPLES = 20
+TOLERANCE = 1e-4
+
+
+def contains_conf(confs, conf):
+    return len(confs) > 0 and np.any(np.all(np.abs(np.array(confs) - conf) < TOLERANCE, axis=1))
+
+
+@pytest.fixture(scope='module')
+def rfl_world():
+    client, robot, _ = load_RFL_world(viewer=False, verbose=False)
+    yield client, robot
+    client.disconnect()
+
+
+def test_batch_ik_matches_sample_ik(rfl_world):
+    client, robot = rfl_world
+    kinematics = get_gantry_arm_kinematics(client, robot)
+    assert kinematics is not None
+    batch_ik_fn = get_batch_ik_fn(client, robot)
+    arm_sample_ik_fn = _get_sample_bare_arm_ik_fn(client, robot)
+
+    robot_uid = kinematics['robot_uid']
+    gantry_joints = kinematics['gantry_joints']
+    arm_joints = pp.joints_from_names(robot_uid, robot.get_configurable_joint_names(group=BARE_ARM_GROUP))
+    tool_link = pp.link_from_name(robot_uid, robot.get_end_effector_link_name(group=BARE_ARM_GROUP))
+    lower_limits, upper_limits = kinematics['lower_limits'], kinematics['upper_limits']
+
+    rng = np.random.default_rng(0)
+    for _ in range(NUM_SAMPLES):
+        gantry_values = rng.uniform(kinematics['gantry_lower_limits'], kinematics['gantry_upper_limits'])
+        arm_values = rng.uniform(lower_limits, upper_limits)
+        pp.set_joint_positions(robot_uid, gantry_joints, gantry_values)
+        pp.set_joint_positions(robot_uid, arm_joints, arm_values)
+        world_from_tool = pp.get_link_pose(robot_uid, tool_link)
+
+        base_conf = Configuration(list(gantry_values), kinematics['gantry_joint_types'], kinematics['gantry_joint_names'])
+        batch_confs = batch_ik_fn([base_conf], world_from_tool)[0]
+        # * the sampled configuration is found, including its wrist turns
+        assert contains_conf(batch_confs, arm_values)
+
+        # * the per-sample IK (it uses the gantry configuration set in the world) finds no solution
+        # within the limits that the batch IK misses
+        for conf in arm_sample_ik_fn(world_from_tool):
+            conf = np.array(conf)
+            if np.all(conf >= lower_limits) and np.all(conf <= upper_limits):
+                assert contains_conf(batch_confs, conf)
+
+        # * every batch solution reaches the tool pose
+        for conf in batch_confs:
+            pp.set_joint_positions(robot_uid, arm_joints, conf)
+            point, quat = pp.get_link_pose(robot_uid, tool_link)
+            assert np.allclose(point, world_from_tool[0], atol=TOLERANCE)
+            assert abs(abs(np.dot(quat, world_from_tool[1])) - 1) < TOLERANCE
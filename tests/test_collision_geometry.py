@@ -0,0 +1,27 @@
+import pytest
+
+pp = pytest.importorskip('pybullet_planning')
+pytest.importorskip('scipy')
+pytest.importorskip('integral_timber_joints')
+
+from integral_timber_joints.planning.robot_setup import load_RFL_world
+
+from collision_geometry import CollisionProxies, check_collision_proxies
+
+NUM_SAMPLES = 20
+
+
+@pytest.fixture(scope='module')
+def rfl_world():
+    client, robot, _ = load_RFL_world(viewer=False, verbose=False)
+    yield client, robot
+    client.disconnect()
+
+
+def test_proxies_contain_exact_collisions(rfl_world, tmp_path):
+    client, robot = rfl_world
+    proxies = CollisionProxies(geometry_dir=str(tmp_path))
+    proxies.add_body(client.get_robot_pybullet_uid(robot))
+    assert any(proxy is not None for proxy in proxies.proxies.values())
+    # * the random configurations are mostly in self-collision, every exact collision is found on the proxies
+    assert check_collision_proxies(client, robot, proxies, num_samples=NUM_SAMPLES) == []
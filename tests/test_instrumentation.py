@@ -0,0 +1,62 @@
+import json
+
+import pytest
+
+# adds the pddlstream and pyplanners submodules to the path
+pytest.importorskip('load_pddlstream')
+
+from instrumentation import StreamProfiler, get_profiled_gen_fn, get_profiled_test_fn
+
+
+def test_profiled_gen_fn_counts_each_output_request():
+    profiler = StreamProfiler()
+
+    def gen_fn(n):
+        yield ('traj0',)
+        # e.g. cancelled by another worker
+        yield None
+        yield ('traj1',)
+
+    outputs = list(get_profiled_gen_fn('plan_motion', gen_fn, profiler)(3))
+    assert outputs == [('traj0',), None, ('traj1',)]
+    # * the request that finds the generator exhausted is a call too
+    assert profiler.calls['plan_motion'] == 4
+    assert profiler.successes['plan_motion'] == 2
+    assert dict(profiler.rejections['plan_motion']) == {'cancelled' : 1, 'out_of_samples' : 1}
+
+
+def test_profiled_test_fn_counts_collisions():
+    profiler = StreamProfiler()
+    test_fn = get_profiled_test_fn('collision_check', lambda traj, beam: beam != 'b2', profiler)
+    assert [test_fn('traj', beam) for beam in ['b1', 'b2', 'b3']] == [True, False, True]
+    assert profiler.calls['collision_check'] == 3
+    assert profiler.successes['collision_check'] == 2
+    assert dict(profiler.rejections['collision_check']) == {'collision' : 1}
+
+
+def test_stages_and_report(tmp_path):
+    profiler = StreamProfiler()
+    with profiler.stage('plan_motion', 'cartesian_plan'):
+        pass
+    with profiler.stage('plan_motion', 'cartesian_plan'):
+        pass
+    assert list(profiler.timed_iter('plan_motion', 'gantry_ik', range(3))) == [0, 1, 2]
+    profiler.record_gantry_iters('plan_motion', 4)
+    profiler.record_gantry_iters('plan_motion', 8)
+    profiler.count_rejection('plan_motion', 'no_ik')
+
+    stats = profiler.report()['streams']['plan_motion']
+    assert stats['stages']['cartesian_plan']['count'] == 2
+    # * one timing per item and one for the exhausted iterator
+    assert stats['stages']['gantry_ik']['count'] == 4
+    assert stats['gantry_iters_per_success'] == {'mean' : 6.0, 'max' : 8, 'values' : [4, 8]}
+    assert stats['rejections'] == {'no_ik' : 1}
+
+    path = profiler.save_report(str(tmp_path), 'report.json', extra={'case' : 4})
+    with open(path, 'r') as f:
+        report = json.load(f)
+    assert report['case'] == 4
+    assert report['streams']['plan_motion']['stages']['cartesian_plan']['count'] == 2
+
+    profiler.reset()
+    assert profiler.report()['streams'] == {}
@@ -0,0 +1,65 @@
+import numpy as np
+import pytest
+
+pp = pytest.importorskip('pybullet_planning')
+pytest.importorskip('integral_timber_joints')
+
+from integral_timber_joints.planning.robot_setup import load_RFL_world, get_tolerances, GANTRY_ARM_GROUP
+
+from path_sanity import get_path_sanity_fn
+
+NUM_POINTS = 4
+
+
+@pytest.fixture(scope='module')
+def rfl_gantry_arm():
+    client, robot, _ = load_RFL_world(viewer=False, verbose=False)
+    robot_uid = client.get_robot_pybullet_uid(robot)
+    joint_names = robot.get_configurable_joint_names(group=GANTRY_ARM_GROUP)
+    joints = pp.joints_from_names(robot_uid, joint_names)
+    # the options of the samplers, with the per-step joint jump tolerances of the interpolated paths
+    options = dict(get_tolerances(robot))
+    custom_limits = {pp.joint_from_name(robot_uid, jn) : lims for jn, lims in options.get('joint_custom_limits', {}).items()}
+    lower_limits, upper_limits = map(np.array, pp.get_custom_limits(robot_uid, joints, custom_limits))
+    yield robot_uid, joints, joint_names, custom_limits, options, lower_limits, upper_limits
+    client.disconnect()
+
+
+def sparse_path(lower_limits, upper_limits):
+    # one point per movement target: a straight joint space path that crosses a quarter of each joint's range
+    lower_limits = np.maximum(lower_limits, -np.pi)
+    upper_limits = np.minimum(upper_limits, np.pi)
+    start = lower_limits + 0.25 * (upper_limits - lower_limits)
+    end = lower_limits + 0.5 * (upper_limits - lower_limits)
+    return [start + t * (end - start) for t in np.linspace(0, 1, NUM_POINTS)]
+
+
+def test_sparse_path_is_accepted(rfl_gantry_arm):
+    robot_uid, joints, joint_names, custom_limits, options, lower_limits, upper_limits = rfl_gantry_arm
+    path = sparse_path(lower_limits, upper_limits)
+    # * the steps between the target poses are larger than the per-step tolerances of interpolated paths
+    max_jumps = np.array([options.get('joint_jump_tolerances', {}).get(name, 0.5) for name in joint_names])
+    assert np.any(np.abs(np.diff(path, axis=0)) > max_jumps)
+    path_sanity_fn = get_path_sanity_fn(robot_uid, joints, joint_names, custom_limits, options)
+    assert path_sanity_fn(path) is None
+    # * also with the opt-in path length rule, the path is straight
+    path_sanity_fn = get_path_sanity_fn(robot_uid, joints, joint_names, custom_limits, dict(options, path_length_check=True))
+    assert path_sanity_fn(path) is None
+    # * the opt-in joint jump rule rejects it
+    path_sanity_fn = get_path_sanity_fn(robot_uid, joints, joint_names, custom_limits, dict(options, path_joint_jump_check=True))
+    assert path_sanity_fn(path) == 'joint_jump'
+
+
+def test_implausible_paths_are_rejected(rfl_gantry_arm):
+    robot_uid, joints, joint_names, custom_limits, options, lower_limits, upper_limits = rfl_gantry_arm
+    path = sparse_path(lower_limits, upper_limits)
+    path_sanity_fn = get_path_sanity_fn(robot_uid, joints, joint_names, custom_limits, dict(options, path_length_check=True))
+    assert path_sanity_fn([]) is None
+
+    outside = [np.array(values) for values in path]
+    outside[1][0] = upper_limits[0] + 1.0
+    assert path_sanity_fn(outside) == 'joint_limits'
+
+    # * a detour back and forth between the end points, 5 times their distance
+    detour = path + path[::-1] + path + path[::-1] + path
+    assert path_sanity_fn(detour) == 'path_length'
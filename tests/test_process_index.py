@@ -0,0 +1,64 @@
+import json
+
+import pytest
+
+pytest.importorskip('compas_fab_pychoreo')
+pytest.importorskip('integral_timber_joints')
+# adds the pddlstream and pyplanners submodules to the path
+pytest.importorskip('load_pddlstream')
+
+from process_index import ProcessGeometryIndex, CLAMP_OPERATIONS
+
+JOINT_ID = ('b1', 'b0')
+
+
+def pose(x, y=0.0, z=0.0):
+    return ((x, y, z), (0.0, 0.0, 0.0, 1.0))
+
+
+def make_index():
+    index = ProcessGeometryIndex()
+    index.beam_ids = ['b0', 'b1']
+    index.beam_assembled_poses = {'b0' : pose(0.0), 'b1' : pose(1.0)}
+    index.beam_grasps = {'b0' : pose(0.0, z=0.1), 'b1' : pose(0.0, z=0.2)}
+    index.beam_neighbours = {'b0' : [], 'b1' : ['b0']}
+    index.beam_target_poses = {'b0' : [pose(0.0, z=0.5), pose(0.0)], 'b1' : [pose(1.0, z=0.5)]}
+    index.clamp_grasp = pose(0.0, z=0.05)
+    index.joint_target_poses['attach'][JOINT_ID] = [pose(0.5, z=0.5), pose(0.5, z=0.2), pose(0.5)]
+    index.joint_target_poses['detach'][JOINT_ID] = [pose(0.5), pose(0.5, z=0.2), pose(0.5, z=0.5)]
+    index.clamp_at_joint_poses = {JOINT_ID : pose(0.5)}
+    return index
+
+
+def test_json_round_trip():
+    index = make_index()
+    loaded = ProcessGeometryIndex.from_data(json.loads(json.dumps(index.to_data())))
+    assert loaded.beam_ids == index.beam_ids
+    assert loaded.beam_assembled_poses == index.beam_assembled_poses
+    assert loaded.beam_grasps == index.beam_grasps
+    assert loaded.beam_neighbours == index.beam_neighbours
+    assert loaded.beam_target_poses == index.beam_target_poses
+    assert loaded.clamp_grasp == index.clamp_grasp
+    for operation in CLAMP_OPERATIONS:
+        # joint ids are tuples again after loading
+        assert loaded.joint_target_poses[operation] == index.joint_target_poses[operation]
+    assert loaded.clamp_at_joint_poses == index.clamp_at_joint_poses
+    # the run-time state is not saved
+    assert loaded.client is None and not loaded.certified_clamp_trajectories['attach']
+
+
+def test_clamp_targets_reversed():
+    index = make_index()
+    assert index.are_clamp_targets_reversed(JOINT_ID)
+    # unknown joint
+    assert not index.are_clamp_targets_reversed(('b2', 'b1'))
+
+    index.joint_target_poses['detach'][JOINT_ID] = index.joint_target_poses['attach'][JOINT_ID][:]
+    assert not index.are_clamp_targets_reversed(JOINT_ID)
+
+    index.joint_target_poses['detach'][JOINT_ID] = list(reversed(index.joint_target_poses['attach'][JOINT_ID]))[:2]
+    assert not index.are_clamp_targets_reversed(JOINT_ID)
+
+    # within tolerance
+    index.joint_target_poses['detach'][JOINT_ID] = [pose(0.5 + 1e-8), pose(0.5, z=0.2), pose(0.5, z=0.5)]
+    assert index.are_clamp_targets_reversed(JOINT_ID)
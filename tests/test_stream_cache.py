@@ -0,0 +1,97 @@
+import os
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+
+pytest.importorskip('compas')
+pytest.importorskip('pybullet_planning')
+# adds the pddlstream and pyplanners submodules to the path
+pytest.importorskip('load_pddlstream')
+
+from stream_cache import StreamCache, get_cached_gen_fn
+from trajectory import CompactTrajectory
+
+JOINT_NAMES = ['bridge1_cart', 'robot11_joint_1', 'robot11_joint_2']
+JOINT_TYPES = [2, 0, 0]
+
+
+def make_cache(tmp_path, max_size_mb=500.0):
+    process = {'assembly' : 'test_process'}
+    robot = SimpleNamespace(model={'name' : 'test_robot'})
+    return StreamCache(process, robot, cache_dir=str(tmp_path), max_size_mb=max_size_mb)
+
+
+def make_traj(seed):
+    return CompactTrajectory(np.random.default_rng(seed).uniform(-1, 1, size=(5, len(JOINT_NAMES))), JOINT_NAMES, JOINT_TYPES)
+
+
+def assert_same_traj(traj1, traj2):
+    assert isinstance(traj2, CompactTrajectory)
+    assert np.allclose(traj1.values, traj2.values)
+    assert traj1.joint_names == traj2.joint_names and traj1.joint_types == traj2.joint_types
+
+
+def test_round_trip_and_append(tmp_path):
+    cache = make_cache(tmp_path)
+    assert cache.load('plan_motion_for_beam_assembly', ('b1', 'g1')) == []
+    trajs = [make_traj(seed) for seed in range(3)]
+    for traj in trajs:
+        cache.save('plan_motion_for_beam_assembly', ('b1', 'g1'), [traj])
+
+    # * one line per output, in the order they were appended
+    outputs = cache.load('plan_motion_for_beam_assembly', ('b1', 'g1'))
+    assert len(outputs) == len(trajs)
+    for traj, output in zip(trajs, outputs):
+        assert_same_traj(traj, output[0])
+    # * other instances and streams have their own entries
+    assert cache.load('plan_motion_for_beam_assembly', ('b2', 'g1')) == []
+    assert cache.load('plan_motion_for_attach_clamp', ('b1', 'g1')) == []
+    # * a new cache of the same geometry reads the stored outputs
+    assert len(make_cache(tmp_path).load('plan_motion_for_beam_assembly', ('b1', 'g1'))) == len(trajs)
+
+
+def test_unreadable_line_is_skipped(tmp_path):
+    cache = make_cache(tmp_path)
+    traj = make_traj(0)
+    cache.save('plan_motion_for_beam_assembly', ('b1', 'g1'), [traj])
+    path = cache._path(cache._key('plan_motion_for_beam_assembly', ('b1', 'g1')))
+    # e.g. a run killed while appending
+    with open(path, 'a') as f:
+        f.write('{"dtype": "trajectory/Compact')
+    outputs = cache.load('plan_motion_for_beam_assembly', ('b1', 'g1'))
+    assert len(outputs) == 1
+    assert_same_traj(traj, outputs[0][0])
+
+
+def test_cached_gen_fn_yields_stored_outputs_first(tmp_path):
+    cache = make_cache(tmp_path)
+    stored, new = make_traj(0), make_traj(1)
+    cache.save('plan_motion_for_beam_assembly', ('b1', 'g1'), [stored])
+
+    def gen_fn(*inputs):
+        yield (new,)
+
+    outputs = list(get_cached_gen_fn(cache, 'plan_motion_for_beam_assembly', gen_fn)('b1', 'g1'))
+    assert len(outputs) == 2
+    assert_same_traj(stored, outputs[0][0])
+    assert outputs[1][0] is new
+    assert (cache.hits, cache.misses) == (1, 1)
+    # * the new output is appended after the stored one
+    assert len(cache.load('plan_motion_for_beam_assembly', ('b1', 'g1'))) == 2
+
+
+def test_evict_least_recently_used(tmp_path):
+    cache = make_cache(tmp_path)
+    for k, beam_id in enumerate(['b1', 'b2', 'b3']):
+        cache.save('plan_motion_for_beam_assembly', (beam_id,), [make_traj(k)])
+        path = cache._path(cache._key('plan_motion_for_beam_assembly', (beam_id,)))
+        os.utime(path, (1000.0 * (k + 1), 1000.0 * (k + 1)))
+    sizes = [os.path.getsize(os.path.join(str(tmp_path), file_name)) for file_name in os.listdir(str(tmp_path))]
+
+    # * room for the two most recently used entries
+    cache.max_size_bytes = sum(sizes) - min(sizes) / 2
+    cache.evict()
+    assert cache.load('plan_motion_for_beam_assembly', ('b1',)) == []
+    assert len(cache.load('plan_motion_for_beam_assembly', ('b2',))) == 1
+    assert len(cache.load('plan_motion_for_beam_assembly', ('b3',))) == 1
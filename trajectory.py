@@ -0,0 +1,95 @@
+import numpy as np
+import pybullet_planning as pp
+from compas_fab.robots import Configuration, JointTrajectory, JointTrajectoryPoint, Duration
+
+# Joint metadata shared by all trajectories, so that decoded trajectories do not each hold their own copy
+_JOINT_METADATA = {}
+
+##########################################
+
+def shared_joint_metadata(joint_names, joint_types):
+    key = (tuple(joint_names), tuple(joint_types))
+    return _JOINT_METADATA.setdefault(key, key)
+
+
+class CompactTrajectory(object):
+    """Joint trajectory stored as one contiguous (num_points, num_joints) float array.
+
+    The joint names and types are shared tuples, and no per-point object is created during the search.
+    A compas `JointTrajectory` is only built with `to_joint_trajectory` when the plan is saved.
+    Serializable with compas' `DataEncoder` / `DataDecoder` (stream cache and parallel samplers).
+    """
+
+    __slots__ = ('values', 'joint_names', 'joint_types', '__weakref__')
+
+    def __init__(self, values, joint_names, joint_types):
+        self.values = np.ascontiguousarray(values, dtype=float)
+        self.joint_names, self.joint_types = shared_joint_metadata(joint_names, joint_types)
+
+    def __len__(self):
+        return self.values.shape[0]
+
+    def __repr__(self):
+        return 'CompactTrajectory({} points, {} joints)'.format(*self.values.shape)
+
+    @property
+    def points(self):
+        """Configurations of the trajectory points, created on each access.
+        """
+        return [Configuration(list(conf_values), list(self.joint_types), list(self.joint_names)) for conf_values in self.values.tolist()]
+
+    def to_joint_trajectory(self):
+        jt_traj_pts = []
+        for i, conf_values in enumerate(self.values.tolist()):
+            jt_traj_pt = JointTrajectoryPoint(joint_values=conf_values, joint_names=list(self.joint_names), joint_types=list(self.joint_types))
+            jt_traj_pt.time_from_start = Duration(i*1,0)
+            jt_traj_pts.append(jt_traj_pt)
+        return JointTrajectory(trajectory_points=jt_traj_pts,
+            joint_names=jt_traj_pts[0].joint_names, start_configuration=jt_traj_pts[0], fraction=1.0)
+
+    # * compas DataEncoder / DataDecoder protocol
+    @property
+    def dtype(self):
+        return '{}/{}'.format(self.__class__.__module__, self.__class__.__name__)
+
+    def to_data(self):
+        return {
+            'values' : self.values.tolist(),
+            'joint_names' : list(self.joint_names),
+            'joint_types' : list(self.joint_types),
+        }
+
+    @classmethod
+    def from_data(cls, data):
+        return cls(data['values'], data['joint_names'], data['joint_types'])
+
+##########################################
+
+def to_joint_trajectory(traj):
+    """compas `JointTrajectory` of a trajectory, other objects are returned unchanged.
+    """
+    return traj.to_joint_trajectory() if isinstance(traj, CompactTrajectory) else traj
+
+
+def trajectory_values(traj):
+    """Joint values of each trajectory point, the array rows for a `CompactTrajectory`.
+    """
+    if isinstance(traj, CompactTrajectory):
+        return traj.values
+    return [point.joint_values for point in traj.points]
+
+
+def replay_trajectory(client, robot_uid, traj, indices=None):
+    """Sets the robot to each point of the trajectory in turn (or only to the points `indices`), yields the point index.
+    For a `CompactTrajectory`, the joint values are set directly from the array rows.
+    """
+    if isinstance(traj, CompactTrajectory):
+        joints = pp.joints_from_names(robot_uid, traj.joint_names)
+        for i in (range(len(traj)) if indices is None else indices):
+            pp.set_joint_positions(robot_uid, joints, traj.values[i])
+            yield i
+    else:
+        points = traj.points
+        for i in (range(len(points)) if indices is None else indices):
+            client._set_body_configuration(robot_uid, points[i])
+            yield i
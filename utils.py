@@ -3,6 +3,7 @@ import os
 from load_pddlstream import HERE
 from termcolor import colored
 from functools import partial
+from collections import OrderedDict
 
 import load_pddlstream
 from pddlstream.utils import str_from_object
@@ -40,6 +41,36 @@ LOGGER = get_logger('robarch_pddl')
 
 ###########################################
 
+class TrajectoryMemo(object):
+    """Values computed for a trajectory, keyed by id(traj).
+
+    Each entry keeps the trajectory so that its id cannot be recycled. The search does not report the
+    trajectories it drops, so at most `max_size` entries are kept and the least recently used one is dropped first.
+    """
+
+    def __init__(self, max_size=1000):
+        self.max_size = max_size
+        # entries[id(traj)] = (traj, value)
+        self.entries = OrderedDict()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, traj):
+        return id(traj) in self.entries
+
+    def __getitem__(self, traj):
+        self.entries.move_to_end(id(traj))
+        return self.entries[id(traj)][1]
+
+    def __setitem__(self, traj, value):
+        self.entries[id(traj)] = (traj, value)
+        self.entries.move_to_end(id(traj))
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+###########################################
+
 def print_pddl_task_object_names(pddl_problem):
     evaluations, goal_exp, domain, externals = parse_problem(
         pddl_problem, unit_costs=True)
@@ -166,6 +197,11 @@ def save_plan_dict(plan, pddl_folder, file_name):
     action_dict = pddl_plan_to_dict(plan)
     import json
     from compas.data import DataEncoder
+    from trajectory import to_joint_trajectory
+    # compact trajectories are converted to compas JointTrajectory for the visualization
+    for sequence in action_dict:
+        for action in sequence['actions']:
+            action['args'] = [to_joint_trajectory(arg) for arg in action['args']]
     with open(file_output_path, 'w') as f:
         json.dump(action_dict, f, indent=4, cls=DataEncoder)
 
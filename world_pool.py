@@ -0,0 +1,67 @@
+import pybullet
+
+from integral_timber_joints.planning.robot_setup import load_RFL_world, get_tolerances
+from integral_timber_joints.planning.state import set_initial_state
+
+from collision_geometry import build_collision_proxies, clear_collision_proxies
+from fk_cache import clear_fk_caches
+from utils import LOGGER
+
+# The world of this process, pybullet_planning works on a single active client so at most one is kept alive
+_ROBOT_WORLD = {}
+
+##########################################
+
+class RobotWorld(object):
+    """Pybullet world with the robot and the objects of a process, loaded once and reused by the planning cases.
+
+    The world state after `set_initial_state` is saved with pybullet's `saveState`, and `reset` restores it
+    instead of reloading the URDFs and meshes. The samplers detach what they attach, so the state of
+    the bodies (poses and joint values) is all that needs to be restored.
+    """
+
+    def __init__(self, process, options=None, viewer=False, verbose=True):
+        options = options or {}
+        self.process = process
+        self.viewer = viewer
+        self.client, self.robot, _ = load_RFL_world(viewer=viewer, verbose=verbose)
+        # frame, conf compare, joint flip and allowable collision tolerances
+        self.tolerances = get_tolerances(self.robot)
+        options.update(self.tolerances)
+        # * initialize collision objects and tools in the scene
+        assert set_initial_state(self.client, self.robot, process, initialize=True, options=options), 'Setting initial state failed.'
+        # * simplified collision geometry, its bodies must exist before the state is saved
+        build_collision_proxies(self.client, self.robot, process, options)
+        self.state_id = pybullet.saveState(physicsClientId=self.client.client_id)
+        self.reset_count = 0
+
+    def reset(self):
+        pybullet.restoreState(stateId=self.state_id, physicsClientId=self.client.client_id)
+        self.reset_count += 1
+
+    def close(self):
+        clear_collision_proxies(self.client)
+        clear_fk_caches(self.client)
+        self.client.disconnect()
+
+##########################################
+
+def get_robot_world(process, options=None, viewer=False, verbose=True):
+    """Returns (client, robot) of a world at the initial state of the process, with the tolerances added to `options`.
+    The world of the previous call is restored from its snapshot if it was loaded for the same process and viewer,
+    and replaced by a new one otherwise.
+    """
+    options = options if options is not None else {}
+    world = _ROBOT_WORLD.get('world')
+    if world is not None and (world.process is not process or world.viewer != viewer):
+        world.close()
+        world = None
+
+    if world is None:
+        world = RobotWorld(process, options, viewer=viewer, verbose=verbose)
+        _ROBOT_WORLD['world'] = world
+    else:
+        world.reset()
+        options.update(world.tolerances)
+        LOGGER.debug('Robot world restored from its initial state snapshot ({} resets).'.format(world.reset_count))
+    return world.client, world.robot